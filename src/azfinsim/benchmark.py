@@ -0,0 +1,4 @@
+from .details import getargs, benchmark
+
+args = getargs.getargs("benchmark")
+benchmark.execute(args)
@@ -0,0 +1,4 @@
+from .details import getargs, collect
+
+args = getargs.getargs("collect")
+collect.execute(args)
@@ -1,17 +1,60 @@
+import atexit
 import colorlog
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 from . import metrics
 
+# log records are handed to the handlers (console, azure) by a background thread, so that
+# formatting and handler I/O stay off the hot path
+_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the listener runs in this process, so records can be queued as they are and the
+        # message is only formatted by the listener thread
+        return record
+
+
+def _add_handler(handler: logging.Handler):
+    """adds a handler to the package logger, behind the background listener"""
+    if _listener is None:
+        logging.getLogger(__name__).addHandler(handler)
+    else:
+        _listener.handlers = _listener.handlers + (handler,)
+
+
+def _synchronous_logging():
+    """attaches the handlers to the package logger directly, e.g. in a forked child process,
+    where the listener thread doesn't exist"""
+    global _listener
+    if _listener is None:
+        return
+    logger = logging.getLogger(__name__)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    for handler in _listener.handlers:
+        logger.addHandler(handler)
+    _listener = None
+
+
+def _stop_listener():
+    # flush pending records at exit
+    if _listener is not None:
+        _listener.stop()
+
+
 # helper setup azure log handler
 def _az_log_handler(connection_string: str):
     # register log handler
     from opencensus.ext.azure.log_exporter import AzureLogHandler
 
-    logger = logging.getLogger(__name__)
-    logger.addHandler(AzureLogHandler(connection_string=connection_string))
+    _add_handler(AzureLogHandler(connection_string=connection_string))
 
     # register metrics exporter
     from opencensus.ext.azure import metrics_exporter
@@ -41,7 +84,14 @@ def _initialize_logging():
         )
 
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+
+    global _listener
+    records = queue.SimpleQueue()
+    logger.addHandler(_QueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, ch, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_synchronous_logging)
 
     # setup azure log handler from env var
     if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING") is not None:
@@ -60,7 +110,10 @@ def _initialize_logging():
 def process_args(progname, args):
     """call this function to process command line arguments to update package logging settings"""
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    if args.log_level is not None:
+        logger.setLevel(args.log_level.upper())
+    else:
+        logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
 
     # setup azure log handler
     if args.app_insights is not None:
@@ -75,6 +128,17 @@ def process_args(progname, args):
     if args.tags is not None:
         tags.update(args.tags)
     metrics.initialize_tags(tags)
+    metrics.configure(
+        metrics.create_sink(args.metrics_sink, args.metrics_path), args.metrics_interval
+    )
+
+    # setup resource telemetry
+    if args.telemetry:
+        if args.telemetry_interval <= 0:
+            raise ValueError("telemetry_interval must be positive")
+        from . import telemetry
+
+        telemetry.start(args.telemetry_interval)
 
     logger = logging.getLogger(__name__)
     for key in dir(args):
@@ -0,0 +1,92 @@
+r"""
+closed-form pricing of the knock-out option simulated by `montecarlo`.
+
+The settlement pays `warrantsNo * notionalPerWarr * max(0, S / strike - 1) / S` (times a fixed
+factor) at maturity, unless the FX rate drops below the strike at any monitoring date. With the
+vol of vol `v` (and the correlation `ro`) at zero, the FX rate is a geometric Brownian motion,
+for which the expected payoff of a barrier option has a closed form. The discrete (daily)
+monitoring of the simulation is accounted for by shifting the barrier down by
+`exp(-0.5826 * sigma * sqrt(dt))` (Broadie, Glasserman & Kou, 1997).
+
+The approximation is accurate while the vol of vol over the life of the trade is small and the
+spot is a few daily standard deviations away from the barrier; `in_band` tells which trades are
+within a validity band, e.g. to fall back to Monte Carlo for the others.
+"""
+import math
+
+import numpy as np
+
+try:
+    from scipy.special import ndtr
+except ImportError:
+    _erfc = np.vectorize(math.erfc, otypes=[np.float64])
+
+    def ndtr(x):
+        # standard normal cdf
+        return 0.5 * _erfc(-np.asarray(x) / math.sqrt(2))
+
+# shift of the barrier, in daily standard deviations, approximating discrete monitoring
+BGK_BETA = 0.5825971579390106  # -zeta(1/2) / sqrt(2 * pi)
+
+# default validity band
+MAX_VOL_OF_VOL = 0.002  # v * sqrt(maturity)
+MIN_BARRIER_DISTANCE = 2.0  # log(fx1 / strike) in daily standard deviations
+
+
+def _survival_moments(a, b, nu, sigma, maturity):
+    """returns `E[1{X_T > a, min X > b}]` and `E[exp(-X_T) 1{X_T > a, min X > b}]` for the
+    Brownian motion `X_t = nu * t + sigma * W_t`, with `a >= b` and `b < 0`"""
+    s = sigma * np.sqrt(maturity)
+    m = nu * maturity
+    reflection = np.exp(2 * nu * b / sigma**2)
+
+    def moments(mean):
+        p = ndtr((mean - a) / s)
+        q = np.exp(-mean + 0.5 * s**2) * ndtr((mean - s**2 - a) / s)
+        return p, q
+
+    p, q = moments(m)
+    p_reflected, q_reflected = moments(m + 2 * b)
+    return p - reflection * p_reflected, q - reflection * q_reflected
+
+
+def price(inputs) -> float:
+    """returns the PV of the trade, ignoring the vol of vol (see module documentation);
+    `inputs` are the trade parameters, as for `montecarlo.price`, or arrays thereof"""
+    fx1 = np.asarray(inputs["fx1"], dtype=np.float64)
+    strike = np.asarray(inputs["strike"], dtype=np.float64)
+    sigma = np.asarray(inputs["sigma1"], dtype=np.float64)
+    drift = np.asarray(inputs["drift"], dtype=np.float64)
+    maturity = np.asarray(inputs["maturity"], dtype=np.float64)
+    dt = maturity / np.asarray(inputs["t_steps"], dtype=np.float64)
+
+    barrier = np.log(strike / fx1) - BGK_BETA * sigma * np.sqrt(dt)
+    p, q = _survival_moments(np.log(strike / fx1), barrier, drift - 0.5 * sigma**2, sigma, maturity)
+    # E[max(0, S / strike - 1) / S] = E[1 - strike / S] / strike, over the surviving paths
+    expected = (p - strike / fx1 * q) / strike
+    pv = inputs["warrantsNo"] * inputs["notionalPerWarr"] * expected * 1.000799081
+    return np.where(fx1 > strike, pv, 0.0) if np.ndim(pv) else (float(pv) if fx1 > strike else 0.0)
+
+
+def risk(parameter, inputs, alpha=0.01):
+    """returns the sensitivity to `parameter` (e.g. "fx1" for delta, "sigma1" for vega), by
+    repricing the closed form with the same relative bumps, and scaling, as `montecarlo.risk`;
+    as the pricing is exact, this has no simulation noise"""
+    delta = inputs[parameter] * alpha
+    up = dict(inputs, **{parameter: inputs[parameter] + delta})
+    down = dict(inputs, **{parameter: inputs[parameter] - delta})
+    return (price(up) - price(down)) / 2 / delta / 10000
+
+
+def in_band(inputs, max_vol_of_vol=MAX_VOL_OF_VOL, min_barrier_distance=MIN_BARRIER_DISTANCE):
+    """returns whether the closed form is a good approximation for the trade(s): the vol of vol
+    over the life of the trade is at most `max_vol_of_vol`, and the spot is at least
+    `min_barrier_distance` daily standard deviations above the barrier"""
+    fx1 = np.asarray(inputs["fx1"], dtype=np.float64)
+    strike = np.asarray(inputs["strike"], dtype=np.float64)
+    maturity = np.asarray(inputs["maturity"], dtype=np.float64)
+    daily_stdev = np.asarray(inputs["sigma1"], dtype=np.float64) * np.sqrt(maturity / np.asarray(inputs["t_steps"]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance = np.log(fx1 / strike) / daily_stdev
+    vol_of_vol = np.abs(np.asarray(inputs["v"], dtype=np.float64)) * np.sqrt(maturity)
+    return (vol_of_vol <= max_vol_of_vol) & (distance >= min_barrier_distance)
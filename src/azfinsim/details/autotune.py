@@ -0,0 +1,91 @@
+r"""
+runtime tuning of the batching and parallelism of `azfinsim`.
+
+A short calibration phase (see `azfinsim.calibrate`) processes the first trades of the window
+in small batches, timed, to measure the fixed time per batch (reading, writing and handling
+the batch) and the time per trade, in process and with a pool of a worker per CPU, along with
+the round trip latency of reading from the cache. From these, `choose` picks the number of
+workers with the highest throughput, and the smallest read chunk and batch sizes whose
+throughput is within `EFFICIENCY` of that of unbounded batches: larger batches only hold more
+trades in memory, and lose more work when a task fails.
+
+The measurements are persisted to a json file, per profile (see `profile`), so that later
+tasks, e.g. on the same pool, reuse them instead of calibrating again.
+"""
+import json
+import math
+import os
+import time
+
+# fraction of the throughput of unbounded batches to achieve
+EFFICIENCY = 0.98
+
+# trades in the larger of the batches processed in process while calibrating
+SAMPLE_TRADES = 8
+
+MAX_BATCH = 100000
+
+
+def profile(args) -> str:
+    """returns the key the measurements are persisted under: the cache, the workload and the
+    number of CPUs"""
+    cache = args.cache_name if args.cache_type in ["redis", "memory"] else args.cache_type
+    if args.algorithm == "synthetic":
+        workload = "{}:{}ms".format(args.synthetic_profile, args.task_duration)
+    else:
+        workload = "{}:{}:{}".format(args.kernel, args.precision, args.time_steps or "daily")
+    return "/".join([cache, args.algorithm, workload, "cpus={}".format(os.cpu_count() or 1)])
+
+
+def timed(function, *args, repeat: int = 3) -> float:
+    """returns the shortest of `repeat` timings of `function(*args)`, in seconds"""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def choose(measured: dict, trade_window: int) -> dict:
+    """returns the settings (`read_chunk`, `batch_size` and `workers`) for the measurements:
+    the read `latency` of the cache, the fixed time per batch (`overhead`), and the time per
+    trade in process (`trade_time`) and with a pool of `cpus` workers (`pool_time`, None if
+    not measured)"""
+    pool_time = measured.get("pool_time")
+    workers = measured["cpus"] if pool_time is not None and pool_time < measured["trade_time"] else 1
+    per_trade = pool_time if workers > 1 else measured["trade_time"]
+    # time per trade that can be spent on overheads, shared between read chunks and batches
+    slack = 0.5 * (1 / EFFICIENCY - 1) * per_trade
+
+    def size(overhead: float) -> int:
+        return MAX_BATCH if slack <= 0 else max(1, math.ceil(overhead / slack))
+
+    # a round trip per read chunk
+    read_chunk = min(size(measured["latency"]), MAX_BATCH, trade_window)
+    # with a pool, workers idle while the last trades of a batch are priced
+    tail = measured["trade_time"] if workers > 1 else 0.0
+    batch_size = math.ceil(max(size(measured["overhead"] + tail), workers) / read_chunk) * read_chunk
+    batch_size = min(batch_size, MAX_BATCH, trade_window)
+    return {"read_chunk": min(read_chunk, batch_size), "batch_size": batch_size, "workers": workers}
+
+
+def load(fname: str, key: str) -> dict:
+    """returns the measurements persisted for the profile, or None"""
+    if fname is None or not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f).get(key)
+
+
+def save(fname: str, key: str, measured: dict) -> None:
+    """persists the measurements for the profile, keeping those of other profiles"""
+    profiles = {}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            profiles = json.load(f)
+    profiles[key] = measured
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmpname, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmpname, fname)
@@ -2,16 +2,21 @@
 
 # This is the main execution engine that runs on the pool nodes
 
+import argparse
+import concurrent.futures
 import time
 import sys
 import logging
-import pandas as pd
+import random
+import numpy as np
 import os.path
 from numpy.random import random_sample
 
-from . import utils, montecarlo
+from . import analytic, autotune, utils, montecarlo, numba_kernel, resultcache, costmodel, sharedmem
 from . import metrics
-from .dbase import connect
+from .generator import create_trade_range
+from .dbase import TradesCacheFile, TradesCacheRedisStream, connect, redis_client, trade_version
+from .trades import ResultBatch, Trade, TradeBatch
 
 # config for metrics
 _metrics_config = {
@@ -27,6 +32,12 @@ _metrics_config = {
         "type": "float",
         "aggregation": "sum",
     },
+    "out_of_band": {
+        "description": "trades outside the validity band of the analytic pricer",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "sum",
+    },
     "failed": {
         "description": "Calculation failed",
         "unit": "count",
@@ -37,8 +48,19 @@ _metrics_config = {
 
 log = logging.getLogger(__name__)
 
+# per-trade timings, which aren't kept in the result cache: cached results report no compute time
+_timings = ["pv_time"]
+
 
 def check_args(args):
+    _check_cache_args(args)
+    _check_batch_args(args)
+    _check_result_args(args)
+    check_pricing_args(args)
+
+
+def _default_cache(args):
+    """fills in the cache type, and name, implied by the other cache arguments"""
     if (
         args.cache_type is None
         and args.cache_path is not None
@@ -57,14 +79,34 @@ def check_args(args):
         log.info("{:16}: --cache-type=redis".format("AUTO_ARG"))
         args.cache_type = "redis"
 
-    if args.cache_type == "redis":
+    if args.cache_type == "memory" and args.cache_name is None:
+        log.info("{:16}: --cache-name=default".format("AUTO_ARG"))
+        args.cache_name = "default"
+
+
+def _check_cache_args(args):
+    """validates the cache arguments"""
+    _default_cache(args)
+    if args.cache_type in ["redis", "memory"]:
         if args.cache_name is None:
             raise ValueError("cache_name must be specified for redis cache")
+    if args.cache_hash_chunk is not None and args.cache_hash_chunk < 0:
+        raise ValueError("cache_hash_chunk must not be negative")
+    if args.cache_cluster and args.cache_type != "redis":
+        raise ValueError("cache_cluster requires redis cache")
+    _default_window(args)
+
+
+def _default_window(args):
+    """fills in the start trade and output path, for the caches that imply them"""
+    if args.cache_type in ["memory", "generated"]:
+        # the in-process cache is populated by this process, and the generated cache has no
+        # trades stored, so there is no manifest to read
         if args.start_trade is None:
             log.info("{:16}: --start-trade=0".format("AUTO_ARG"))
             args.start_trade = 0
         if args.trade_window is None:
-            raise ValueError("trade_window must be specified for redis cache")
+            raise ValueError("trade_window must be specified for {} cache".format(args.cache_type))
 
     if args.cache_type == "filesystem":
         if args.cache_path is None:
@@ -73,49 +115,627 @@ def check_args(args):
             args.output_path = os.path.dirname(args.cache_path)
             log.info("{:16}: --output-path={}".format("AUTO_ARG", args.output_path))
 
+    if args.cache_type == "generated" and args.output_path is None:
+        args.output_path = "."
+        log.info("{:16}: --output-path={}".format("AUTO_ARG", args.output_path))
+
+
+def _check_batch_args(args):
+    """validates the batching and logging arguments"""
+    if args.log_sample < 1:
+        raise ValueError("log_sample must be positive")
+    if args.batch_size < 1:
+        raise ValueError("batch_size must be positive")
+    if args.read_chunk is not None and args.read_chunk < 1:
+        raise ValueError("read_chunk must be positive")
+    if args.autotune_file is not None and not args.autotune:
+        raise ValueError("autotune_file requires autotune")
+
+
+def _check_result_args(args):
+    """validates the arguments for writing and reusing results"""
+    if args.result_sink != "keys" and args.cache_type not in ["redis", "memory"]:
+        raise ValueError("result_sink is only supported with redis cache")
+    if args.delta and args.cache_type not in ["redis", "memory"]:
+        raise ValueError("delta is only supported with redis cache")
+
+    if args.result_cache == "redis" and args.cache_name is None:
+        raise ValueError("cache_name must be specified for redis result cache")
+    if args.result_cache == "file" and args.result_cache_path is None:
+        raise ValueError("result_cache_path must be specified for file result cache")
+
+
+def check_pricing_args(args):
+    """validates the algorithm and worker arguments (shared with azfinsim.pipeline)"""
+    _check_trials_args(args)
+    if args.algorithm == "synthetic":
+        _check_synthetic_args(args)
+
+    if args.workers < 1:
+        raise ValueError("workers must be positive")
+    if args.shared_memory and args.workers < 2:
+        raise ValueError("shared_memory requires more than one worker")
+
+    _check_kernel_args(args)
+
+
+def _check_trials_args(args):
+    """validates the arguments choosing the paths simulated per trade"""
+    if args.target_stderr is None and args.max_trials is not None:
+        raise ValueError("max_trials requires target_stderr")
+    if args.max_trials is not None and args.max_trials < 1:
+        raise ValueError("max_trials must be positive")
+    if args.trials_block < 1:
+        raise ValueError("trials_block must be positive")
+    if args.algorithm == "scenarios":
+        if args.scenarios is None:
+            raise ValueError("scenarios must be specified for scenarios algorithm")
+        montecarlo.scenario_grid(args.scenarios)  # validate
+        if args.target_stderr is not None:
+            raise ValueError("target_stderr is not supported by scenarios algorithm")
+
+
+def _check_synthetic_args(args):
+    """validates the synthetic workload arguments"""
+    if args.task_duration < 0:
+        raise ValueError("task_duration must not be negative")
+    if args.synthetic_profile == "threads" and args.synthetic_threads is None:
+        args.synthetic_threads = os.cpu_count() or 1
+        log.info("{:16}: --synthetic-threads={}".format("AUTO_ARG", args.synthetic_threads))
+    if args.synthetic_threads is not None and args.synthetic_threads < 1:
+        raise ValueError("synthetic_threads must be positive")
+    if args.duration_sigma < 0:
+        raise ValueError("duration_sigma must not be negative")
+    if not 0 <= args.bimodal_fraction <= 1:
+        raise ValueError("bimodal_fraction must be between 0 and 1")
+    if args.bimodal_ratio < 1:
+        raise ValueError("bimodal_ratio must be at least 1")
+
+
+def _check_kernel_args(args):
+    """validates the simulation kernel arguments"""
+    if args.kernel == "numba" and not numba_kernel.available:
+        log.warning("numba is not installed")
+        log.info("{:16}: --kernel=numpy".format("AUTO_ARG"))
+        args.kernel = "numpy"
+    if args.algorithm == "scenarios" and args.kernel != "numpy":
+        raise ValueError(f"{args.kernel} kernel is not supported by scenarios algorithm")
+    if args.precision != "float64" and args.kernel != "numpy":
+        raise ValueError(f"{args.kernel} kernel only supports float64 precision")
+    if args.time_steps is not None:
+        if args.time_steps < 1:
+            raise ValueError("time_steps must be positive")
+        if args.kernel != "numpy":
+            raise ValueError(f"{args.kernel} kernel doesn't support time_steps")
+
+
+def mc_options(args) -> dict:
+    """returns the keyword arguments for `montecarlo.price` / `montecarlo.risk`"""
+    return {
+        "target_stderr": args.target_stderr,
+        "max_trials": args.max_trials,
+        "trials_block": args.trials_block,
+        "antithetic": args.antithetic,
+        "control_variate": args.control_variate,
+        "sampler": args.sampler,
+        "kernel": args.kernel,
+        "precision": args.precision,
+        "time_steps": args.time_steps,
+    }
+
+
+_synthetic_workload = None
+
+
+def synthetic_workload(args) -> utils.SyntheticWorkload:
+    """returns the synthetic workload for this process, allocating its buffers on first use"""
+    global _synthetic_workload
+    if _synthetic_workload is None:
+        _synthetic_workload = utils.SyntheticWorkload(
+            args.synthetic_profile, mem_usage=args.mem_usage, threads=args.synthetic_threads or 1
+        )
+    return _synthetic_workload
+
+
+def analytic_band(args) -> dict:
+    """returns the validity band of the analytic pricer, as arguments for `analytic.in_band`"""
+    return {
+        "max_vol_of_vol": args.analytic_max_vol_of_vol,
+        "min_barrier_distance": args.analytic_min_barrier_distance,
+    }
+
+
+def compute(args, tradenum: int, trade: Trade, options: dict) -> dict:
+    """prices a single trade; returns the result row as a dict of column lists"""
+    start_compute_ts = time.perf_counter()
+    row_s = {"tradenum": tradenum}
+    if args.algorithm == "synthetic":
+        # -- fake pricing computation - tunable duration - mainly for benchmarking schedulers
+        duration = utils.SampleDuration(
+            args.task_duration / 1000.0,  # - convert from ms to s
+            args.duration_distribution,
+            sigma=args.duration_sigma,
+            fraction=args.bimodal_fraction,
+            ratio=args.bimodal_ratio,
+        )
+        if duration > 0:
+            synthetic_workload(args).run(duration)
+        # generate fake results
+        row_s["random"] = [random_sample()]
+    elif args.algorithm == "pvonly":
+        log.debug("TRADE %10d: Start PV", tradenum)
+        pv = montecarlo.price(trade, **options)
+        row_s["pv"] = [pv["pv"]]
+        row_s["pv_stderr"] = [pv["pv_stderr"]]
+        row_s["trials_used"] = [pv["trials_used"]]
+        row_s["pv_time"] = [time.perf_counter() - start_compute_ts]
+    elif args.algorithm == "deltavega":
+        # --- Perform timedelta vega risk calculation
+        log.debug("TRADE %10d: Start Delta Vega", tradenum)
+        row_s["delta"] = [montecarlo.risk("fx1", trade.copy(), **options)]
+        row_s["vega"] = [montecarlo.risk("sigma1", trade.copy(), **options)]
+    elif args.algorithm in ["analytic", "hybrid"]:
+        # --- closed form PV, delta and vega; with hybrid, Monte Carlo for trades outside the band
+        in_band = bool(analytic.in_band(trade, **analytic_band(args)))
+        if not in_band:
+            metrics.put("out_of_band", 1)
+        if in_band or args.algorithm == "analytic":
+            log.debug("TRADE %10d: Start Analytic", tradenum)
+            row_s["pv"] = [analytic.price(trade)]
+            row_s["pv_stderr"] = [0.0]
+            row_s["delta"] = [analytic.risk("fx1", trade)]
+            row_s["vega"] = [analytic.risk("sigma1", trade)]
+        else:
+            log.debug("TRADE %10d: Start Monte Carlo fallback", tradenum)
+            pv = montecarlo.price(trade, **options)
+            row_s["pv"] = [pv["pv"]]
+            row_s["pv_stderr"] = [pv["pv_stderr"]]
+            row_s["delta"] = [montecarlo.risk("fx1", trade.copy(), **options)]
+            row_s["vega"] = [montecarlo.risk("sigma1", trade.copy(), **options)]
+        row_s["in_band"] = [int(in_band)]
+    elif args.algorithm == "scenarios":
+        # --- price the trade under all scenarios of the risk ladder, one row per scenario
+        log.debug("TRADE %10d: Start Scenarios", tradenum)
+        grid = montecarlo.scenario_grid(args.scenarios)
+        pvs = montecarlo.price_scenarios(
+            trade,
+            args.scenarios,
+            **{k: options[k] for k in ["antithetic", "control_variate", "sampler", "precision", "time_steps"]},
+        )
+        row_s["scenario"] = list(range(len(grid)))
+        for parameter in args.scenarios:
+            row_s[f"{parameter}_shock"] = [shocks[parameter] for shocks in grid]
+        row_s["pv"] = [pv["pv"] for pv in pvs]
+        row_s["pv_stderr"] = [pv["pv_stderr"] for pv in pvs]
+    else:
+        raise RuntimeError("Unknown algorithm: %s" % args.algorithm)
+    return row_s
+
+
+def result_layout(args) -> list:
+    """returns the `(column, count, dtype)` of the values `compute` returns for a trade
+    (but the trade number), e.g. to preallocate result arrays"""
+    if args.algorithm == "synthetic":
+        return [("random", 1, np.float64)]
+    elif args.algorithm == "pvonly":
+        return [
+            ("pv", 1, np.float64),
+            ("pv_stderr", 1, np.float64),
+            ("trials_used", 1, np.int64),
+            ("pv_time", 1, np.float64),
+        ]
+    elif args.algorithm == "deltavega":
+        return [("delta", 1, np.float64), ("vega", 1, np.float64)]
+    elif args.algorithm in ["analytic", "hybrid"]:
+        return [
+            ("pv", 1, np.float64),
+            ("pv_stderr", 1, np.float64),
+            ("delta", 1, np.float64),
+            ("vega", 1, np.float64),
+            ("in_band", 1, np.int64),
+        ]
+    elif args.algorithm == "scenarios":
+        count = len(montecarlo.scenario_grid(args.scenarios))
+        return (
+            [("scenario", count, np.int64)]
+            + [(f"{parameter}_shock", count, np.float64) for parameter in args.scenarios]
+            + [("pv", count, np.float64), ("pv_stderr", count, np.float64)]
+        )
+    else:
+        raise RuntimeError("Unknown algorithm: %s" % args.algorithm)
 
-def execute(args):
-    # validate and sanitize args
-    check_args(args)
 
-    log.info("{0:16}: azfinsim starting".format("BEGIN"))
+def price_trade(args, tradenum: int, trade: Trade, options: dict) -> tuple:
+    """computes the result row for a trade; returns `(row_s, compute time)`"""
+    start_compute_ts = time.perf_counter()
+    if args.seed is not None:
+        np.random.seed((args.seed + tradenum) % (1 << 32))
+    row_s = compute(args, tradenum, trade, options)
+    return row_s, time.perf_counter() - start_compute_ts
 
-    # setup metrics
-    metrics.define_measurements_and_views(_metrics_config)
-    metrics.put("failed", 0)
 
-    # -- open connection to dbase
+# arguments for `price_trade` in worker processes, set by `_init_worker`
+_worker_args = None
+
+
+def _init_worker(args, options):
+    global _worker_args
+    _worker_args = args, options
+    # forked workers would otherwise all draw the same random numbers
+    np.random.seed()
+    random.seed()
+
+
+def _price_trade_task(tradenum: int, trade: Trade) -> tuple:
+    args, options = _worker_args
+    row_s, compute_ts = price_trade(args, tradenum, trade, options)
+    return tradenum, row_s, compute_ts, metrics.drain()
+
+
+def _price_shared_task(spec: tuple, position: int) -> tuple:
+    """prices the trade at `position` in the shared block, writing the results back to it"""
+    args, options = _worker_args
+    block = sharedmem.attached(spec)
+    trade = Trade(
+        (name[len("trade."):], column[position].item())
+        for name, column in block.columns.items()
+        if name.startswith("trade.")
+    )
+    row_s, compute_ts = price_trade(args, trade["tradenum"], trade, options)
+    for column, values in row_s.items():
+        if column != "tradenum":
+            block.columns["result." + column][position] = values
+    return position, compute_ts, metrics.drain()
+
+
+def worker_pool(args, options) -> concurrent.futures.ProcessPoolExecutor:
+    # the open config file can't be passed to the workers
+    worker_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != "config"})
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers, initializer=_init_worker, initargs=(worker_args, options)
+    )
+
+
+def compute_all(args, trades: TradeBatch, pending: dict, options: dict, pool, cost_model, units: dict):
+    """prices the pending trades, in the pool if any; yields `(tradenum, row_s, compute time)`"""
+    if pool is None:
+        for tradenum, (trade, _) in pending.items():
+            yield (tradenum, *price_trade(args, tradenum, trade, options))
+        return
+
+    # dispatch the most expensive trades first, so that workers aren't left waiting
+    # on a large trade picked up at the end
+    costs = dict(zip(units, cost_model.estimate(costmodel.profile(args), list(units.values()))))
+    order = sorted(pending, key=lambda tradenum: costs[tradenum], reverse=True)
+    if args.shared_memory:
+        yield from _compute_shared(args, trades, order, pool)
+        return
+    futures = [pool.submit(_price_trade_task, tradenum, pending[tradenum][0]) for tradenum in order]
+    for future in concurrent.futures.as_completed(futures):
+        tradenum, row_s, compute_ts, drained = future.result()
+        metrics.merge(drained)
+        yield tradenum, row_s, compute_ts
+
+
+def _compute_shared(args, trades: TradeBatch, order: list, pool):
+    """prices the trades in the pool, passing the (numeric) trade columns to the workers,
+    and collecting the results, through a shared memory block"""
+    layout = result_layout(args)
+    index = {tradenum: position for position, tradenum in enumerate(trades.tradenums)}
+    inputs = trades.take([index[tradenum] for tradenum in order])
+    columns = {
+        "trade." + name: inputs[name] for name in inputs.columns if inputs[name].dtype.kind in "biuf"
+    }
+    columns.update({"result." + column: ((len(order), count), dtype) for column, count, dtype in layout})
+    block = sharedmem.SharedColumns.create(columns)
+    try:
+        futures = [pool.submit(_price_shared_task, block.spec, position) for position in range(len(order))]
+        for future in concurrent.futures.as_completed(futures):
+            position, compute_ts, drained = future.result()
+            metrics.merge(drained)
+            row_s = {"tradenum": order[position]}
+            for column, _, _ in layout:
+                row_s[column] = block.columns["result." + column][position].tolist()
+            yield order[position], row_s, compute_ts
+    finally:
+        block.close()
+
+
+def calibrate(args, dbase, tradenums, process, options) -> tuple:
+    """measures the cache latency, and the time to process (read, price and write) the first
+    trades of the window: two batches of a single trade and one of `autotune.SAMPLE_TRADES`
+    in this process, and, with more than one CPU, two of two trades per worker with a worker
+    per CPU, the first of which warms up the workers; returns the measurements (see
+    `autotune.choose`), or None if the window is too small, the number of trades processed,
+    and the pool"""
+    cpus = os.cpu_count() or 1
+    sizes = [1, 1, autotune.SAMPLE_TRADES] + ([2 * cpus] * 2 if cpus > 1 else [])
+    if len(tradenums) < sum(sizes):
+        return None, 0, None
+    latency = autotune.timed(dbase.get_batch, tradenums[:1])
+
+    timings = []  # (elapsed, compute time) per batch
+    pool = None
+    offset = 0
+    for index, size in enumerate(sizes):
+        if index == 3:
+            pool = worker_pool(argparse.Namespace(**dict(vars(args), workers=cpus)), options)
+            list(pool.map(int, range(cpus)))  # starts the workers
+        start = time.perf_counter()
+        compute_ts = process(offset, size, pool)
+        timings.append((time.perf_counter() - start, compute_ts))
+        offset += size
+
+    # the time spent outside of pricing is the fixed time per batch, plus some time per trade
+    single = min(elapsed - compute_ts for elapsed, compute_ts in timings[:2])
+    elapsed, compute_ts = timings[2]
+    per_trade = max(0.0, (elapsed - compute_ts - single) / (autotune.SAMPLE_TRADES - 1))
+    overhead = max(0.0, single - per_trade)
+    measured = {
+        "latency": latency,
+        "overhead": overhead,
+        "trade_time": (elapsed - overhead) / autotune.SAMPLE_TRADES,
+        # the first batch in the pool includes e.g. the workers' first calls
+        "pool_time": max(0.0, timings[4][0] - overhead) / (2 * cpus) if pool is not None else None,
+        "cpus": cpus,
+    }
+    return measured, offset, pool
+
+
+def tune(args, dbase, tradenums, process, options) -> tuple:
+    """sets the read chunk, batch size and workers from the measurements persisted for this
+    profile, if any, or by calibrating (see `autotune`); returns the number of trades processed
+    while calibrating, and the worker pool to use, if any"""
+    key = autotune.profile(args)
+    measured = autotune.load(args.autotune_file, key)
+    done, pool = 0, None
+    if measured is not None:
+        log.info("{:16}: reusing {} from {}: {}".format("AUTOTUNE", key, args.autotune_file, measured))
+    else:
+        measured, done, pool = calibrate(args, dbase, tradenums, process, options)
+        if measured is None:
+            log.warning("too few trades to calibrate; using --batch-size={}".format(args.batch_size))
+            measured = {}
+        else:
+            log.info("{:16}: calibrated {}: {}".format("AUTOTUNE", key, measured))
+            if args.autotune_file is not None:
+                autotune.save(args.autotune_file, key, measured)
+
+    if measured:
+        for name, value in autotune.choose(measured, max(1, len(tradenums) - done)).items():
+            setattr(args, name, value)
+            log.info("{:16}: --{}={}".format("AUTO_ARG", name.replace("_", "-"), value))
+    if pool is not None and args.workers == 1:
+        pool.shutdown()
+        pool = None
+    elif pool is None and args.workers > 1:
+        pool = worker_pool(args, options)
+    return done, pool
+
+
+def _connect(args) -> tuple:
+    """connects to the cache; returns the trades cache, and the cache the results are written to"""
     log.info(
         "CACHE %10s: CONNECT %s",
         "",
-        args.cache_path if args.cache_type == "filesystem" else args.cache_name,
+        {"filesystem": args.cache_path, "generated": "generated"}.get(args.cache_type, args.cache_name),
     )
-    if args.cache_type == "filesystem":
+    if args.cache_type in ["filesystem", "generated"]:
         dbase = connect(args, mode="r")
 
         # if cache_type is filesystem then we need a separate connection for output
-        dirname, basename = os.path.split(args.cache_path)
-        name, ext = os.path.splitext(basename)
+        if args.cache_type == "generated":
+            # results of generated trades are written to a file named after the trade window
+            name, ext = "generated.%d" % args.start_trade, ".csv"
+        else:
+            dirname, basename = os.path.split(args.cache_path)
+            name, ext = os.path.splitext(basename)
         args.cache_path = os.path.join(args.output_path, f"{name}.results{ext}")
+        os.makedirs(args.output_path or ".", exist_ok=True)
         log.info("CACHE %10s: RESULTS %s", "", args.cache_path)
-        results_dbase = connect(args, mode="w")
+        results_dbase = TradesCacheFile(args.cache_path, mode="w", compression=args.cache_compression)
     else:
         # to avoid overwriting the input cache, we use a different key pattern
         # for the output by passing the `write_key`` argument
-        dbase = connect(args, mode="rw", write_key='%s:{}' % args.algorithm)
+        write_key = '%s:{}:{}' if args.algorithm == "scenarios" else '%s:{}'
+        dbase = connect(
+            args,
+            mode="rw",
+            write_key=write_key % args.algorithm,
+            write_versions="%s:versions" % args.algorithm,
+            write_manifest="%s:manifest" % args.algorithm,
+        )
         results_dbase = dbase
+        if args.result_sink == "stream":
+            results_dbase = TradesCacheRedisStream(
+                redis_client(args),
+                mode="w",
+                stream="%s:results" % args.algorithm,
+                write_versions="%s:versions" % args.algorithm,
+                compression=args.cache_compression,
+            )
     log.info("CACHE %10s: CONNECTED", "")
+    return dbase, results_dbase
 
+
+def _resolve_window(args, dbase) -> None:
+    """fills in the start trade and trade window, if not specified, from the cache"""
     if args.start_trade is None:
-        assert args.cache_type == "filesystem"
+        # the first trade in the file, or in the redis manifest
         args.start_trade = int(dbase.get_first_trade()["tradenum"])
         log.info("{:16}: --start-trade={}".format("AUTO_ARG", args.start_trade))
 
     if args.trade_window is None:
-        assert args.cache_type == "filesystem"
-        args.trade_window = dbase.get_trade_count()
+        # the consecutive trades from the start trade on
+        ranges = dbase.get_trade_ranges()
+        args.trade_window = next(
+            (stop - args.start_trade for start, stop in ranges if start <= args.start_trade < stop), 0
+        )
+        if any(start > args.start_trade for start, _ in ranges):
+            log.warning("trade numbers aren't consecutive; use azfinsim.split to plan windows for all trades")
         log.info("{:16}: --trade-window={}".format("AUTO_ARG", args.trade_window))
 
+
+def _prefill(args, dbase, start_trade: int, stop_trade: int) -> None:
+    """generates the trades of the window into the in-process cache, unless already there"""
+    if args.cache_type != "memory" or dbase.get_versions([start_trade])[0] is not None:
+        return
+    # the in-process cache starts out empty, unless populated by this process
+    log.info("CACHE %10s: GENERATE %d trades", "", stop_trade - start_trade)
+    if args.seed is not None:
+        np.random.seed(args.seed % (1 << 32))
+    trades_dbase = connect(args, mode="w")
+    # in batches of --batch-size, as `azfinsim.generator` does
+    for offset in range(start_trade, stop_trade, args.batch_size):
+        create_trade_range(offset, args.batch_size, stop_trade, trades_dbase)
+
+
+class _BatchProcessor:
+    """reads, prices and writes the trades of the window, a batch at a time (see `process`),
+    reusing the results in the result cache, if any"""
+
+    def __init__(self, args, dbase, results_dbase, tradenums, options: dict, result_cache, cost_model):
+        self._args = args
+        self._dbase = dbase
+        self._results_dbase = results_dbase
+        self._tradenums = tradenums
+        self._options = options
+        self._result_cache = result_cache
+        self._cost_model = cost_model
+        self._cost_profile = costmodel.profile(args)
+        self._use_result_cache = result_cache is not None and args.algorithm != "synthetic"
+        # the input versions of the results are only hashed for --delta runs, and for the
+        # result cache keys, which include them
+        self._track_versions = args.delta or self._use_result_cache
+        self._cache_options = dict(options, scenarios=args.scenarios)
+        if args.algorithm in ["analytic", "hybrid"]:
+            # the band decides which trades are priced in closed form
+            self._cache_options.update(analytic_band(args))
+        # results are identified by trade number, and scenario for the scenarios algorithm
+        self._result_key = ["tradenum", "scenario"] if args.algorithm == "scenarios" else "tradenum"
+        self._cached_timings = {column: [0.0] for column, _, _ in result_layout(args) if column in _timings}
+        # per-trade progress is only logged for every `log_sample`-th trade, plus a summary
+        # every `log_sample` trades
+        self._trace = log.isEnabledFor(logging.INFO)
+        self._done = 0
+        self._start_ts = time.perf_counter()
+
+    def _finished(self):
+        self._done += 1
+        if self._args.log_sample > 1 and self._done % self._args.log_sample == 0 and self._trace:
+            elapsed = time.perf_counter() - self._start_ts
+            log.info(
+                "TRADE %10s: PROGRESS %d of %d, %.1f trades/s",
+                "", self._done, len(self._tradenums), self._done / elapsed,
+            )
+
+    def process(self, offset: int, size: int, pool) -> float:
+        """reads, prices and writes the `size` trades from `offset` on; returns the total compute time"""
+        args = self._args
+        batch = self._tradenums[offset:offset + size]
+        read_chunk = args.read_chunk or size
+
+        # -- read trades from cache
+        log.debug("Retrieving Trades: %d-%d", batch[0], batch[-1])
+        trades = TradeBatch.concat(
+            [self._dbase.get_batch(batch[i:i + read_chunk]) for i in range(0, len(batch), read_chunk)]
+        )
+        units = costmodel.trade_units(trades, args.algorithm, args.scenarios, analytic_band(args), args.time_steps)
+        units = dict(zip(batch, units))
+        pending, versions, traced = self._prepare(offset, batch, trades)
+        rows = self._lookup(pending, traced)
+
+        computed = {}  # results to cache, by result cache key
+        compute_total = 0.0
+        for tradenum, row_s, compute_ts in compute_all(
+            args, trades, pending, self._options, pool, self._cost_model, units
+        ):
+            if tradenum in traced:
+                log.info("TRADE %10d: RESULT: %s", tradenum, row_s)
+                log.info("TRADE %10d: COMPUTE : %.12f", tradenum, compute_ts)
+            metrics.put("compute_time", compute_ts)
+            self._cost_model.observe(self._cost_profile, units[tradenum], compute_ts)
+            compute_total += compute_ts
+            key = pending[tradenum][1]
+            if key is not None:
+                computed[key] = {k: v for k, v in row_s.items() if k != "tradenum" and k not in _timings}
+            rows[tradenum] = row_s
+            self._finished()
+
+        # -- write results back to cache
+        results = ResultBatch()
+        for tradenum in batch:
+            results.append(rows[tradenum])
+        self._results_dbase.set_trades(results.to_frame(), column=self._result_key, versions=versions)
+        if self._result_cache is not None:
+            self._result_cache.set_many(computed)
+            self._result_cache.flush()
+        log.info("TRADE %10d: WRITE", batch[-1])
+        return compute_total
+
+    def _prepare(self, offset: int, batch, trades: TradeBatch) -> tuple:
+        """returns the trades to price, with their result cache keys, the input versions of
+        their results, if tracked, and the trades whose progress is logged"""
+        pending = {}
+        versions = {}
+        traced = set()
+        for index, (tradenum, trade) in enumerate(zip(batch, trades), offset):
+            if self._trace and index % self._args.log_sample == 0:
+                traced.add(tradenum)
+                log.info("TRADE %10d: BEGIN", tradenum)
+                log.debug("READ: %s", trade)
+                log.info("TRADE %10d: READ", tradenum)
+
+            # -- Inject Random Failure
+            if utils.InjectRandomFail(self._args.failure):
+                metrics.put("failed", 1)
+                metrics.record()
+                sys.exit(1)
+
+            version = None
+            if self._track_versions:
+                version = versions[tradenum] = trade_version(trade)
+            key = None
+            if self._use_result_cache:
+                key = resultcache.result_key(trade, self._args.algorithm, self._cache_options, self._args.seed, version)
+            pending[tradenum] = trade, key
+        return pending, versions, traced
+
+    def _lookup(self, pending: dict, traced: set) -> dict:
+        """looks the pending trades up in the result cache, in a single round trip; returns
+        the result rows found, by trade number, and removes their trades from `pending`"""
+        rows = {}
+        keys = {tradenum: key for tradenum, (_, key) in pending.items() if key is not None}
+        if not keys:
+            return rows
+        for tradenum, cached in zip(keys, self._result_cache.get_many(list(keys.values()))):
+            if cached is not None:
+                if tradenum in traced:
+                    log.info("TRADE %10d: CACHED", tradenum)
+                rows[tradenum] = {"tradenum": tradenum, **cached, **self._cached_timings}
+                del pending[tradenum]
+                self._finished()
+        return rows
+
+
+def execute(args):
+    # validate and sanitize args
+    check_args(args)
+
+    log.info("{0:16}: azfinsim starting".format("BEGIN"))
+
+    # setup metrics
+    metrics.define_measurements_and_views(_metrics_config)
+    metrics.put("failed", 0)
+
+    if args.algorithm == "synthetic" and args.delay_start > 0:
+        log.info("{0:16}: {1}s".format("DELAY_START", args.delay_start))
+        time.sleep(args.delay_start)
+
+    # -- open connection to dbase
+    dbase, results_dbase = _connect(args)
+    _resolve_window(args, dbase)
+
     start_trade = args.start_trade
     trade_window = args.trade_window
     stop_trade = start_trade + trade_window
@@ -124,69 +744,37 @@ def execute(args):
         log.critical("No trades to process")
         sys.exit(1)
 
-    results = pd.DataFrame()
-    out_batch_size = 10000  # number of trade results to write in a single batch
+    _prefill(args, dbase, start_trade, stop_trade)
+
+    tradenums = range(start_trade, stop_trade)
+    if args.delta:
+        tradenums = dbase.changed_trades(tradenums)
+        log.info("TRADE %10s: CHANGED=%d of %d", "", len(tradenums), trade_window)
+
+    options = mc_options(args)
+    result_cache = resultcache.connect(args)
+    cost_model = costmodel.load(args.cost_model)
+    # with --autotune, the pool is started by `tune`
+    pool = worker_pool(args, options) if args.workers > 1 and not args.autotune else None
 
     log.info("TRADE %10s: START=%d, COUNT=%d", "", start_trade, trade_window)
 
     # start time
     start_ts = time.perf_counter()
-    for tradenum in range(start_trade, stop_trade):
-        log.info("TRADE %10d: BEGIN" % args.start_trade)
-
-        # -- read trade from cache
-        log.debug("Retrieving Trade: %d", tradenum)
-        df = dbase.get_trade(tradenum)
-
-        log.debug("READ: %s", df.to_string())
-        log.info("TRADE %10d: READ", tradenum)
-
-        # -- Inject Random Failure
-        if utils.InjectRandomFail(args.failure):
-            metrics.put("failed", 1)
-            metrics.record()
-            sys.exit(1)
-
-        start_compute_ts = time.perf_counter()
-        row_s = {"tradenum": tradenum}
-        if args.algorithm == "synthetic":
-            # -- fake pricing computation - tunable duration - mainly for benchmarking schedulers
-            if args.task_duration > 0:
-                utils.DoFakeCompute(
-                    args.delay_start, args.task_duration, args.mem_usage
-                )
-            # generate fake results
-            row_s["random"] = [random_sample()]
-        elif args.algorithm == "pvonly":
-            log.debug("TRADE %10d: Start PV" % tradenum)
-            pv, pv_time = montecarlo.price_option(
-                df.iloc[0].to_dict()
-            )  # - single row in dataframe TODO: save all & tab print
-            row_s["pv"] = [pv]
-            row_s["pv_time"] = [pv_time]
-        elif args.algorithm == "deltavega":
-            # --- Perform timedelta vega risk calculation
-            log.debug("TRADE %10d: Start Delta Vega" % tradenum)
-            row_s["delta"] = [montecarlo.risk("fx1", df.iloc[0].to_dict())]
-            row_s["vega"] = [montecarlo.risk("sigma1", df.iloc[0].to_dict())]
-        else:
-            raise RuntimeError("Unknown algorithm: %s" % args.algorithm)
-        end_compute_ts = time.perf_counter()
-        compute_ts = end_compute_ts - start_compute_ts
-        log.info("TRADE %10d: RESULT: %s", tradenum, str(row_s))
-        log.info("TRADE %10d: COMPUTE : %.12f", tradenum, compute_ts)
-        metrics.put("compute_time", compute_ts)
-
-        # -- append row to results
-        log.debug("Appending Trade: %d", tradenum)
-        results = pd.concat([results, pd.DataFrame.from_dict(row_s)], ignore_index=True)
-
-        # -- write result back to cache
-        if (tradenum - start_trade) % out_batch_size == 0 or tradenum == stop_trade - 1:
-            results_dbase.set_trades(results)
-            log.info("TRADE %10d: WRITE", tradenum)
-            results = results.iloc[0:0]  # clear results
+    processor = _BatchProcessor(args, dbase, results_dbase, tradenums, options, result_cache, cost_model)
+    start = 0
+    if args.autotune:
+        # the trades processed while calibrating are done
+        start, pool = tune(args, dbase, tradenums, processor.process, options)
+    for offset in range(start, len(tradenums), args.batch_size):
+        processor.process(offset, args.batch_size, pool)
     log.info("TRADE %10d: DONE", args.start_trade)
+    if pool is not None:
+        pool.shutdown()
+    if result_cache is not None:
+        result_cache.close()
+    if args.cost_model is not None:
+        cost_model.save(args.cost_model)
 
     # -- log finish time
     end_ts = time.perf_counter()
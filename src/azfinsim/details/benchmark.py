@@ -0,0 +1,267 @@
+r"""
+benchmarks / accuracy checks for the pricing engine and the cache. Each benchmark logs its measurements
+and returns False if the results are outside the accepted tolerance.
+"""
+import io
+import logging
+import sys
+import time
+
+import numpy as np
+
+from . import compression, memstore, metrics, montecarlo, numba_kernel
+from .dbase import TradesCacheRedis, trade_version
+from .utils import GenerateTrade
+
+log = logging.getLogger(__name__)
+
+# config for metrics
+_metrics_config = {
+    "execution_time": {
+        "description": "process execution time",
+        "unit": "s",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+}
+
+
+def check_args(args):
+    if args.num_trades < 1:
+        raise ValueError("num_trades must be positive")
+    if args.trials < 2:
+        raise ValueError("trials must be at least 2")
+    if args.time_steps is not None and args.time_steps < 1:
+        raise ValueError("time_steps must be positive")
+    if args.tolerance is None:
+        args.tolerance = _tolerances[args.benchmark]
+        log.info("{:10}: --tolerance={}".format("AUTO_ARG", args.tolerance))
+
+
+def _trades(args) -> list:
+    np.random.seed(args.seed)
+    trades = GenerateTrade(0, args.num_trades).to_dict("records")
+    for trade in trades:
+        trade["trials"] = args.trials
+    return trades
+
+
+def _price(trade, seed, **kwargs):
+    np.random.seed(seed)
+    start = time.perf_counter()
+    result = montecarlo.price(trade, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def precision(args) -> bool:
+    """compares float32 against float64 simulation using the same random numbers"""
+    passed = True
+    times = {"float64": 0.0, "float32": 0.0}
+    for trade in _trades(args):
+        ref, ref_time = _price(trade, args.seed, precision="float64")
+        res, res_time = _price(trade, args.seed, precision="float32")
+        times["float64"] += ref_time
+        times["float32"] += res_time
+        error = abs(res["pv"] - ref["pv"]) / ref["pv_stderr"] if ref["pv_stderr"] > 0 else 0.0
+        log.info(
+            "TRADE %10d: float64=%.4f float32=%.4f stderr=%.4f error=%.6f",
+            trade["tradenum"], ref["pv"], res["pv"], ref["pv_stderr"], error,
+        )
+        if error > args.tolerance:
+            log.error("TRADE %10d: float32 error %.6f exceeds tolerance %.6f", trade["tradenum"], error, args.tolerance)
+            passed = False
+    log.info(
+        "{:10}: float64={:.4f}s float32={:.4f}s speedup={:.2f}x".format(
+            "TIME", times["float64"], times["float32"], times["float64"] / times["float32"]
+        )
+    )
+    return passed
+
+
+def kernels(args) -> bool:
+    """checks that the kernels agree statistically: the PV from each kernel must be within
+    `tolerance` combined standard errors of the PV from the reference kernel"""
+    names = ["numpy", "numba"]
+    if not numba_kernel.available:
+        log.warning("numba is not installed; skipping 'numba' kernel")
+        names.remove("numba")
+    else:
+        # exclude JIT compilation from the timings
+        _price(dict(_trades(args)[0], trials=2), args.seed, kernel="numba")
+
+    passed = True
+    times = dict.fromkeys(["reference"] + names, 0.0)
+    for index, trade in enumerate(_trades(args)):
+        seed = args.seed + 2 * index
+        ref, ref_time = _price(trade, seed, kernel="reference")
+        times["reference"] += ref_time
+        for kernel in names:
+            # use different random numbers than the reference run
+            res, res_time = _price(trade, seed + 1, kernel=kernel)
+            times[kernel] += res_time
+            error = abs(res["pv"] - ref["pv"]) / np.hypot(res["pv_stderr"], ref["pv_stderr"])
+            log.info(
+                "TRADE %10d: reference=%.4f %s=%.4f error=%.4f",
+                trade["tradenum"], ref["pv"], kernel, res["pv"], error,
+            )
+            if error > args.tolerance:
+                log.error("TRADE %10d: %s error %.4f exceeds tolerance %.4f", trade["tradenum"], kernel, error, args.tolerance)
+                passed = False
+    log.info("{:10}: {}".format("TIME", " ".join("{}={:.4f}s".format(k, t) for k, t in times.items())))
+    return passed
+
+
+def bridge(args) -> bool:
+    """checks coarse time-stepping with the Brownian bridge against the daily grid: the PV on the
+    coarse grid must be within `tolerance` combined standard errors of the PV on the daily grid.
+    Spots are moved to between 1 and 10 daily standard deviations above the barrier, where the
+    knock-out between grid points matters; the error of the coarse grid without the bridge (i.e.
+    only monitoring the grid points) is logged for comparison"""
+    passed = True
+    times = dict.fromkeys(["daily", "bridge"], 0.0)
+    trades = _trades(args)
+    for index, trade in enumerate(trades):
+        distance = 1 + 9 * index / max(len(trades) - 1, 1)
+        daily_stdev = trade["sigma1"] * np.sqrt(trade["maturity"] / trade["t_steps"])
+        trade["fx1"] = trade["strike"] * np.exp(distance * daily_stdev)
+        steps = args.time_steps or max(trade["t_steps"] // 10, 1)
+        seed = args.seed + 2 * index
+        ref, ref_time = _price(trade, seed)
+        res, res_time = _price(trade, seed + 1, time_steps=steps)
+        coarse, _ = _price(dict(trade, t_steps=steps), seed + 1)
+        times["daily"] += ref_time
+        times["bridge"] += res_time
+        error = abs(res["pv"] - ref["pv"]) / np.hypot(res["pv_stderr"], ref["pv_stderr"])
+        coarse_error = abs(coarse["pv"] - ref["pv"]) / np.hypot(coarse["pv_stderr"], ref["pv_stderr"])
+        log.info(
+            "TRADE %10d: steps=%d/%d daily=%.4f bridge=%.4f error=%.4f (without bridge %.4f)",
+            trade["tradenum"], steps, trade["t_steps"], ref["pv"], res["pv"], error, coarse_error,
+        )
+        if error > args.tolerance:
+            log.error("TRADE %10d: bridge error %.4f exceeds tolerance %.4f", trade["tradenum"], error, args.tolerance)
+            passed = False
+    log.info(
+        "{:10}: daily={:.4f}s bridge={:.4f}s speedup={:.2f}x".format(
+            "TIME", times["daily"], times["bridge"], times["daily"] / times["bridge"]
+        )
+    )
+    return passed
+
+
+def cache(args) -> bool:
+    """compares reading trades one request at a time with reading them in a batch, from the
+    memory cache with the simulated latency and bandwidth. Fails if the trades read differ,
+    or if reading in a batch isn't at least `tolerance` times faster"""
+    memstore.clear("benchmark")
+    client = memstore.MemoryClient(
+        "benchmark", latency=args.cache_latency / 1000.0, bandwidth=args.cache_bandwidth * 1e6
+    )
+    dbase = TradesCacheRedis(client, mode="rw")
+    np.random.seed(args.seed)
+    dbase.set_trades(GenerateTrade(0, args.num_trades))
+
+    start = time.perf_counter()
+    single = [dbase.get_trade(tradenum).iloc[0].to_dict() for tradenum in range(args.num_trades)]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = list(dbase.get_batch(range(args.num_trades)))
+    batch_time = time.perf_counter() - start
+
+    passed = True
+    if [trade_version(trade) for trade in single] != [trade_version(trade) for trade in batch]:
+        log.error("trades read in a batch differ from trades read one at a time")
+        passed = False
+    speedup = single_time / batch_time
+    log.info(
+        "{:10}: single={:.4f}s batch={:.4f}s speedup={:.2f}x".format("TIME", single_time, batch_time, speedup)
+    )
+    if speedup < args.tolerance:
+        log.error("batch speedup %.2fx is below tolerance %.2fx", speedup, args.tolerance)
+        passed = False
+    memstore.clear("benchmark")
+    return passed
+
+
+def compression_codecs(args) -> bool:
+    """compares the compression codecs on the trades, as written to redis (a pickle per trade)
+    and to files (CSV rows, a block per batch): logs the bytes, compression ratio and the
+    compression and decompression throughput of each codec. Fails if the data doesn't
+    round-trip, or if a codec's compression ratio is below `tolerance`"""
+    np.random.seed(args.seed)
+    trades = GenerateTrade(0, args.num_trades)
+    payloads = {"redis": [], "file": []}
+    for _, row in trades.iterrows():
+        buffer = io.BytesIO()
+        row.to_pickle(buffer)
+        payloads["redis"].append(buffer.getvalue())
+    for offset in range(0, len(trades), 10000):
+        payloads["file"].append(trades.iloc[offset:offset + 10000].to_csv(header=offset == 0, index=False).encode())
+
+    passed = True
+    for codec in compression.CODECS[1:]:
+        if not compression.available(codec):
+            log.warning("%s is not available; skipping", codec)
+            continue
+        for name, values in payloads.items():
+            size = sum(len(value) for value in values)
+            start = time.perf_counter()
+            compressed = [compression.compress(value, codec) for value in values]
+            compress_time = time.perf_counter() - start
+            start = time.perf_counter()
+            decompressed = [compression.decompress(value) for value in compressed]
+            decompress_time = time.perf_counter() - start
+            ratio = size / sum(len(value) for value in compressed)
+            log.info(
+                "{:10}: {:5} {:5} {:.3f}MB -> {:.3f}MB ratio={:.2f}x compress={:.1f}MB/s decompress={:.1f}MB/s".format(
+                    "CODEC", codec, name, size / 1e6, size / ratio / 1e6, ratio,
+                    size / 1e6 / compress_time, size / 1e6 / decompress_time,
+                )
+            )
+            if decompressed != values:
+                log.error("%s: %s data doesn't round-trip", codec, name)
+                passed = False
+            if ratio < args.tolerance:
+                log.error("%s: %s compression ratio %.2fx is below tolerance %.2fx", codec, name, ratio, args.tolerance)
+                passed = False
+    return passed
+
+
+_benchmarks = {
+    "precision": precision,
+    "kernels": kernels,
+    "bridge": bridge,
+    "cache": cache,
+    "compression": compression_codecs,
+}
+
+# default tolerance for each benchmark
+_tolerances = {
+    "precision": 0.01,
+    "kernels": 4.0,
+    "bridge": 4.0,
+    "cache": 1.0,
+    "compression": 1.0,
+}
+
+
+def execute(args):
+    # validate and sanitize args
+    check_args(args)
+
+    log.info("{:10}: benchmark '{}' starting".format("BEGIN", args.benchmark))
+
+    # setup metrics
+    metrics.define_measurements_and_views(_metrics_config)
+
+    start_ts = time.perf_counter()
+    passed = _benchmarks[args.benchmark](args)
+    end_ts = time.perf_counter()
+    metrics.put("execution_time", end_ts - start_ts)
+
+    # flush metrics
+    metrics.record()
+    if not passed:
+        log.critical("benchmark '%s' failed", args.benchmark)
+        sys.exit(1)
+    log.info("{:10}: benchmark '{}' passed".format("END", args.benchmark))
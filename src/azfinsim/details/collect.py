@@ -0,0 +1,67 @@
+import logging
+import sys
+import time
+
+from . import metrics
+from .dbase import TradesCacheFile, TradesCacheRedisStream, redis_client
+
+log = logging.getLogger(__name__)
+
+# config for metrics
+_metrics_config = {
+    "execution_time": {
+        "description": "process execution time",
+        "unit": "s",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+}
+
+
+def check_args(args):
+    if args.cache_type not in [None, "redis"]:
+        raise ValueError("results can only be collected from a redis cache")
+    args.cache_type = "redis"
+    if args.cache_name is None:
+        raise ValueError("cache_name must be specified")
+    if args.output_path is None:
+        raise ValueError("output_path must be specified")
+    if args.chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    if args.stream is None:
+        args.stream = "{}:results".format(args.algorithm)
+        log.info("{:10}: --stream={}".format("AUTO_ARG", args.stream))
+
+
+def execute(args):
+    # validate and sanitize args
+    check_args(args)
+
+    log.info("{:10}: collect start".format("BEGIN"))
+
+    # setup metrics
+    metrics.define_measurements_and_views(_metrics_config)
+
+    log.info("{:10}: reading {} from {}".format("IN_CACHE", args.stream, args.cache_name))
+    dbase = TradesCacheRedisStream(redis_client(args), mode="r", stream=args.stream)
+
+    start_ts = time.perf_counter()
+    results = dbase.get_trades(chunk_size=args.chunk_size)
+    log.info("{:10}: {} results".format("RESULTS", len(results)))
+    if results.empty:
+        log.critical("No results to collect")
+        sys.exit(1)
+
+    log.info("{:10}: creating {}".format("OUT_CACHE", args.output_path))
+    if args.output_path.endswith(".parquet"):
+        # requires pyarrow (or fastparquet)
+        results.to_parquet(args.output_path, index=False)
+    else:
+        TradesCacheFile(args.output_path, mode="w", compression=args.cache_compression).set_trades(results)
+    end_ts = time.perf_counter()
+    delta_ts = end_ts - start_ts
+    metrics.put("execution_time", delta_ts)
+
+    # record metrics
+    metrics.record()
+    log.info("{:10}: collect complete".format("END"))
@@ -0,0 +1,92 @@
+r"""
+optional compression of cache payloads: redis values (pickled trades and results) and blocks
+of CSV rows in files. Compressed payloads start with a header naming the codec and the size
+of the compressed data, so that readers decompress whatever they find, whichever codec (if
+any) the writer used; payloads without the header are returned as they are.
+
+"zlib" is always available; "lz4" and "zstd" require the `lz4` and `zstandard` packages
+(`pip install azfinsim[lz4]` / `azfinsim[zstd]`).
+"""
+import struct
+import zlib
+
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+CODECS = ["none", "zlib", "lz4", "zstd"]
+
+MAGIC = b"AZC"
+# magic, codec id, size of the compressed data that follows
+_HEADER = struct.Struct(">3sBQ")
+_IDS = {"zlib": 1, "lz4": 2, "zstd": 3}
+_NAMES = {codec_id: name for name, codec_id in _IDS.items()}
+_PACKAGES = {"lz4": "lz4", "zstd": "zstandard"}
+
+
+def available(codec: str) -> bool:
+    """returns whether the codec can be used"""
+    return {"lz4": _lz4 is not None, "zstd": _zstd is not None}.get(codec, codec in CODECS)
+
+
+def check(codec: str) -> None:
+    """raises ValueError if the codec can't be used"""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression: {codec}")
+    if not available(codec):
+        raise ValueError(f"{codec} compression requires the '{_PACKAGES[codec]}' package")
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    """returns the data compressed with `codec`, with a header; "none" returns the data as it is"""
+    if codec == "none":
+        return data
+    if codec == "zlib":
+        payload = zlib.compress(data)
+    elif codec == "lz4":
+        payload = _lz4.compress(data)
+    elif codec == "zstd":
+        payload = _zstd.ZstdCompressor().compress(data)
+    else:
+        raise ValueError(f"Unknown compression: {codec}")
+    return _HEADER.pack(MAGIC, _IDS[codec], len(payload)) + payload
+
+
+def _decode(codec: str, payload: bytes) -> bytes:
+    if not available(codec):
+        raise RuntimeError(f"{codec} compressed data requires the '{_PACKAGES[codec]}' package")
+    if codec == "zlib":
+        return zlib.decompress(payload)
+    elif codec == "lz4":
+        return _lz4.decompress(payload)
+    else:
+        return _zstd.ZstdDecompressor().decompress(payload)
+
+
+def blocks(data: bytes):
+    """yields the decompressed blocks of `data`, a sequence of compressed payloads (e.g. a file
+    written a batch at a time), or `data` itself if it isn't compressed"""
+    if not data.startswith(MAGIC):
+        yield data
+        return
+    offset = 0
+    while offset < len(data):
+        magic, codec_id, size = _HEADER.unpack_from(data, offset)
+        if magic != MAGIC or codec_id not in _NAMES:
+            raise RuntimeError(f"Invalid compressed data at offset {offset}")
+        offset += _HEADER.size
+        yield _decode(_NAMES[codec_id], data[offset:offset + size])
+        offset += size
+
+
+def decompress(data: bytes) -> bytes:
+    """returns the decompressed payload(s) of `data`, or `data` itself if it isn't compressed"""
+    if not data.startswith(MAGIC):
+        return data
+    return b"".join(blocks(data))
@@ -0,0 +1,136 @@
+r"""
+estimates the compute cost of pricing trades, used to balance work across shards and
+workers.
+
+The cost of a trade is modelled as `overhead + rate * units`, where `units` is the number
+of simulated path-steps (`trials * steps * pricings per trade`, with `steps` the trade's
+`t_steps`, or the coarser simulation grid, if any). The coefficients are
+fitted per profile (the algorithm and the options that change the cost of a path-step, see
+`profile`), by least squares, from the compute times measured by `azfinsim` and persisted
+to a json file so that they improve from run to run.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+from . import analytic, montecarlo, numba_kernel
+
+log = logging.getLogger(__name__)
+
+# pricings per trade: deltavega bumps two parameters up and down; hybrid prices, and bumps,
+# the trades outside the analytic validity band by Monte Carlo
+_pricings = {"pvonly": 1, "deltavega": 4, "hybrid": 5}
+
+# nominal cost of a path-step, used until the model is calibrated
+_default_rate = 3e-8
+
+
+def profile(args) -> str:
+    """returns the key the cost model is fitted under: the algorithm, along with the kernel,
+    precision and variance reduction options the trades are simulated with, if not the
+    defaults"""
+    if args.algorithm in ["synthetic", "analytic"]:
+        return args.algorithm
+    kernel = "numpy" if args.kernel == "numba" and not numba_kernel.available else args.kernel
+    options = [kernel if kernel != "numpy" else None, args.precision if args.precision != "float64" else None]
+    options.append("antithetic" if args.antithetic else None)
+    options.append("stderr={}".format(args.target_stderr) if args.target_stderr is not None else None)
+    return ":".join([args.algorithm] + [option for option in options if option is not None])
+
+
+def trade_units(
+    trades, algorithm: str, scenarios: dict = None, band: dict = None, time_steps: int = None
+) -> np.ndarray:
+    """returns the work units for each of the trades (a DataFrame or `TradeBatch`); `band` is
+    the analytic validity band (see `analytic.in_band`) for the hybrid algorithm, and
+    `time_steps` the simulation grid, if coarser than the trades' `t_steps`"""
+    if algorithm in ["synthetic", "analytic"] or not {"trials", "t_steps"}.issubset(trades.columns):
+        # synthetic tasks (and closed form pricing) take the same time, whatever the trade
+        return np.ones(len(trades))
+    if algorithm == "scenarios":
+        # the scenarios are simulated in a single batch, but the work scales with their count
+        pricings = len(montecarlo.scenario_grid(scenarios)) if scenarios else 1
+    else:
+        pricings = _pricings[algorithm]
+    steps = np.asarray(trades["t_steps"], dtype=np.float64)
+    if time_steps is not None:
+        steps = np.minimum(steps, time_steps)
+    units = np.asarray(trades["trials"], dtype=np.float64) * steps * pricings
+    if algorithm == "hybrid":
+        # trades priced in closed form cost the same as with the analytic algorithm
+        units = np.where(analytic.in_band(trades, **(band or {})), 1.0, units)
+    return units
+
+
+class CostModel:
+    """per-profile linear cost model; keeps the sufficient statistics of the fit
+    (count, sum of units, sum of seconds, sum of units^2, sum of units*seconds)"""
+
+    def __init__(self, stats: dict = None):
+        self._stats = {key: list(values) for key, values in (stats or {}).items()}
+        self._new = {}  # observations since load, merged into the file on save
+
+    def observe(self, key: str, units: float, seconds: float) -> None:
+        for stats in (self._stats, self._new):
+            values = stats.setdefault(key, [0.0] * 5)
+            for i, value in enumerate((1.0, units, seconds, units * units, units * seconds)):
+                values[i] += value
+
+    def coefficients(self, key: str) -> tuple:
+        """returns `(overhead, rate)` for the profile"""
+        if key not in self._stats:
+            return 0.0, _default_rate
+        n, sx, sy, sxx, sxy = self._stats[key]
+        variance = n * sxx - sx * sx
+        if variance > 1e-9 * n * sxx:
+            rate = (n * sxy - sx * sy) / variance
+            overhead = (sy - rate * sx) / n
+            if rate > 0 and overhead >= 0:
+                return overhead, rate
+        # all trades had (nearly) the same units, or the fit is unphysical: proportional model
+        return 0.0, sy / sx if sx > 0 else _default_rate
+
+    def estimate(self, key: str, units: np.ndarray) -> np.ndarray:
+        """returns the estimated compute time (in seconds) for the given units"""
+        overhead, rate = self.coefficients(key)
+        return overhead + rate * np.asarray(units, dtype=np.float64)
+
+    def save(self, fname: str) -> None:
+        """adds the observations made since loading to the model file"""
+        stats = load(fname)._stats
+        for key, values in self._new.items():
+            stats[key] = [a + b for a, b in zip(stats.get(key, [0.0] * 5), values)]
+        tmpname = "{}.{}.tmp".format(fname, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(stats, f, indent=2)
+        os.replace(tmpname, fname)
+        self._stats, self._new = stats, {}
+
+
+def load(fname: str = None) -> CostModel:
+    """loads the model from a file; returns an uncalibrated model if there is no file"""
+    if fname is None or not os.path.exists(fname):
+        return CostModel()
+    with open(fname) as f:
+        return CostModel(json.load(f))
+
+
+def partition(costs: np.ndarray, parts: int) -> list:
+    """splits the sequence of costs into `parts` contiguous, non-empty ranges of about
+    equal total cost; returns the list of `(begin, end)` indices"""
+    count = len(costs)
+    parts = max(1, min(parts, count))
+    cumulative = np.cumsum(costs)
+    targets = cumulative[-1] * np.arange(1, parts) / parts
+    bounds = [0]
+    for k, (target, end) in enumerate(zip(targets, np.searchsorted(cumulative, targets)), start=1):
+        # cut before or after the trade that crosses the target, whichever is closer
+        before = cumulative[end - 1] if end > 0 else 0.0
+        if end < count and cumulative[end] - target <= target - before:
+            end += 1
+        # keep every range non-empty
+        bounds.append(int(min(max(end, bounds[-1] + 1), count - (parts - k))))
+    bounds.append(count)
+    return list(zip(bounds[:-1], bounds[1:]))
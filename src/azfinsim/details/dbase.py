@@ -1,13 +1,21 @@
 r"""
 encapsulates the cache / io operations
 """
+import numpy as np
 import pandas as pd
 import redis
+from redis.cluster import RedisCluster
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import logging
 import time
+import hashlib
+import json
 import io
-from . import metrics
+from . import memstore, metrics
+from .compression import check as check_compression, compress, decompress
+from .trades import TradeBatch
+from .utils import GenerateTradesSeeded
 
 log = logging.getLogger(__name__)
 
@@ -24,13 +32,38 @@ _metrics_config = {
         "type": "float",
         "aggregation": "sum",
     },
+    "io_read_bytes": {
+        "description": "Bytes read from the cache (compressed, if compression is used)",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "sum",
+    },
+    "io_write_bytes": {
+        "description": "Bytes written to the cache (compressed, if compression is used)",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "sum",
+    },
 }
 
 _metrics = None
+_keys_per_request = 10000  # keys looked up per round trip
+
+
+def _columns(column) -> list:
+    return [column] if isinstance(column, str) else list(column)
+
+
+def trade_version(trade: dict) -> str:
+    """returns a content hash of the trade's inputs (all columns but the trade number)"""
+    # normalize numpy scalars so that the hash doesn't depend on where the trade was read from
+    inputs = {k: v.item() if hasattr(v, "item") else v for k, v in trade.items() if k != "tradenum"}
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
 
 
 class TradesCache:
-    def __init__(self, mode: str):
+    def __init__(self, mode: str, compression: str = "none"):
         global _metrics
         if _metrics is None:
             metrics.define_measurements_and_views(_metrics_config)
@@ -39,94 +72,372 @@ class TradesCache:
         if mode not in ["r", "w", "rw"]:
             raise RuntimeError(f"Invalid mode: {mode}")
         self._mode = mode
+        # codec for writing; readers detect the codec used from the data (see `compression`)
+        check_compression(compression)
+        self._compression = compression
 
     def get_trade(self, tradenum: int, column: str = "tradenum") -> pd.DataFrame:
         """returns a dataframe with the trade"""
         assert self._mode == "r"
         raise RuntimeError("Not implemented")
 
-    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum") -> None:
+    def get_batch(self, tradenums: list) -> TradeBatch:
+        """returns the trades, in the given order, as a batch"""
+        raise RuntimeError("Not implemented")
+
+    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum", versions: dict = None) -> None:
+        """stores the trades; `column` names the column (or list of columns) identifying each row.
+        `versions` maps trade numbers to the version of the inputs the rows were derived from,
+        for caches that track versions"""
         assert self._mode == "w"
         assert isinstance(trades, pd.DataFrame)
-        assert column in trades.columns
+        assert set(_columns(column)).issubset(trades.columns)
         raise RuntimeError("Not implemented")
 
     def get_trade_count(self) -> int:
         raise RuntimeError("Not implemented")
 
+    def get_first_trade(self) -> pd.Series:
+        raise RuntimeError("Not implemented")
+
+    def get_trade_ranges(self) -> list:
+        """returns the ranges of trade numbers in the cache, as sorted `(start, stop)` pairs"""
+        raise RuntimeError("Not implemented")
+
+
+def _trade_runs(tradenums) -> list:
+    """returns the runs of consecutive trade numbers, as `(start, stop)` pairs"""
+    tradenums = np.unique(np.asarray(tradenums, dtype=np.int64))
+    if len(tradenums) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(tradenums) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(tradenums, breaks)]
+
 
 class TradesCacheRedis(TradesCache):
-    """Redis implementation of TradesCache"""
+    """Redis implementation of TradesCache.
 
-    def __init__(self, redis_client: redis.Redis, mode: str, read_key='trade:{}', write_key='trade:{}', **kwargs):
-        super().__init__(mode)
+    Along with each row, `set_trades` records a version per trade number in a hash
+    (`write_versions`): a content hash of the trade for trades, or the version of the inputs
+    they were computed from for results (see `changed_trades`).
+
+    Values are compressed with `compression`, if specified, one row at a time, so that rows
+    can still be read and versioned individually (at the cost of a lower compression ratio
+    than for batches of rows).
+
+    It also records the ranges of trade numbers written in a manifest (`write_manifest`), a
+    sorted set of `<first>-<last>` members scored by the first trade number, so that the
+    trades in the cache can be counted and planned without scanning the keys.
+
+    With `hash_chunk`, keys carry a hash tag with the trade number divided by `hash_chunk`,
+    e.g. `trade:{12}:12345`, so that chunks of consecutive trades map to the same slot of a
+    Redis Cluster. On a cluster (a `RedisCluster` client), reads and writes are grouped by
+    slot, and each node is sent a single pipeline, with the nodes accessed in parallel."""
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        mode: str,
+        read_key='trade:{}',
+        write_key='trade:{}',
+        read_versions='trade:versions',
+        write_versions='trade:versions',
+        read_manifest='trade:manifest',
+        write_manifest='trade:manifest',
+        hash_chunk=0,
+        compression="none",
+        **kwargs,
+    ):
+        super().__init__(mode, compression)
         self._redis_client = redis_client
         self._read_key = read_key
         self._write_key = write_key
+        self._read_versions = read_versions
+        self._write_versions = write_versions
+        self._read_manifest = read_manifest
+        self._write_manifest = write_manifest
+        self._hash_chunk = hash_chunk
+        self._cluster = isinstance(redis_client, RedisCluster)
 
         # validate connection to redis server
         self._redis_client.ping()
 
+    def _key(self, pattern: str, *values) -> str:
+        """returns the key for the row identified by `values`, the trade number first"""
+        key = pattern.format(*values)
+        if not self._hash_chunk:
+            return key
+        prefix, _, rest = key.partition(":")
+        return "%s:{%d}:%s" % (prefix, int(values[0]) // self._hash_chunk, rest)
+
+    def _by_node(self, keys: list) -> list:
+        """groups the keys by cluster node, and slot; returns `(node client, [[index, ...], ...])`
+        pairs, with the indices of the keys in each slot"""
+        nodes = {}
+        slots = {}  # hash tag -> slot
+        for index, key in enumerate(keys):
+            # all keys with the same hash tag are in the same slot
+            tag = key[key.index("{"):key.index("}") + 1] if self._hash_chunk else key
+            slot = slots.get(tag)
+            if slot is None:
+                slot = slots[tag] = self._redis_client.keyslot(tag)
+            node = self._redis_client.nodes_manager.get_node_from_slot(slot)
+            nodes.setdefault(node.name, (node, {}))[1].setdefault(slot, []).append(index)
+        return [
+            (self._redis_client.get_redis_connection(node), list(groups.values()))
+            for node, groups in nodes.values()
+        ]
+
+    def _on_nodes(self, function, groups: list) -> None:
+        """calls `function(client, slots)` for each node of `_by_node`, in parallel"""
+        if len(groups) == 1:
+            function(*groups[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            for future in [pool.submit(function, *group) for group in groups]:
+                future.result()  # re-raises errors
+
+    def _mget(self, keys: list) -> list:
+        """returns the values of the keys, reading `_keys_per_request` keys per request"""
+        if not self._cluster:
+            data = []
+            for i in range(0, len(keys), _keys_per_request):
+                data += self._redis_client.mget(keys[i:i + _keys_per_request])
+            return data
+
+        data = [None] * len(keys)
+
+        def read(client, slots):
+            pipeline = client.pipeline(transaction=False)
+            requests = []
+            for indices in slots:
+                for i in range(0, len(indices), _keys_per_request):
+                    requests.append(indices[i:i + _keys_per_request])
+                    pipeline.mget([keys[index] for index in requests[-1]])
+            for indices, values in zip(requests, pipeline.execute()):
+                for index, value in zip(indices, values):
+                    data[index] = value
+
+        self._on_nodes(read, self._by_node(keys))
+        return data
+
+    def _mset(self, items: list) -> None:
+        """writes the `(key, value)` pairs, one pipeline per cluster node"""
+
+        def write(client, slots):
+            pipeline = client.pipeline(transaction=False)
+            for indices in slots:
+                for index in indices:
+                    pipeline.set(*items[index])
+            pipeline.execute(raise_on_error=True)
+
+        self._on_nodes(write, self._by_node([key for key, _ in items]))
+
     def get_trade(self, tradenum: int, column: str = "tradenum") -> pd.DataFrame:
         """returns a dataframe with the trade"""
         assert self._mode == "r" or self._mode == "rw"
         assert isinstance(tradenum, int)
         assert isinstance(column, str)
         start = time.perf_counter()
-        data = self._redis_client.get(self._read_key.format(tradenum))
+        data = self._redis_client.get(self._key(self._read_key, tradenum))
         end = time.perf_counter()
         delta_ts = end - start
         metrics.put("io_read_time", delta_ts)
         if data is None:
             raise RuntimeError(f"No trade found for {tradenum}")
+        metrics.put("io_read_bytes", len(data))
         # log.info('{}, data: {}'.format(tradenum, data))
-        buffer = io.BytesIO(data)
+        buffer = io.BytesIO(decompress(data))
         return pd.read_pickle(buffer).to_frame().T
 
+    def get_batch(self, tradenums: list) -> TradeBatch:
+        assert self._mode == "r" or self._mode == "rw"
+        tradenums = list(tradenums)
+        start = time.perf_counter()
+        data = self._mget([self._key(self._read_key, tradenum) for tradenum in tradenums])
+        end = time.perf_counter()
+        metrics.put("io_read_time", end - start)
+        records = []
+        nbytes = 0
+        for tradenum, value in zip(tradenums, data):
+            if value is None:
+                raise RuntimeError(f"No trade found for {tradenum}")
+            nbytes += len(value)
+            records.append(pd.read_pickle(io.BytesIO(decompress(value))))
+        metrics.put("io_read_bytes", nbytes)
+        return TradeBatch.from_records(records)
+
+    def get_trade_ranges(self) -> list:
+        """returns the ranges of trades in the cache, as recorded in the manifest"""
+        start = time.perf_counter()
+        members = self._redis_client.zrange(self._read_manifest, 0, -1)
+        metrics.put("io_read_time", time.perf_counter() - start)
+        ranges = []
+        for first, last in sorted(tuple(int(x) for x in member.decode().split("-")) for member in members):
+            stop = last + 1
+            if ranges and first <= ranges[-1][1]:
+                # overlapping or adjacent: trades written more than once, or by consecutive batches
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], stop))
+            else:
+                ranges.append((first, stop))
+        return ranges
+
     def get_trade_count(self) -> int:
-        log.warning("get_trade_count not implemented for redis")
-        return 0
+        return sum(stop - start for start, stop in self.get_trade_ranges())
+
+    def get_first_trade(self) -> pd.Series:
+        members = self._redis_client.zrange(self._read_manifest, 0, 0)
+        if not members:
+            raise RuntimeError("No trades found in {}".format(self._read_manifest))
+        first = int(members[0].decode().split("-")[0])
+        return self.get_trade(first).iloc[0]
 
-    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum") -> None:
+    def get_versions(self, tradenums: list, key: str = None) -> list:
+        """returns the recorded versions of the trades (None if unknown); reads the input
+        versions, unless `key` names another versions hash"""
+        key = self._read_versions if key is None else key
+        versions = []
+        for i in range(0, len(tradenums), _keys_per_request):
+            versions += self._redis_client.hmget(key, tradenums[i:i + _keys_per_request])
+        return [v.decode() if v is not None else None for v in versions]
+
+    def changed_trades(self, tradenums: list) -> list:
+        """returns the trades whose inputs have changed (or whose version is unknown) since
+        their results were written"""
+        assert self._mode == "rw"
+        tradenums = list(tradenums)
+        inputs = self.get_versions(tradenums)
+        outputs = self.get_versions(tradenums, key=self._write_versions)
+        return [
+            tradenum
+            for tradenum, version, result_version in zip(tradenums, inputs, outputs)
+            if version is None or version != result_version
+        ]
+
+    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum", versions: dict = None) -> None:
         assert self._mode == "w" or self._mode == "rw"
         assert isinstance(trades, pd.DataFrame)
-        assert column in trades.columns
+        columns = _columns(column)
+        assert set(columns).issubset(trades.columns)
 
         # convert individual trades to json and store in redis
         start = time.perf_counter()
         pipeline = self._redis_client.pipeline()
-        for _, row in trades.iterrows():
-            tradenum = row[column]
-            # log.info('{}, row: {}'.format(tradenum, row.to_json()))
+        compute_versions = versions is None and "tradenum" in trades.columns
+        if compute_versions:
+            versions = {}
+        items = []
+        # take the key values from the columns, since `iterrows` may upcast them to float
+        for key_values, (_, row) in zip(trades[columns].itertuples(index=False), trades.iterrows()):
+            key = self._key(self._write_key, *key_values)
+            # log.info('{}, row: {}'.format(key, row.to_json()))
             buffer = io.BytesIO()
             row.to_pickle(buffer)
-            pipeline.set(self._write_key.format(tradenum), buffer.getvalue())
+            items.append((key, compress(buffer.getvalue(), self._compression)))
+            if compute_versions:
+                versions[int(row["tradenum"])] = trade_version(row.to_dict())
+        if self._cluster:
+            self._mset(items)
+        else:
+            for key, value in items:
+                pipeline.set(key, value)
+        if versions:
+            pipeline.hset(self._write_versions, mapping=versions)
+        if "tradenum" in trades.columns and self._write_manifest is not None:
+            runs = _trade_runs(trades["tradenum"])
+            if runs:
+                pipeline.zadd(self._write_manifest, {f"{first}-{stop - 1}": first for first, stop in runs})
+        pipeline.execute(raise_on_error=True)
+        end = time.perf_counter()
+        delta_ts = end - start
+        metrics.put("io_write_time", delta_ts)
+        metrics.put("io_write_bytes", sum(len(value) for _, value in items))
+
+
+class TradesCacheRedisStream(TradesCacheRedis):
+    """Redis implementation of TradesCache that appends the rows passed to each
+    `set_trades` call to a stream, as a single entry, rather than writing a key per row.
+    Meant for results, which are read back in bulk using `get_trades`."""
+
+    def __init__(self, redis_client: redis.Redis, mode: str, stream='results', **kwargs):
+        super().__init__(redis_client, mode, **kwargs)
+        self._stream = stream
+
+    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum", versions: dict = None) -> None:
+        assert self._mode == "w" or self._mode == "rw"
+        assert isinstance(trades, pd.DataFrame)
+        columns = _columns(column)
+        assert set(columns).issubset(trades.columns)
+
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        trades.to_pickle(buffer)
+        data = compress(buffer.getvalue(), self._compression)
+        pipeline = self._redis_client.pipeline()
+        pipeline.xadd(self._stream, {"rows": len(trades), "key": json.dumps(columns), "data": data})
+        if versions:
+            pipeline.hset(self._write_versions, mapping=versions)
         pipeline.execute(raise_on_error=True)
         end = time.perf_counter()
         delta_ts = end - start
         metrics.put("io_write_time", delta_ts)
+        metrics.put("io_write_bytes", len(data))
+
+    def get_trades(self, chunk_size: int = 100) -> pd.DataFrame:
+        """returns all rows in the stream, reading `chunk_size` entries per round trip.
+        Rows written more than once (e.g. by a retried task) are returned once, as last written"""
+        start = time.perf_counter()
+        frames = []
+        columns = None
+        nbytes = 0
+        first = "-"
+        while True:
+            entries = self._redis_client.xrange(self._stream, min=first, count=chunk_size)
+            for _, fields in entries:
+                nbytes += len(fields[b"data"])
+                frames.append(pd.read_pickle(io.BytesIO(decompress(fields[b"data"]))))
+                columns = json.loads(fields[b"key"])
+            if len(entries) < chunk_size:
+                break
+            # continue after the last entry read
+            last_ms, last_seq = entries[-1][0].decode().split("-")
+            first = "{}-{}".format(last_ms, int(last_seq) + 1)
+        end = time.perf_counter()
+        metrics.put("io_read_time", end - start)
+        metrics.put("io_read_bytes", nbytes)
+        if not frames:
+            return pd.DataFrame()
+        trades = pd.concat(frames, ignore_index=True)
+        return trades.drop_duplicates(subset=columns, keep="last").sort_values(columns, ignore_index=True)
 
 
 class TradesCacheFile(TradesCache):
-    """Filesystem implementation of TradesCache"""
+    """Filesystem implementation of TradesCache.
 
-    def __init__(self, fname: str, mode: str, **kwargs):
-        super().__init__(mode)
+    With `compression`, the rows passed to each `set_trades` call are written to the file as
+    a compressed block of CSV text; files are read whether they are compressed or not."""
+
+    def __init__(self, fname: str, mode: str, compression: str = "none", **kwargs):
+        super().__init__(mode, compression)
         assert mode in ["r", "w"]  # we don't support "rw" for files yet
         self._fname = fname
         self._lock = threading.Lock()
         self._add_header = True
         self._trades = None
+        self._batch = None  # all trades, as a batch
 
     def _read(self):
         assert self._mode == "r"
         with self._lock:
             if self._trades is None:
                 start = time.perf_counter()
-                self._trades = pd.read_csv(self._fname, index_col=False)
+                with open(self._fname, "rb") as f:
+                    data = f.read()
+                self._trades = pd.read_csv(io.BytesIO(decompress(data)), index_col=False)
                 end = time.perf_counter()
                 delta_ts = end - start
                 metrics.put("io_read_time", delta_ts)
+                metrics.put("io_read_bytes", len(data))
 
     def get_trade(self, tradenum: int, column: str = "tradenum") -> pd.DataFrame:
         """returns a dataframe with the trade"""
@@ -141,6 +452,18 @@ class TradesCacheFile(TradesCache):
         self._read()
         return self._trades
 
+    def get_batch(self, tradenums: list) -> TradeBatch:
+        assert self._mode == "r"
+        self._read()
+        with self._lock:
+            if self._batch is None:
+                self._batch = TradeBatch.from_frame(self._trades)
+                self._positions = pd.Index(self._batch["tradenum"])
+        positions = self._positions.get_indexer(list(tradenums))
+        if (positions < 0).any():
+            raise RuntimeError(f"No trade found for {list(tradenums)[int(np.argmin(positions))]}")
+        return self._batch.take(positions)
+
     def get_trade_count(self) -> int:
         assert self._mode == "r"
         self._read()
@@ -151,50 +474,106 @@ class TradesCacheFile(TradesCache):
         self._read()
         return self._trades.iloc[0]
 
-    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum") -> None:
+    def get_trade_ranges(self) -> list:
+        assert self._mode == "r"
+        self._read()
+        return _trade_runs(self._trades["tradenum"])
+
+    def set_trades(self, trades: pd.DataFrame, column: str = "tradenum", versions: dict = None) -> None:
         assert self._mode == "w"
         assert isinstance(trades, pd.DataFrame)
-        assert column in trades.columns
+        assert set(_columns(column)).issubset(trades.columns)
 
         with self._lock:
             # append trades to file
             start = time.perf_counter()
-            trades.to_csv(
-                self._fname,
-                mode="w" if self._add_header else "a",
-                header=self._add_header,
-                index=False,
-            )
+            data = trades.to_csv(header=self._add_header, index=False).encode()
+            data = compress(data, self._compression)
+            with open(self._fname, "wb" if self._add_header else "ab") as f:
+                f.write(data)
             end = time.perf_counter()
             delta_ts = end - start
             metrics.put("io_write_time", delta_ts)
+            metrics.put("io_write_bytes", len(data))
             self._add_header = False
 
 
-def connect(args, mode: str, **kwargs) -> TradesCache:
-    """connect to the cache"""
-    if args.cache_type == "redis":
+class TradesCacheGenerated(TradesCache):
+    """Read-only TradesCache that generates trades on the fly, as a function of `seed` and
+    the trade number (see `utils.GenerateTradesSeeded`), instead of reading them"""
+
+    def __init__(self, seed: int, mode: str = "r"):
+        super().__init__(mode)
+        assert mode == "r"  # generated trades can't be written
+        self._seed = seed
+
+    def get_trade(self, tradenum: int, column: str = "tradenum") -> pd.DataFrame:
+        """returns a dataframe with the trade"""
+        assert column == "tradenum"
+        return GenerateTradesSeeded(self._seed, tradenum, 1)
+
+    def get_batch(self, tradenums: list) -> TradeBatch:
+        tradenums = np.asarray(tradenums, dtype=np.int64)
+        if len(tradenums) == 0:
+            return TradeBatch.from_frame(GenerateTradesSeeded(self._seed, 0, 0))
+        # generate each run of consecutive trades in one go
+        breaks = np.flatnonzero(np.diff(tradenums) != 1) + 1
+        frames = [
+            GenerateTradesSeeded(self._seed, int(run[0]), len(run))
+            for run in np.split(tradenums, breaks)
+        ]
+        return TradeBatch.from_frame(frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True))
+
+
+def redis_client(args) -> redis.Redis:
+    """returns a client for the redis cache specified by the command line arguments"""
+    if args.cache_type == "memory":
+        return memstore.MemoryClient(
+            args.cache_name,
+            latency=args.cache_latency / 1000.0,
+            bandwidth=args.cache_bandwidth * 1e6,
+        )
+    if args.cache_cluster:
+        # the other nodes are discovered from the one specified
         if args.cache_ssl == "yes":
-            return TradesCacheRedis(
-                redis.Redis(
-                    host=args.cache_name,
-                    port=args.cache_port,
-                    password=args.cache_key,
-                    ssl_cert_reqs="none",  # -- or specify location of certs
-                    ssl=True,
-                ),
-                mode,
-                **kwargs
-            )
-        else:
-            return TradesCacheRedis(
-                redis.Redis(
-                    host=args.cache_name, port=args.cache_port, password=args.cache_key
-                ),
-                mode,
-                **kwargs
+            return RedisCluster(
+                host=args.cache_name,
+                port=args.cache_port,
+                password=args.cache_key,
+                ssl_cert_reqs="none",  # -- or specify location of certs
+                ssl=True,
             )
+        return RedisCluster(host=args.cache_name, port=args.cache_port, password=args.cache_key)
+    if args.cache_ssl == "yes":
+        return redis.Redis(
+            host=args.cache_name,
+            port=args.cache_port,
+            password=args.cache_key,
+            ssl_cert_reqs="none",  # -- or specify location of certs
+            ssl=True,
+        )
+    else:
+        return redis.Redis(
+            host=args.cache_name, port=args.cache_port, password=args.cache_key
+        )
+
+
+def hash_chunk(args) -> int:
+    """returns the number of consecutive trades whose keys share a hash tag (0 for none)"""
+    if args.cache_hash_chunk is not None:
+        return args.cache_hash_chunk
+    return 1000 if args.cache_cluster else 0
+
+
+def connect(args, mode: str, **kwargs) -> TradesCache:
+    """connect to the cache"""
+    if args.cache_type in ["redis", "memory"]:
+        return TradesCacheRedis(
+            redis_client(args), mode, hash_chunk=hash_chunk(args), compression=args.cache_compression, **kwargs
+        )
     elif args.cache_type == "filesystem":
-        return TradesCacheFile(args.cache_path, mode)
+        return TradesCacheFile(args.cache_path, mode, compression=args.cache_compression)
+    elif args.cache_type == "generated":
+        return TradesCacheGenerated(args.seed or 0, mode)
     else:
         raise RuntimeError(f"Invalid cache type: {args.cache_type}")
@@ -51,9 +51,16 @@ def check_args(args):
         log.info("{:10}: --cache-type=redis".format("AUTO_ARG"))
         args.cache_type = "redis"
 
+    if args.cache_type == "memory" and args.cache_name is None:
+        log.info("{:10}: --cache-name=default".format("AUTO_ARG"))
+        args.cache_name = "default"
     if args.cache_type == "redis":
         if args.cache_name is None:
             raise ValueError("cache_name must be specified for redis cache")
+    if args.cache_hash_chunk is not None and args.cache_hash_chunk < 0:
+        raise ValueError("cache_hash_chunk must not be negative")
+    if args.cache_cluster and args.cache_type != "redis":
+        raise ValueError("cache_cluster requires redis cache")
     if args.cache_type == "filesystem":
         if args.cache_path is None:
             raise ValueError("cache_path must be specified for filesystem cache")
@@ -64,6 +71,8 @@ def check_args(args):
     if args.trade_window is None:
         args.trade_window = 100000  # 100,000 trades by default
         log.info("{:10}: --trade-window=100,000".format("AUTO_ARG"))
+    if args.batch_size < 1:
+        raise ValueError("batch_size must be positive")
 
 
 def execute(args):
@@ -91,7 +100,7 @@ def execute(args):
     log.info("{:10}: connected".format("CACHE"))
 
     start_trade = args.start_trade
-    batch_size = min(10000, args.trade_window)
+    batch_size = min(args.batch_size, args.trade_window)
     stop_trade = start_trade + args.trade_window
 
     log.info(
@@ -7,6 +7,8 @@ import argparse
 import json
 import logging
 
+from . import analytic, compression
+
 log = logging.getLogger(__name__)
 
 class ArgumentsAction(argparse.Action):
@@ -17,6 +19,9 @@ class ArgumentsAction(argparse.Action):
             secrets = json.load(f)
             for key, value in secrets.items():
                 key = key.lower()
+                if not isinstance(value, str):
+                    # e.g. nested objects such as the scenario ladder
+                    value = json.dumps(value)
                 if key.startswith(prefix):
                     parser.parse_known_args(
                         ["--" + key[prefix_length:], value], namespace=namespace
@@ -37,7 +42,7 @@ class ParseTagsAction(argparse.Action):
 
 
 def getargs(progname):
-    if progname not in ["azfinsim", "generator", "split", "concat"]:
+    if progname not in ["azfinsim", "generator", "split", "concat", "benchmark", "collect", "pipeline"]:
         raise ValueError(f"Invalid program name: {progname}")
 
     parser = argparse.ArgumentParser(progname)
@@ -54,6 +59,13 @@ def getargs(progname):
         action="store_true",
         help="generate verbose output",
     )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        default=None,
+        choices=["debug", "info", "warning", "error"],
+        help="logging level; overrides --verbose (default: info)",
+    )
     parser.add_argument(
         "--no-color",
         action="store_true",
@@ -61,12 +73,16 @@ def getargs(progname):
     )
 
     # -- Cache parameters
-    if progname in ["azfinsim", "generator"]:
+    if progname in ["azfinsim", "generator", "collect", "split"]:
         cacheParser = parser.add_argument_group("Cache", "Cache-specific options")
         cacheParser.add_argument(
             "--cache-type",
-            choices=["redis", "filesystem"],
-            help="cache type (default: auto-detected)",
+            choices=["redis", "filesystem"]
+            + (["memory"] if progname != "split" else [])
+            + (["generated"] if progname == "azfinsim" else []),
+            help="cache type; 'memory' is an in-process stand-in for redis; 'generated' generates trades "
+            "on the fly from --seed and the trade number, with results written to --output-path "
+            "(default: auto-detected)",
         )
 
         redisParser = parser.add_argument_group(
@@ -86,27 +102,76 @@ def getargs(progname):
             choices=["yes", "no"],
             help="use SSL for redis cache access (default: yes)",
         )
+        redisParser.add_argument(
+            "--cache-cluster",
+            action="store_true",
+            help="the redis cache is a Redis Cluster; --cache-name is any of its nodes",
+        )
+        redisParser.add_argument(
+            "--cache-hash-chunk",
+            type=int,
+            default=None,
+            help="number of consecutive trades whose keys share a hash tag, e.g. 'trade:{12}:12345', so that "
+            "they are stored in the same cluster slot and read and written together; 0 for plain keys "
+            "(default: 1000 with --cache-cluster, otherwise 0)",
+        )
+        if progname == "azfinsim":
+            redisParser.add_argument(
+                "--result-sink",
+                default="keys",
+                choices=["keys", "stream"],
+                help="keys: write a key per result; stream: append each batch of results to the "
+                "'<algorithm>:results' stream, read back using azfinsim.collect (default: keys)",
+            )
+
+    if progname in ["azfinsim", "generator", "benchmark"]:
+        memoryParser = parser.add_argument_group(
+            "Memory Cache", "Memory Cache-specific options (when --cache-type=memory)"
+        )
+        memoryParser.add_argument(
+            "--cache-latency",
+            type=float,
+            default=0.0,
+            help="simulated latency per round trip, in milliseconds (default: 0)",
+        )
+        memoryParser.add_argument(
+            "--cache-bandwidth",
+            type=float,
+            default=0.0,
+            help="simulated bandwidth, in MB/s; 0 for unlimited (default: 0)",
+        )
 
     fsParser = parser.add_argument_group(
         "Filesystem Cache",
         "Filesystem Cache-specific options (when --cache-type=filesystem)",
     )
     fsParser.add_argument("--cache-path", help="filesystem path for cache")
-    if progname in ["azfinsim", "split"]:
+    if progname in ["azfinsim", "split", "pipeline"]:
         fsParser.add_argument(
             "--output-path",
             default=None,
             help="filesystem directory for results."
         )
-    if progname == "concat":
+    if progname in ["concat", "collect"]:
         fsParser.add_argument(
             "--output-path", help="merged file name.", type=str
         )
 
+    if progname in ["azfinsim", "generator", "split", "concat", "collect", "pipeline"]:
+        compressionParser = parser.add_argument_group("Compression", "Compression of cache values and files")
+        compressionParser.add_argument(
+            "--cache-compression",
+            default="none",
+            choices=compression.CODECS,
+            help="compress the trades / results written to redis (per value) and files (per batch of rows); "
+            "readers detect the compression used, so this only applies to writing; lz4 and zstd require the "
+            "'lz4' and 'zstandard' packages (default: none)",
+        )
+
     # -- algorithm/work per thread
-    if progname in ["azfinsim", "generator", "split"]:
+    if progname in ["azfinsim", "generator", "split", "pipeline"]:
         workParser = parser.add_argument_group("Trades", "Trade-specific options")
-        if progname in ["azfinsim", "generator"]:
+        if progname in ["azfinsim", "generator", "pipeline"]:
             workParser.add_argument(
                 "-s",
                 "--start-trade",
@@ -118,20 +183,279 @@ def getargs(progname):
             )
         if progname == "split":
             workParser.add_argument(
-                "-w", "--trade-window", type=int, help="number of trades per file"
+                "-w",
+                "--trade-window",
+                type=int,
+                help="number of trades per file, or, with a redis cache, per task window",
+            )
+        if progname == "pipeline":
+            workParser.add_argument(
+                "--shard-size",
+                type=int,
+                default=10000,
+                help="number of trades per shard, i.e. per file of the split stage (default: 10,000)",
+            )
+        if progname == "azfinsim":
+            workParser.add_argument(
+                "--delta",
+                action="store_true",
+                default=False,
+                help="only process trades whose inputs changed since their results were last written (redis only)",
+            )
+        if progname in ["azfinsim", "pipeline"]:
+            workParser.add_argument(
+                "-j",
+                "--workers",
+                type=int,
+                default=1,
+                help="number of worker processes pricing trades; "
+                "the most expensive trades are dispatched first (default: 1)",
+            )
+            workParser.add_argument(
+                "--shared-memory",
+                action="store_true",
+                default=False,
+                help="pass trades to, and results from, the workers through shared memory",
+            )
+        if progname in ["azfinsim", "generator"]:
+            workParser.add_argument(
+                "--batch-size",
+                type=int,
+                default=10000,
+                help="number of trades generated and written, or read, priced and written, per batch (default: 10,000)",
+            )
+        if progname == "azfinsim":
+            workParser.add_argument(
+                "--read-chunk",
+                type=int,
+                default=None,
+                help="number of trades read from the cache per request (default: --batch-size)",
+            )
+            workParser.add_argument(
+                "--autotune",
+                action="store_true",
+                default=False,
+                help="choose --read-chunk, --batch-size and --workers from the measured cache latency and "
+                "compute time of the first trades, or from --autotune-file",
+            )
+            workParser.add_argument(
+                "--autotune-file",
+                default=None,
+                help="file (json) the --autotune measurements are saved to, and reused from by later tasks "
+                "with the same cache, algorithm, kernel, precision and number of CPUs",
+            )
+            workParser.add_argument(
+                "--log-sample",
+                type=int,
+                default=1,
+                help="log the progress of every N-th trade, and a summary every N trades (default: 1)",
             )
 
-    if progname == "azfinsim":
+    if progname in ["azfinsim", "split", "pipeline"]:
+        costParser = parser.add_argument_group("Cost Model", "Estimating the compute cost of trades")
+        costParser.add_argument(
+            "--cost-model",
+            default=None,
+            help="cost model file (json); azfinsim calibrates it using the measured compute times",
+        )
+        if progname == "split":
+            costParser.add_argument(
+                "--split-by",
+                default="count",
+                choices=["count", "cost"],
+                help="count: split into files of --trade-window trades; "
+                "cost: split into as many files, balanced by estimated compute cost (default: count)",
+            )
+            costParser.add_argument(
+                "--algorithm",
+                default="deltavega",
+                choices=["analytic", "deltavega", "hybrid", "pvonly", "scenarios", "synthetic"],
+                help="algorithm the trades will be processed with, for --split-by=cost (default: deltavega)",
+            )
+            costParser.add_argument(
+                "--time-steps",
+                type=int,
+                default=None,
+                help="simulation grid the trades will be processed with (see azfinsim --time-steps), "
+                "for --split-by=cost (default: the trades' t_steps)",
+            )
+            costParser.add_argument(
+                "--scenarios",
+                type=json.loads,
+                default=None,
+                help="risk ladder the trades will be processed with (see azfinsim --scenarios), "
+                "for --split-by=cost and --algorithm scenarios",
+            )
+            costParser.add_argument(
+                "--analytic-max-vol-of-vol",
+                type=float,
+                default=analytic.MAX_VOL_OF_VOL,
+                help="validity band of the analytic pricer (see azfinsim --analytic-max-vol-of-vol), "
+                "for --split-by=cost and --algorithm hybrid (default: {})".format(analytic.MAX_VOL_OF_VOL),
+            )
+            costParser.add_argument(
+                "--analytic-min-barrier-distance",
+                type=float,
+                default=analytic.MIN_BARRIER_DISTANCE,
+                help="validity band of the analytic pricer (see azfinsim --analytic-min-barrier-distance), "
+                "for --split-by=cost and --algorithm hybrid (default: {})".format(analytic.MIN_BARRIER_DISTANCE),
+            )
+            costParser.add_argument(
+                "--kernel",
+                default="numpy",
+                choices=["numpy", "numba", "reference"],
+                help="simulation kernel the trades will be processed with, for --split-by=cost (default: numpy)",
+            )
+            costParser.add_argument(
+                "--precision",
+                default="float64",
+                choices=["float64", "float32"],
+                help="precision the trades will be processed with, for --split-by=cost (default: float64)",
+            )
+            costParser.add_argument(
+                "--antithetic",
+                action="store_true",
+                help="the trades will be processed with antithetic paths, for --split-by=cost",
+            )
+            costParser.add_argument(
+                "--target-stderr",
+                type=float,
+                default=None,
+                help="target standard error the trades will be processed with (see azfinsim --target-stderr), "
+                "for --split-by=cost",
+            )
+
+    if progname in ["azfinsim", "pipeline"]:
         algoParser = parser.add_argument_group(
             "Algorithm", "Algorithm-specific options"
         )
         algoParser.add_argument(
             "--algorithm",
             default="deltavega",
-            choices=["deltavega", "pvonly", "synthetic"],
-            help="pricing algorithm (default: deltavega)",
+            choices=["analytic", "deltavega", "hybrid", "pvonly", "scenarios", "synthetic"],
+            help="pricing algorithm; analytic: closed-form PV, delta and vega; hybrid: analytic for the trades "
+            "within the validity band, Monte Carlo for the others (default: deltavega)",
+        )
+        algoParser.add_argument(
+            "--scenarios",
+            type=json.loads,
+            default=None,
+            help="risk ladder for --algorithm scenarios as json, mapping trade parameters to lists of "
+            'relative shocks, e.g. \'{"fx1": [-0.01, 0, 0.01], "sigma1": [-0.1, 0, 0.1]}\'',
+        )
+        algoParser.add_argument(
+            "--analytic-max-vol-of-vol",
+            type=float,
+            default=analytic.MAX_VOL_OF_VOL,
+            help="validity band of the analytic pricer: maximum vol of vol over the life of the trade, "
+            "v * sqrt(maturity) (default: {})".format(analytic.MAX_VOL_OF_VOL),
+        )
+        algoParser.add_argument(
+            "--analytic-min-barrier-distance",
+            type=float,
+            default=analytic.MIN_BARRIER_DISTANCE,
+            help="validity band of the analytic pricer: minimum distance of the spot above the barrier, "
+            "in daily standard deviations (default: {})".format(analytic.MIN_BARRIER_DISTANCE),
         )
 
+        # -- monte carlo options
+        algoParser.add_argument(
+            "--target-stderr",
+            type=float,
+            default=None,
+            help="simulate paths in blocks until the standard error of the PV is below this value "
+            "(default: simulate the number of trials specified by each trade)",
+        )
+        algoParser.add_argument(
+            "--max-trials",
+            type=int,
+            default=None,
+            help="maximum number of paths to simulate with --target-stderr (default: trials specified by each trade)",
+        )
+        algoParser.add_argument(
+            "--trials-block",
+            type=int,
+            default=1000,
+            help="number of paths to simulate per block with --target-stderr (default: 1000)",
+        )
+
+        algoParser.add_argument(
+            "--antithetic",
+            action="store_true",
+            help="variance reduction: use antithetic paths (overridden by an 'antithetic' trade column)",
+        )
+        algoParser.add_argument(
+            "--control-variate",
+            action="store_true",
+            help="variance reduction: use the settlement FX rate as a control variate "
+            "(overridden by a 'control_variate' trade column)",
+        )
+
+        algoParser.add_argument(
+            "--sampler",
+            default="pseudo",
+            choices=["pseudo", "sobol"],
+            help="path generation: pseudo-random or quasi-random (scrambled Sobol with "
+            "Brownian bridge; uses scipy, if available) (default: pseudo)",
+        )
+
+        algoParser.add_argument(
+            "--kernel",
+            default="numpy",
+            choices=["numpy", "numba", "reference"],
+            help="simulation kernel; numba falls back to numpy if numba is not installed (default: numpy)",
+        )
+        algoParser.add_argument(
+            "--precision",
+            default="float64",
+            choices=["float64", "float32"],
+            help="floating point precision for path simulation; float32 requires --kernel numpy (default: float64)",
+        )
+        algoParser.add_argument(
+            "--time-steps",
+            type=int,
+            default=None,
+            help="simulate each trade on a grid of this many steps, accounting for the knock-out at the daily "
+            "monitoring dates in between with a Brownian bridge; requires --kernel numpy "
+            "(default: simulate every monitoring date, i.e. the trade's t_steps)",
+        )
+
+        algoParser.add_argument(
+            "--seed",
+            type=int,
+            default=None,
+            help="random seed; each trade is priced with seed + trade number, and the 'generated' cache "
+            "and the pipeline generate trades from it (default: not seeded; generated trades use 0)",
+        )
+
+        # -- result cache options
+        if progname == "azfinsim":
+            resultParser = parser.add_argument_group(
+                "Result Cache", "Reuse results for trades whose inputs are unchanged since an earlier run"
+            )
+            resultParser.add_argument(
+                "--result-cache",
+                default="none",
+                choices=["none", "redis", "file"],
+                help="result cache type; 'redis' uses the --cache-name server (default: none)",
+            )
+            resultParser.add_argument(
+                "--result-cache-path", default=None, help="database file for the 'file' result cache"
+            )
+            resultParser.add_argument(
+                "--result-cache-ttl",
+                type=int,
+                default=86400,
+                help="time in seconds after which cached results expire (default: 86400)",
+            )
+            resultParser.add_argument(
+                "--result-cache-size",
+                type=int,
+                default=1000000,
+                help="maximum number of results kept by the 'file' result cache; "
+                "least recently used results are evicted first (default: 1,000,000)",
+            )
+
         # -- synthetic workload options
         algoParser.add_argument(
             "--delay-start",
@@ -143,13 +467,53 @@ def getargs(progname):
             "--mem-usage",
             type=int,
             default=16,
-            help="memory usage for task in MB (default: 16)",
+            help="memory usage for task in MB, for the 'memory' profile (default: 16)",
         )
         algoParser.add_argument(
             "--task-duration",
             type=int,
             default=20,
-            help="task duration in milliseconds (default: 20)",
+            help="mean task duration in milliseconds (default: 20)",
+        )
+        algoParser.add_argument(
+            "--synthetic-profile",
+            type=str,
+            default="memory",
+            choices=["memory", "cpu", "io", "threads"],
+            help="synthetic workload: 'memory' streams over a --mem-usage MB buffer, 'cpu' runs floating "
+            "point loops in cache, 'io' sleeps, 'threads' runs floating point loops on "
+            "--synthetic-threads threads (default: memory)",
+        )
+        algoParser.add_argument(
+            "--synthetic-threads",
+            type=int,
+            default=None,
+            help="number of busy threads for the 'threads' profile (default: number of CPUs)",
+        )
+        algoParser.add_argument(
+            "--duration-distribution",
+            type=str,
+            default="fixed",
+            choices=["fixed", "lognormal", "bimodal"],
+            help="distribution of synthetic task durations, with mean --task-duration (default: fixed)",
+        )
+        algoParser.add_argument(
+            "--duration-sigma",
+            type=float,
+            default=0.5,
+            help="standard deviation of the log of the duration, for 'lognormal' (default: 0.5)",
+        )
+        algoParser.add_argument(
+            "--bimodal-fraction",
+            type=float,
+            default=0.1,
+            help="fraction of long tasks, for 'bimodal' (default: 0.1)",
+        )
+        algoParser.add_argument(
+            "--bimodal-ratio",
+            type=float,
+            default=10.0,
+            help="duration of long tasks relative to short ones, for 'bimodal' (default: 10)",
         )
         algoParser.add_argument(
             "--failure",
@@ -158,6 +522,79 @@ def getargs(progname):
             help="inject random task failure with this probability (default: 0.0)",
         )
 
+    if progname == "pipeline":
+        pipelineParser = parser.add_argument_group("Pipeline", "Options for the in-memory pipeline")
+        pipelineParser.add_argument(
+            "--materialize",
+            nargs="+",
+            default=[],
+            choices=["trades", "shards", "results", "merged"],
+            help="stages whose output is written to --output-path: 'trades' (trades.csv), 'shards' "
+            "(trades.N.csv), 'results' (trades.N.results.csv) and/or 'merged' (results.csv) (default: none)",
+        )
+        pipelineParser.add_argument(
+            "--queue-size",
+            type=int,
+            default=2,
+            help="number of shards buffered between stages (default: 2)",
+        )
+
+    if progname == "collect":
+        collectParser = parser.add_argument_group("Collect", "Options for collecting results from a stream")
+        collectParser.add_argument(
+            "--algorithm",
+            default="deltavega",
+            choices=["analytic", "deltavega", "hybrid", "pvonly", "scenarios", "synthetic"],
+            help="algorithm whose results to collect (default: deltavega)",
+        )
+        collectParser.add_argument(
+            "--stream",
+            default=None,
+            help="stream to read the results from (default: '<algorithm>:results')",
+        )
+        collectParser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="number of stream entries (result batches) to read per request (default: 100)",
+        )
+
+    if progname == "benchmark":
+        benchParser = parser.add_argument_group("Benchmark", "Benchmark-specific options")
+        benchParser.add_argument(
+            "--benchmark",
+            default="precision",
+            choices=["precision", "kernels", "bridge", "cache", "compression"],
+            help="precision: compare float32 and float64 simulation; "
+            "kernels: check that the simulation kernels agree statistically; "
+            "bridge: check coarse time-stepping with the Brownian bridge against the daily grid; "
+            "cache: compare reading trades one at a time and in batches, using the memory cache; "
+            "compression: compare the compression codecs on the trades (default: precision)",
+        )
+        benchParser.add_argument(
+            "-n", "--num-trades", type=int, default=10, help="number of trades to generate (default: 10)"
+        )
+        benchParser.add_argument(
+            "--trials", type=int, default=10000, help="Monte Carlo paths per trade (default: 10000)"
+        )
+        benchParser.add_argument(
+            "--seed", type=int, default=0, help="random seed (default: 0)"
+        )
+        benchParser.add_argument(
+            "--tolerance",
+            type=float,
+            default=None,
+            help="maximum accepted difference, in units of the PV standard error, or, for cache, "
+            "minimum speedup, or, for compression, minimum compression ratio "
+            "(default: 0.01 for precision, 4 for kernels and bridge, 1 for cache and compression)",
+        )
+        benchParser.add_argument(
+            "--time-steps",
+            type=int,
+            default=None,
+            help="simulation steps per trade for the bridge benchmark (default: a tenth of the trade's t_steps)",
+        )
+
     # -- logs & metrics
     insightsParser = parser.add_argument_group(
         "Azure Application Insights", "Azure Application Insights-specific options"
@@ -177,6 +614,38 @@ def getargs(progname):
         default={},
     )
 
+    metricsParser = parser.add_argument_group("Metrics", "Metrics export options")
+    metricsParser.add_argument(
+        "--metrics-sink",
+        default="opencensus",
+        choices=["opencensus", "jsonl", "prometheus", "none"],
+        help="where to export metrics (default: opencensus)",
+    )
+    metricsParser.add_argument(
+        "--metrics-path",
+        type=str,
+        default=None,
+        help="output file for 'jsonl' and 'prometheus' metrics sinks",
+    )
+    metricsParser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=15.0,
+        help="interval in seconds for flushing metrics in the background; 0 to flush only at exit (default: 15)",
+    )
+    metricsParser.add_argument(
+        "--telemetry",
+        action="store_true",
+        default=False,
+        help="sample the CPU, memory, context switches, disk and network I/O of the task, and record them as metrics",
+    )
+    metricsParser.add_argument(
+        "--telemetry-interval",
+        type=float,
+        default=1.0,
+        help="interval in seconds between resource samples (default: 1)",
+    )
+
     import sys
     log.debug(f"parsing arguments: {sys.argv}")
     args = parser.parse_args()
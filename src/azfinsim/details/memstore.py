@@ -0,0 +1,199 @@
+r"""
+an in-process stand-in for a redis server, implementing the subset of the redis client API
+used by `dbase` and `resultcache`, so that the redis code paths can be exercised (and
+benchmarked) without a server.
+
+Each request, or pipeline, counts as one round trip. Round trips can be slowed down by a
+fixed latency plus the time to transfer the request and response at a limited bandwidth,
+to mimic a remote cache. Stores are shared, by name, by all clients in a process.
+"""
+import fnmatch
+import threading
+import time
+
+_stores = {}  # name -> {key: value}
+_stores_lock = threading.Lock()
+
+
+def _encode(value) -> bytes:
+    # redis stores everything as bytes
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _size(value) -> int:
+    """approximate number of bytes transferred for `value`"""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    return 8
+
+
+def _stream_id(value, default) -> tuple:
+    if value in ("-", "+"):
+        return default
+    ms, _, seq = _encode(value).decode().partition("-")
+    return int(ms), int(seq or 0)
+
+
+class MemoryClient:
+    """in-process redis client; `latency` is in seconds per round trip and `bandwidth` in
+    bytes per second (0 for unlimited)"""
+
+    def __init__(self, name: str = "default", latency: float = 0.0, bandwidth: float = 0.0):
+        with _stores_lock:
+            self._data = _stores.setdefault(name, {})
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._lock = threading.Lock()
+
+    def _round_trip(self, nbytes: int) -> None:
+        delay = self._latency + (nbytes / self._bandwidth if self._bandwidth > 0 else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _call(self, command: str, *args, **kwargs):
+        with self._lock:
+            result = getattr(self, "_" + command)(*args, **kwargs)
+        self._round_trip(_size(args) + _size(kwargs) + _size(result))
+        return result
+
+    def pipeline(self, transaction: bool = True) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    # -- commands
+
+    def _ping(self):
+        return True
+
+    def _get(self, key):
+        return self._data.get(_encode(key))
+
+    def _set(self, key, value, ex=None):
+        # expiry isn't modelled; values live as long as the process
+        self._data[_encode(key)] = _encode(value)
+        return True
+
+    def _mget(self, keys):
+        return [self._data.get(_encode(key)) for key in keys]
+
+    def _delete(self, *keys):
+        return sum(self._data.pop(_encode(key), None) is not None for key in keys)
+
+    def _exists(self, *keys):
+        return sum(_encode(key) in self._data for key in keys)
+
+    def _keys(self, pattern="*"):
+        return [key for key in self._data if fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def _hset(self, name, key=None, value=None, mapping=None):
+        values = self._data.setdefault(_encode(name), {})
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = sum(_encode(k) not in values for k in items)
+        values.update({_encode(k): _encode(v) for k, v in items.items()})
+        return added
+
+    def _hget(self, name, key):
+        return self._data.get(_encode(name), {}).get(_encode(key))
+
+    def _hmget(self, name, keys):
+        values = self._data.get(_encode(name), {})
+        return [values.get(_encode(key)) for key in keys]
+
+    def _zadd(self, name, mapping):
+        members = self._data.setdefault(_encode(name), {})
+        added = sum(_encode(k) not in members for k in mapping)
+        members.update({_encode(k): float(v) for k, v in mapping.items()})
+        return added
+
+    def _zrange(self, name, start, end, withscores=False):
+        members = sorted(self._data.get(_encode(name), {}).items(), key=lambda item: (item[1], item[0]))
+        # the end index is inclusive, as in redis
+        members = members[start:] if end == -1 else members[start:end + 1]
+        return members if withscores else [member for member, _ in members]
+
+    def _zcard(self, name):
+        return len(self._data.get(_encode(name), {}))
+
+    def _xadd(self, name, fields, id="*"):
+        entries = self._data.setdefault(_encode(name), [])
+        ms = int(time.time() * 1000)
+        last = _stream_id(entries[-1][0], None) if entries else (0, -1)
+        entry_id = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+        entry_id = "{}-{}".format(*entry_id).encode()
+        entries.append((entry_id, {_encode(k): _encode(v) for k, v in fields.items()}))
+        return entry_id
+
+    def _xrange(self, name, min="-", max="+", count=None):
+        first = _stream_id(min, (0, 0))
+        last = _stream_id(max, (float("inf"), 0))
+        result = []
+        for entry_id, fields in self._data.get(_encode(name), []):
+            if first <= _stream_id(entry_id, None) <= last:
+                result.append((entry_id, dict(fields)))
+                if count is not None and len(result) == count:
+                    break
+        return result
+
+    def _xlen(self, name):
+        return len(self._data.get(_encode(name), []))
+
+
+def _command(name):
+    def command(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+
+    command.__name__ = name
+    return command
+
+
+for _name in [
+    "ping", "get", "set", "mget", "delete", "exists", "keys", "hset", "hget", "hmget",
+    "zadd", "zrange", "zcard", "xadd", "xrange", "xlen",
+]:
+    setattr(MemoryClient, _name, _command(_name))
+
+
+class MemoryPipeline:
+    """queues commands and executes them in a single round trip"""
+
+    def __init__(self, client: MemoryClient):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        if not hasattr(MemoryClient, "_" + name):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        client = self._client
+        results = []
+        nbytes = 0
+        with client._lock:
+            for name, args, kwargs in self._commands:
+                result = getattr(client, "_" + name)(*args, **kwargs)
+                results.append(result)
+                nbytes += _size(args) + _size(kwargs) + _size(result)
+        self._commands = []
+        client._round_trip(nbytes)
+        return results
+
+
+def clear(name: str = None) -> None:
+    """removes all data from the named store, or from all stores"""
+    with _stores_lock:
+        for store_name, store in _stores.items():
+            if name is None or store_name == name:
+                store.clear()
@@ -1,52 +1,185 @@
-from opencensus.stats import measure as measure_module
-from opencensus.stats import aggregation as aggregation_module
-from opencensus.stats import view as view_module
-from opencensus.stats import stats as stats_module
-from opencensus.tags import TagMap, TagKey, TagValue
+r"""
+metrics collection and export.
 
+Measurements are aggregated locally, in per-thread buffers, so that calls to `put` on
+the hot path never take a lock or touch the exporter. The aggregates are periodically
+flushed, from a background thread, to a pluggable sink (opencensus/Azure, a JSON-lines
+file or a Prometheus text file). `record` forces a synchronous flush and the pending
+aggregates are always flushed at exit.
+
+Aggregates are cumulative for the lifetime of the process. Worker processes (e.g. in a
+process pool) should return `drain()` along with their results; the parent then folds
+them in using `merge()`.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# measurement name -> config (description, unit, type, aggregation)
 measurements = {}
-measurement_map = stats_module.stats.stats_recorder.new_measurement_map()
-tag_map = TagMap()
+tags = {}
 
+_local = threading.local()
+_buffers = []  # per-thread aggregates; appended to only when a new thread first puts
+_buffers_lock = threading.Lock()
+_merged = {}  # aggregates merged in from other processes
+_merged_lock = threading.Lock()
 
-def initialize_tags(tags: dict):
-    for tag, value in tags.items():
-        tag_map.insert(TagKey(tag), TagValue(value))
+_sink = None
+_exported = {}  # values at the last flush
+_flush_lock = threading.Lock()
+_flusher = None
+_stop_event = threading.Event()
 
 
-def get_tag_keys():
-    return list(tag_map.map.keys())
+# -- sinks
 
 
-def define_measurements(measurements_config: dict):
-    global measurements
-    for measurement, config in measurements_config.items():
+class MetricsSink:
+    """base class for metrics sinks; `export` receives cumulative values for all measurements"""
+
+    def export(self, values: dict, tags: dict) -> None:
+        raise RuntimeError("Not implemented")
+
+    def close(self) -> None:
+        pass
+
+
+class OpenCensusSink(MetricsSink):
+    """records measurements using opencensus; the Azure exporter, if any, is attached
+    to the global view manager (see `azfinsim.details._az_log_handler`)"""
+
+    def __init__(self):
+        from opencensus.stats import stats as stats_module
+        from opencensus.tags import TagMap, TagKey, TagValue
+
+        self._stats = stats_module.stats
+        self._tag_map = TagMap()
+        for tag, value in tags.items():
+            self._tag_map.insert(TagKey(tag), TagValue(value))
+        self._measures = {}
+        self._exported = {}
+
+    def _define(self, measurement: str):
+        from opencensus.stats import measure as measure_module
+        from opencensus.stats import aggregation as aggregation_module
+        from opencensus.stats import view as view_module
+
+        config = measurements[measurement]
         if config["type"] == "float":
-            measurements[measurement] = measure_module.MeasureFloat(
+            measure = measure_module.MeasureFloat(
                 measurement, config["description"], config["unit"]
             )
-        elif config["type"] == "int":
-            measurements[measurement] = measure_module.MeasureInt(
+        else:
+            measure = measure_module.MeasureInt(
                 measurement, config["description"], config["unit"]
             )
+        if config["aggregation"] == "sum":
+            aggr = aggregation_module.SumAggregation()
         else:
+            aggr = aggregation_module.LastValueAggregation()
+
+        v = view_module.View(
+            measurement, config["description"], list(self._tag_map.map.keys()), measure, aggr
+        )
+        self._stats.view_manager.register_view(v)
+        self._measures[measurement] = measure
+
+    def export(self, values: dict, tags: dict) -> None:
+        measurement_map = self._stats.stats_recorder.new_measurement_map()
+        for measurement, value in values.items():
+            if measurement not in self._measures:
+                self._define(measurement)
+            config = measurements[measurement]
+            if config["aggregation"] == "sum":
+                # views aggregate on their own, so only record what is new since the last export
+                delta = value - self._exported.get(measurement, 0)
+                self._exported[measurement] = value
+                if delta == 0:
+                    continue
+                value = delta
+            if config["type"] == "int":
+                measurement_map.measure_int_put(self._measures[measurement], int(value))
+            else:
+                measurement_map.measure_float_put(self._measures[measurement], float(value))
+        measurement_map.record(self._tag_map)
+
+
+class JsonLinesSink(MetricsSink):
+    """appends one json object per flush to a file"""
+
+    def __init__(self, fname: str):
+        self._fname = fname
+
+    def export(self, values: dict, tags: dict) -> None:
+        record = {"timestamp": time.time(), "pid": os.getpid(), "tags": tags, "metrics": values}
+        with open(self._fname, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class PrometheusSink(MetricsSink):
+    """writes the metrics in Prometheus text exposition format (e.g. for the node_exporter
+    textfile collector); the file is replaced atomically on every flush"""
+
+    def __init__(self, fname: str):
+        self._fname = fname
+
+    def export(self, values: dict, tags: dict) -> None:
+        labels = ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in tags.items())
+        lines = []
+        for measurement, value in values.items():
+            config = measurements[measurement]
+            name = "azfinsim_{}".format(measurement)
+            lines.append("# HELP {} {} ({})".format(name, config["description"], config["unit"]))
+            lines.append("# TYPE {} {}".format(name, "counter" if config["aggregation"] == "sum" else "gauge"))
+            lines.append("{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+        tmpname = "{}.{}.tmp".format(self._fname, os.getpid())
+        with open(tmpname, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpname, self._fname)
+
+
+def create_sink(sink_type: str, path: str = None) -> MetricsSink:
+    if sink_type == "opencensus":
+        return OpenCensusSink()
+    elif sink_type in ["jsonl", "prometheus"]:
+        if path is None:
+            raise ValueError(f"metrics path must be specified for '{sink_type}' sink")
+        return JsonLinesSink(path) if sink_type == "jsonl" else PrometheusSink(path)
+    elif sink_type == "none":
+        return None
+    else:
+        raise ValueError(f"Unknown metrics sink: {sink_type}")
+
+
+# -- setup
+
+
+def initialize_tags(new_tags: dict):
+    tags.update(new_tags)
+
+
+def get_tag_keys():
+    return list(tags.keys())
+
+
+def define_measurements(measurements_config: dict):
+    for measurement, config in measurements_config.items():
+        if config["type"] not in ["float", "int"]:
             raise ValueError("Unknown measurement type")
+        measurements[measurement] = config
 
 
 def define_views(views_config: dict):
-    global measurements
     for view, config in views_config.items():
-        if config["aggregation"] == "sum":
-            aggr = aggregation_module.SumAggregation()
-        elif config["aggregation"] == "last_value":
-            aggr = aggregation_module.LastValueAggregation()
-        else:
+        if config["aggregation"] not in ["sum", "last_value"]:
             raise ValueError("Unknown aggregation type")
-
-        v = view_module.View(
-            view, config["description"], get_tag_keys(), measurements[view], aggr
-        )
-        stats_module.stats.view_manager.register_view(v)
+        measurements[view] = config
 
 
 def define_measurements_and_views(config: dict):
@@ -54,14 +187,140 @@ def define_measurements_and_views(config: dict):
     define_views(config)
 
 
-def record():
-    measurement_map.record(tag_map)
+def configure(sink: MetricsSink, interval: float = 0):
+    """sets the sink and starts the background flush thread, if `interval` > 0"""
+    global _sink, _flusher
+    shutdown()
+    # registered here, rather than on import, so that the final flush runs before the
+    # exit handlers of any exporter set up earlier (they run in reverse order)
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+    _sink = sink
+    _exported.clear()
+    if interval > 0:
+        _stop_event.clear()
+        _flusher = threading.Thread(target=_flush_loop, args=(interval,), name="metrics", daemon=True)
+        _flusher.start()
+
+
+def shutdown():
+    """stops the background flush thread and flushes any pending metrics"""
+    global _flusher, _sink
+    if _flusher is not None:
+        _stop_event.set()
+        _flusher.join()
+        _flusher = None
+    if _sink is not None:
+        record()
+        _sink.close()
+        _sink = None
+
+
+def _flush_loop(interval: float):
+    while not _stop_event.wait(interval):
+        try:
+            record()
+        except Exception:
+            log.exception("failed to flush metrics")
+
+
+def _after_fork_in_child():
+    # aggregates (and the sink) belong to the parent; a forked worker starts afresh
+    # and hands its aggregates back with `drain()`
+    global _sink, _flusher, _buffers_lock, _merged_lock, _flush_lock
+    _sink = None
+    _flusher = None
+    _exported.clear()
+    _buffers.clear()
+    _merged.clear()
+    _local.__dict__.clear()
+    _buffers_lock = threading.Lock()
+    _merged_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# -- aggregation
+
+
+def _local_values() -> dict:
+    values = getattr(_local, "values", None)
+    if values is None:
+        values = _local.values = {}
+        with _buffers_lock:
+            _buffers.append(_local.__dict__)
+    return values
+
+
+def _fold(into: dict, values: dict):
+    """merge aggregates `values` into `into`; sums are added, last values are resolved by timestamp"""
+    for measurement, (value, stamp) in values.items():
+        current = into.get(measurement)
+        if measurements.get(measurement, {}).get("aggregation") == "sum":
+            into[measurement] = (value if current is None else current[0] + value, 0)
+        elif current is None or current[1] <= stamp:
+            into[measurement] = value, stamp
 
 
 def put(measurement, value):
-    if isinstance(measurements[measurement], measure_module.MeasureInt):
-        measurement_map.measure_int_put(measurements[measurement], value)
-    elif isinstance(measurements[measurement], measure_module.MeasureFloat):
-        measurement_map.measure_float_put(measurements[measurement], value)
+    config = measurements[measurement]
+    values = _local_values()
+    if config["aggregation"] == "sum":
+        current = values.get(measurement)
+        values[measurement] = (value if current is None else current[0] + value, 0)
     else:
-        raise ValueError("Unknown measurement type")
+        values[measurement] = (value, time.time())
+
+
+def collect() -> dict:
+    """returns the aggregates for this process as `{measurement: (value, timestamp)}`"""
+    result = {}
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        _fold(result, buffer.get("values", {}).copy())
+    with _merged_lock:
+        _fold(result, _merged)
+    return result
+
+
+def drain() -> dict:
+    """returns the aggregates recorded so far in this process (along with their config) and
+    resets them; meant to be called by worker processes at the end of a task, once no other
+    thread is recording"""
+    result = {}
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        values, buffer["values"] = buffer.get("values", {}), {}
+        _fold(result, values)
+    with _merged_lock:
+        _fold(result, _merged)
+        _merged.clear()
+    return {
+        "measurements": {measurement: measurements[measurement] for measurement in result},
+        "values": result,
+    }
+
+
+def merge(drained: dict):
+    """merges aggregates returned by `drain()` in a worker process"""
+    for measurement, config in drained["measurements"].items():
+        measurements.setdefault(measurement, config)
+    with _merged_lock:
+        _fold(_merged, drained["values"])
+
+
+def record():
+    """flushes the current aggregates to the sink"""
+    with _flush_lock:
+        if _sink is None:
+            return
+        values = {measurement: value for measurement, (value, _) in collect().items()}
+        if values and values != _exported:
+            _sink.export(values, dict(tags))
+            _exported.clear()
+            _exported.update(values)
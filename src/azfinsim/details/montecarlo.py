@@ -1,11 +1,23 @@
+import itertools
 import pandas as pd
 import numpy as np
 import time
 
+from . import analytic, numba_kernel, qmc
+
+# version of the pricing model; bump when changes affect the results (see `resultcache`)
+MODEL_VERSION = "1"
+
 # -- Montecarlo
 
 
-def mc_simulation(fx1, sigma1, drift, v, ro, maturity, t_steps, trials):
+def mc_simulation(
+    fx1, sigma1, drift, v, ro, maturity, t_steps, trials, antithetic=False, normals=None
+):
+    # with `antithetic`, path `i + trials / 2` is driven by the negated draws of path `i`
+    # `normals`, if specified, are pre-generated draws of shape (2, t_steps, paths) for the
+    # FX and volatility processes, e.g. from `qmc.sobol_normals`
+    assert not antithetic or trials % 2 == 0
     dt = float(maturity) / t_steps  # defining time step
     ndt = np.zeros(
         (t_steps + 1, trials), np.float64
@@ -28,12 +40,18 @@ def mc_simulation(fx1, sigma1, drift, v, ro, maturity, t_steps, trials):
     for t in range(1, t_steps + 1):
         ndt[t] = ndt[t - 1] + dt  # counting time steps
 
-        random_num_2 = np.random.standard_normal(
-            trials
-        )  # drawing random numbers for stochastic volatility process
-        random_num_1 = np.random.standard_normal(
-            trials
-        )  # drawing random numbers for FX process
+        if normals is not None:
+            random_num_1, random_num_2 = normals[0, t - 1], normals[1, t - 1]
+        else:
+            random_num_2 = np.random.standard_normal(
+                trials // 2 if antithetic else trials
+            )  # drawing random numbers for stochastic volatility process
+            random_num_1 = np.random.standard_normal(
+                trials // 2 if antithetic else trials
+            )  # drawing random numbers for FX process
+        if antithetic:
+            random_num_2 = np.concatenate((random_num_2, -random_num_2))
+            random_num_1 = np.concatenate((random_num_1, -random_num_1))
 
         stoh_vol[t] = stoh_vol[t - 1] * np.exp(
             (-0.5 * v**2) * dt
@@ -51,10 +69,247 @@ def mc_simulation(fx1, sigma1, drift, v, ro, maturity, t_steps, trials):
     return fx_simulation, stoh_vol, ndt
 
 
-def price_option(inputs):
-    # print("price_option")
-    # print(inputs)
-    start_time = time.time()
+def _broadcast(x, scenarios, dtype):
+    # scalars stay scalars, per-scenario values are broadcast along the paths
+    return dtype.type(x) if x.ndim == 0 else np.broadcast_to(x, scenarios).astype(dtype)[:, None]
+
+
+def _paths(fx1, sigma1, drift, v, ro, maturity, t_steps, trials, antithetic, normals, dtype):
+    """simulates the process of `mc_simulation` (drawing random numbers in the same order),
+    keeping only the current state of each path: yields the FX rate and volatility buffers,
+    updated in place, at t = 0 and after each step (see `mc_terminal` for the arguments)"""
+    assert not antithetic or trials % 2 == 0
+    dtype = np.dtype(dtype)
+    fx1, sigma1, drift, v, ro, maturity = (
+        np.asarray(x, dtype=np.float64) for x in (fx1, sigma1, drift, v, ro, maturity)
+    )
+    scenarios = np.broadcast_shapes(fx1.shape, sigma1.shape, drift.shape, v.shape, ro.shape, maturity.shape)
+
+    def _const(x):
+        return _broadcast(x, scenarios, dtype)
+
+    dt = maturity / t_steps
+    sqrt_dt = _const(np.sqrt(dt))
+    vol_drift = _const(-0.5 * v**2 * dt)
+    vol_z1 = _const(v * ro * np.sqrt(dt))
+    vol_z2 = _const(v * np.sqrt(1 - ro**2) * np.sqrt(dt))
+    fx_drift = _const(drift * dt)
+    fx_var = _const(-0.5 * dt)
+    half = trials // 2 if antithetic else trials
+
+    shape = scenarios + (trials,)
+    vol = np.empty(shape, dtype)
+    vol[...] = _const(sigma1)
+    fx = np.empty(shape, dtype)
+    fx[...] = _const(fx1)
+    yield fx, vol
+    z1 = np.empty(trials, dtype)
+    z2 = np.empty(trials, dtype)
+    a = np.empty(shape, dtype)
+    b = np.empty(shape, dtype)
+    for t in range(t_steps):
+        if normals is not None:
+            z1[:half] = normals[0, t]
+            z2[:half] = normals[1, t]
+        else:
+            z2[:half] = np.random.standard_normal(half)
+            z1[:half] = np.random.standard_normal(half)
+        if antithetic:
+            np.negative(z1[:half], out=z1[half:])
+            np.negative(z2[:half], out=z2[half:])
+
+        # vol *= exp(-0.5 * v**2 * dt + v * (ro * z1 + sqrt(1 - ro**2) * z2) * sqrt(dt))
+        np.multiply(z1, vol_z1, out=a)
+        np.multiply(z2, vol_z2, out=b)
+        a += b
+        a += vol_drift
+        np.exp(a, out=a)
+        vol *= a
+
+        # fx *= exp((drift - 0.5 * vol**2) * dt + vol * z1 * sqrt(dt))
+        np.multiply(vol, vol, out=a)
+        a *= fx_var
+        a += fx_drift
+        np.multiply(vol, z1, out=b)
+        b *= sqrt_dt
+        a += b
+        np.exp(a, out=a)
+        fx *= a
+        yield fx, vol
+
+
+def mc_terminal(
+    fx1, sigma1, drift, v, ro, maturity, t_steps, trials, antithetic=False, normals=None, dtype=np.float64
+):
+    """simulates the same process as `mc_simulation` (drawing random numbers in the same
+    order), but only keeps the current state of each path. Returns the settlement FX rate
+    and the minimum FX rate along each path.
+
+    Invariants are hoisted out of the time loop and all updates are done in place on
+    preallocated buffers of type `dtype`.
+
+    `fx1`, `sigma1`, `drift`, `v`, `ro` and `maturity` can also be arrays of shape
+    (scenarios,), in which case all scenarios are simulated from the same random numbers
+    and the results have shape (scenarios, trials)."""
+    paths = _paths(fx1, sigma1, drift, v, ro, maturity, t_steps, trials, antithetic, normals, dtype)
+    fx, _ = next(paths)
+    fx_min = fx.copy()
+    for fx, _ in paths:
+        np.minimum(fx_min, fx, out=fx_min)
+    return fx, fx_min
+
+
+def mc_bridge(
+    fx1, sigma1, drift, v, ro, maturity, t_steps, steps, trials, strike,
+    antithetic=False, normals=None, dtype=np.float64,
+):
+    """simulates the same process as `mc_terminal` on a coarse grid of `steps` steps, and
+    accounts for the knock-out at the `t_steps` (daily) monitoring dates in between using the
+    Brownian bridge: given the log FX rates `x0` and `x1` at the ends of a step of length `dt`,
+    a path crosses a barrier `h` below both with probability `exp(-2 (x0 - h) (x1 - h) / (vol**2 dt))`.
+    The barrier is shifted down by `analytic.BGK_BETA * vol * sqrt(maturity / t_steps)`, so that
+    crossing it continuously approximates crossing the strike at a monitoring date.
+
+    Returns the settlement FX rate and the probability that each path survives, i.e. the
+    weight of its payoff. `strike` can be an array of shape (scenarios,), like the other
+    parameters (see `mc_terminal`)."""
+    dtype = np.dtype(dtype)
+    fx1, sigma1, drift, v, ro, maturity, strike = (
+        np.asarray(x, dtype=np.float64) for x in (fx1, sigma1, drift, v, ro, maturity, strike)
+    )
+    scenarios = np.broadcast_shapes(
+        fx1.shape, sigma1.shape, drift.shape, v.shape, ro.shape, maturity.shape, strike.shape
+    )
+    log_strike = _broadcast(np.log(strike), scenarios, dtype)
+    shift = _broadcast(analytic.BGK_BETA * np.sqrt(maturity / t_steps), scenarios, dtype)
+    two_over_dt = _broadcast(2.0 * steps / maturity, scenarios, dtype)
+
+    paths = _paths(fx1, sigma1, drift, v, ro, maturity, steps, trials, antithetic, normals, dtype)
+    fx, _ = next(paths)
+    distance = np.log(fx)
+    distance -= log_strike  # log(fx / strike) at the start of the step
+    survival = (distance > 0).astype(dtype)
+    d0 = np.empty_like(distance)
+    d1 = np.empty_like(distance)
+    for fx, vol in paths:
+        # distances from the shifted barrier at both ends of the step
+        np.multiply(vol, shift, out=d1)
+        np.add(distance, d1, out=d0)
+        np.maximum(d0, 0, out=d0)
+        np.log(fx, out=distance)
+        distance -= log_strike
+        d1 += distance
+        # survival *= 1 - exp(-2 * d0 * d1 / (vol**2 * dt)), or 0 if d1 <= 0
+        np.maximum(d1, 0, out=d1)
+        d1 *= d0
+        d1 *= two_over_dt
+        np.multiply(vol, vol, out=d0)
+        d1 /= d0
+        np.negative(d1, out=d1)
+        np.expm1(d1, out=d1)
+        survival *= d1
+        np.negative(survival, out=survival)
+    return fx, survival
+
+
+def payoff(inputs, fx_terminal, knocked_out):
+    """returns the net settlement for each path given its settlement FX rate"""
+    fx_terminal = np.asarray(fx_terminal, dtype=np.float64)
+    settlement = (
+        inputs["warrantsNo"]
+        * inputs["notionalPerWarr"]
+        * np.maximum(0, fx_terminal / inputs["strike"] - 1)
+        / fx_terminal
+        * 1.000799081
+    )
+    settlement[knocked_out] = 0
+    return settlement
+
+
+def simulate_settlement(
+    inputs,
+    trials,
+    antithetic=False,
+    sampler="pseudo",
+    normals=None,
+    kernel="numpy",
+    precision="float64",
+    time_steps=None,
+):
+    """simulates `trials` paths and returns the net settlement and the settlement FX
+    rate for each path. `sampler` is either "pseudo" (pseudo-random draws) or "sobol"
+    (quasi-random draws with a Brownian bridge); alternatively pre-generated `normals`
+    can be passed, e.g. to share them across trades (see `mc_simulation`).
+
+    `kernel` is either "numpy" (`mc_terminal`, which supports `precision` "float32"),
+    "numba" (see `numba_kernel`; falls back to "numpy" if numba is not installed) or
+    "reference" (`mc_simulation` with the original, path-by-path payoff).
+
+    If `time_steps` is less than `inputs["t_steps"]`, paths are simulated on a grid of
+    `time_steps` steps, with the knock-out at the monitoring dates in between accounted for
+    by weighting the payoff of each path with its survival probability (see `mc_bridge`);
+    this is only supported by the "numpy" kernel."""
+    t_steps = int(inputs["t_steps"])
+    steps = t_steps if time_steps is None else min(int(time_steps), t_steps)
+    if normals is None and sampler == "sobol":
+        normals = qmc.sobol_normals(steps, trials // 2 if antithetic else trials)
+    elif normals is None and sampler != "pseudo":
+        raise ValueError(f"Unknown sampler: {sampler}")
+    if precision not in ["float64", "float32"]:
+        raise ValueError(f"Unknown precision: {precision}")
+
+    if kernel == "numba" and not numba_kernel.available:
+        kernel = "numpy"
+    if steps < t_steps and kernel != "numpy":
+        raise ValueError(f"{kernel} kernel doesn't support time_steps")
+    if steps < t_steps:
+        fx_terminal, survival = mc_bridge(
+            inputs["fx1"],
+            inputs["sigma1"],
+            inputs["drift"],
+            inputs["v"],
+            inputs["ro"],
+            inputs["maturity"],
+            t_steps,
+            steps,
+            trials,
+            inputs["strike"],
+            antithetic,
+            normals,
+            precision,
+        )
+        settlement = payoff(inputs, fx_terminal, survival == 0)
+        settlement *= survival
+        return settlement, fx_terminal.astype(np.float64)
+
+    if kernel == "numba":
+        if precision != "float64":
+            raise ValueError("numba kernel only supports float64 precision")
+        return numba_kernel.simulate_settlement(inputs, trials, antithetic, normals)
+    elif kernel == "numpy":
+        fx_terminal, fx_min = mc_terminal(
+            inputs["fx1"],
+            inputs["sigma1"],
+            inputs["drift"],
+            inputs["v"],
+            inputs["ro"],
+            inputs["maturity"],
+            t_steps,
+            trials,
+            antithetic,
+            normals,
+            precision,
+        )
+        return payoff(inputs, fx_terminal, fx_min < inputs["strike"]), fx_terminal.astype(np.float64)
+    elif kernel == "reference":
+        if precision != "float64":
+            raise ValueError("reference kernel only supports float64 precision")
+        return _reference_settlement(inputs, trials, antithetic, normals)
+    else:
+        raise ValueError(f"Unknown kernel: {kernel}")
+
+
+def _reference_settlement(inputs, trials, antithetic, normals):
     """ Monte Carlo Model Parameters """
     fx1 = inputs["fx1"]
     # EURGBP as of 29/12/2017: 0.888085  for FX High: 0.88944 FX Low: 0.88673
@@ -64,7 +319,6 @@ def price_option(inputs):
     t_steps = inputs[
         "t_steps"
     ]  # number of working days between 29/12/2017 and 08/03/2018
-    trials = inputs["trials"]
 
     """ Calibrated Parameters"""
     sigma1 = inputs["sigma1"]
@@ -81,7 +335,7 @@ def price_option(inputs):
 
     """ Monte Carlo Model"""
     Simulation = mc_simulation(
-        fx1, sigma1, drift, v, ro, maturity, t_steps, trials
+        fx1, sigma1, drift, v, ro, maturity, t_steps, trials, antithetic, normals
     )  # calling the MC function
     # print(Simulation)
 
@@ -167,15 +421,232 @@ def price_option(inputs):
 
     # netSettlement netSettlement[i] = (cashSetAm[i] - warrantsPrice) * np.exp(-drift * delta.days / 365) =
     #   Cash Settlement(t0) - Warrant Price(t0)
-    return (netSettlement.mean(), (time.time() - start_time))
+    return netSettlement, np.asarray(settlementRate)
+
+
+class _RunningMoments:
+    """streaming mean and co-moments of the columns of blocks of samples (Chan et al.)"""
+
+    def __init__(self, dim):
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros((dim, dim))
+
+    def update(self, block):
+        n = len(block)
+        block_mean = block.mean(axis=0)
+        centered = block - block_mean
+        total = self.count + n
+        diff = block_mean - self.mean
+        self.mean += diff * n / total
+        self.m2 += centered.T @ centered + np.outer(diff, diff) * self.count * n / total
+        self.count = total
+
+    def estimate(self, control_mean=None):
+        """returns the mean of the first column and its standard error; if `control_mean`
+        is specified, the second column is used as a control variate with that expectation"""
+        if self.count < 2:
+            return self.mean[0], np.nan
+        cov = self.m2 / (self.count - 1)
+        if control_mean is None or cov[1, 1] == 0:
+            return self.mean[0], np.sqrt(cov[0, 0] / self.count)
+        beta = cov[0, 1] / cov[1, 1]
+        variance = max(cov[0, 0] - beta * cov[0, 1], 0.0)
+        return self.mean[0] - beta * (self.mean[1] - control_mean), np.sqrt(variance / self.count)
+
+
+def _trade_option(inputs, name, default):
+    """returns a per-trade override for option `name`, if the trade has such a column"""
+    value = inputs.get(name)
+    if value is None or pd.isna(value):
+        return default
+    return bool(value)
+
+
+def _samples(inputs, trials, antithetic, **kwargs):
+    """returns the (net settlement, settlement FX rate) samples for `trials` paths; with
+    `antithetic`, each sample is the average over a pair of antithetic paths"""
+    settlement, fx_terminal = simulate_settlement(inputs, trials, antithetic, **kwargs)
+    samples = np.column_stack((settlement, fx_terminal))
+    if antithetic:
+        half = trials // 2
+        samples = 0.5 * (samples[:half] + samples[half:])
+    return samples
+
+
+def price(
+    inputs,
+    target_stderr=None,
+    max_trials=None,
+    trials_block=1000,
+    antithetic=False,
+    control_variate=False,
+    sampler="pseudo",
+    kernel="numpy",
+    precision="float64",
+    time_steps=None,
+):
+    """prices the option and returns a dict with the PV, its standard error and the
+    number of paths simulated.
+
+    By default, exactly `inputs["trials"]` paths are simulated. If `target_stderr` is
+    specified, paths are simulated in blocks of `trials_block` until the standard error
+    of the PV is at most `target_stderr` or `max_trials` (default: `inputs["trials"]`)
+    paths have been simulated.
+
+    Variance reduction: `antithetic` pairs each path with one driven by the negated
+    draws; `control_variate` uses the settlement FX rate, whose expectation is
+    `fx1 * exp(drift * maturity)`, as a control. Both can be overridden per trade with
+    `antithetic` / `control_variate` columns.
+
+    `sampler` selects "pseudo" random or "sobol" quasi-random path generation. Each
+    block is an independently scrambled point set; the reported standard error treats
+    the paths as independent and is therefore conservative for "sobol".
+
+    `kernel` and `precision` select the simulation kernel, and `time_steps` a coarser
+    simulation grid (see `simulate_settlement`).
+    """
+    antithetic = _trade_option(inputs, "antithetic", antithetic)
+    control_variate = _trade_option(inputs, "control_variate", control_variate)
+    control_mean = (
+        inputs["fx1"] * np.exp(inputs["drift"] * inputs["maturity"]) if control_variate else None
+    )
+
+    trials = int(inputs["trials"])
+    if target_stderr is None:
+        max_trials, trials_block = trials, trials
+    elif max_trials is None:
+        max_trials = trials
+    if max_trials < 1:
+        raise ValueError(f"trials must be positive, got {max_trials}")
+
+    moments = _RunningMoments(2)
+    trials_used = 0
+    while trials_used < max_trials:
+        block = min(trials_block, max_trials - trials_used)
+        if antithetic:
+            block += block % 2
+        moments.update(
+            _samples(
+                inputs, block, antithetic, sampler=sampler, kernel=kernel, precision=precision, time_steps=time_steps
+            )
+        )
+        trials_used += block
+        pv, stderr = moments.estimate(control_mean)
+        if target_stderr is not None and stderr <= target_stderr:
+            break
+    return {"pv": pv, "pv_stderr": stderr, "trials_used": trials_used}
+
+
+# trade parameters that can be shocked by `price_scenarios`
+SCENARIO_PARAMETERS = ["fx1", "sigma1", "drift", "v", "ro", "strike", "notionalPerWarr", "warrantsNo"]
+
+
+def scenario_grid(ladder: dict) -> list:
+    """returns the list of scenarios, i.e. the cartesian product of the shocks in `ladder`,
+    each a dict of parameter name to relative shock"""
+    for parameter in ladder:
+        if parameter not in SCENARIO_PARAMETERS:
+            raise ValueError(f"Invalid scenario parameter: {parameter}")
+    return [dict(zip(ladder, shocks)) for shocks in itertools.product(*ladder.values())]
+
+
+def price_scenarios(
+    inputs,
+    ladder,
+    antithetic=False,
+    control_variate=False,
+    sampler="pseudo",
+    precision="float64",
+    time_steps=None,
+):
+    """prices the option under every scenario of the risk ladder `ladder`, a dict of
+    parameter name (see `SCENARIO_PARAMETERS`) to a list of relative shocks, e.g.
+    `{"fx1": [-0.01, 0, 0.01], "sigma1": [-0.1, 0, 0.1]}` for 9 scenarios. All scenarios
+    are simulated in one batch from the same random numbers (using `mc_terminal`, or
+    `mc_bridge` on a grid of `time_steps` steps).
+    Returns a list with a dict with the PV and its standard error for each scenario, in
+    the order of `scenario_grid(ladder)`."""
+    antithetic = _trade_option(inputs, "antithetic", antithetic)
+    control_variate = _trade_option(inputs, "control_variate", control_variate)
+    grid = scenario_grid(ladder)
+    params = {
+        name: np.array([inputs[name] * (1 + shocks.get(name, 0)) for shocks in grid])
+        for name in SCENARIO_PARAMETERS
+    }
+
+    trials = int(inputs["trials"])
+    trials += trials % 2 if antithetic else 0
+    t_steps = int(inputs["t_steps"])
+    steps = t_steps if time_steps is None else min(int(time_steps), t_steps)
+    normals = None
+    if sampler == "sobol":
+        normals = qmc.sobol_normals(steps, trials // 2 if antithetic else trials)
+    elif sampler != "pseudo":
+        raise ValueError(f"Unknown sampler: {sampler}")
+
+    columns = {name: value[:, None] for name, value in params.items()}
+    if steps < t_steps:
+        fx_terminal, survival = mc_bridge(
+            params["fx1"],
+            params["sigma1"],
+            params["drift"],
+            params["v"],
+            params["ro"],
+            inputs["maturity"],
+            t_steps,
+            steps,
+            trials,
+            params["strike"],
+            antithetic,
+            normals,
+            precision,
+        )
+        settlement = payoff(columns, fx_terminal, survival == 0)
+        settlement *= survival
+    else:
+        fx_terminal, fx_min = mc_terminal(
+            params["fx1"],
+            params["sigma1"],
+            params["drift"],
+            params["v"],
+            params["ro"],
+            inputs["maturity"],
+            t_steps,
+            trials,
+            antithetic,
+            normals,
+            precision,
+        )
+        settlement = payoff(columns, fx_terminal, fx_min < columns["strike"])
+
+    results = []
+    for index in range(len(grid)):
+        samples = np.column_stack((settlement[index], fx_terminal[index].astype(np.float64)))
+        if antithetic:
+            samples = 0.5 * (samples[: trials // 2] + samples[trials // 2:])
+        moments = _RunningMoments(2)
+        moments.update(samples)
+        control_mean = (
+            params["fx1"][index] * np.exp(params["drift"][index] * inputs["maturity"]) if control_variate else None
+        )
+        pv, stderr = moments.estimate(control_mean)
+        results.append({"pv": pv, "pv_stderr": stderr})
+    return results
+
+
+def price_option(inputs, **kwargs):
+    """returns the PV and the time taken to compute it; see `price` for options"""
+    start_time = time.time()
+    return (price(inputs, **kwargs)["pv"], (time.time() - start_time))
 
 
-def risk(parameter, inputs, alpha=0.01):
+def risk(parameter, inputs, alpha=0.01, **kwargs):
     delta = inputs[parameter] * alpha
     inputs[parameter] += delta
-    PV_up = price_option(inputs)[0]
+    PV_up = price_option(inputs, **kwargs)[0]
     inputs[parameter] -= 2 * delta
-    PV_down = price_option(inputs)[0]
+    PV_down = price_option(inputs, **kwargs)[0]
     inputs[parameter] += delta
     sensi = (PV_up - PV_down) / 2 / delta / 10000
     return sensi
@@ -0,0 +1,107 @@
+r"""
+optional JIT-compiled simulation kernel. Simulation, knock-out check and payoff are fused
+into a single pass per path, and paths are distributed across threads. `available` is
+False if numba is not installed.
+"""
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+
+_TILE = 256  # paths simulated together by one thread
+
+
+if available:
+
+    @numba.njit(cache=True)
+    def _payoff(fx, fx_min, strike, scale):
+        if fx_min < strike:
+            return 0.0
+        return scale * max(0.0, fx / strike - 1.0) / fx
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _simulate(
+        fx1, sigma1, vol_drift, vol_z1, vol_z2, fx_drift, fx_var, sqrt_dt, t_steps,
+        strike, scale, antithetic, normals, seed, settlement, fx_terminal,
+    ):
+        paths = settlement.shape[0] // 2 if antithetic else settlement.shape[0]
+        use_normals = normals.shape[2] > 0
+        # each tile of paths is carried through all time steps while its state stays in cache;
+        # path `i + paths` is the antithetic twin of path `i`, driven by the negated draws
+        twins = 2 if antithetic else 1
+        tiles = (paths + _TILE - 1) // _TILE
+        for tile in numba.prange(tiles):
+            if not use_normals:
+                # the generators are per thread: seed the thread's for each tile, so that the
+                # draws don't depend on which thread simulates which tile
+                np.random.seed(seed + tile)
+            begin = tile * _TILE
+            size = min(_TILE, paths - begin)
+            vol = np.full((twins, size), sigma1)
+            fx = np.full((twins, size), fx1)
+            fx_min = np.full((twins, size), fx1)
+            z1 = np.empty(size)
+            z2 = np.empty(size)
+            for t in range(t_steps):
+                for j in range(size):
+                    if use_normals:
+                        z1[j] = normals[0, t, begin + j]
+                        z2[j] = normals[1, t, begin + j]
+                    else:
+                        z2[j] = np.random.standard_normal()
+                        z1[j] = np.random.standard_normal()
+                for k in range(twins):
+                    sign = 1.0 - 2.0 * k
+                    for j in range(size):
+                        vol[k, j] *= math.exp(vol_drift + sign * (vol_z1 * z1[j] + vol_z2 * z2[j]))
+                        fx[k, j] *= math.exp(
+                            fx_drift + fx_var * vol[k, j] * vol[k, j] + sign * vol[k, j] * z1[j] * sqrt_dt
+                        )
+                        fx_min[k, j] = min(fx_min[k, j], fx[k, j])
+            for k in range(twins):
+                for j in range(size):
+                    i = begin + j + k * paths
+                    fx_terminal[i] = fx[k, j]
+                    settlement[i] = _payoff(fx[k, j], fx_min[k, j], strike, scale)
+
+
+def simulate_settlement(inputs, trials, antithetic=False, normals=None):
+    """same as `montecarlo.simulate_settlement` using the compiled kernel. Random numbers
+    are drawn from numba's per-thread generators, seeded per tile of paths from `np.random`,
+    so that results are reproducible whatever the number of threads; they are statistically,
+    but not path-by-path, equivalent to the other kernels."""
+    assert available
+    assert not antithetic or trials % 2 == 0
+    seed = 0
+    if normals is None:
+        normals = np.empty((2, 0, 0))
+        seed = np.random.randint(1 << 31)
+    dt = float(inputs["maturity"]) / inputs["t_steps"]
+    v, ro = float(inputs["v"]), float(inputs["ro"])
+    settlement = np.empty(trials)
+    fx_terminal = np.empty(trials)
+    _simulate(
+        float(inputs["fx1"]),
+        float(inputs["sigma1"]),
+        -0.5 * v**2 * dt,
+        v * ro * math.sqrt(dt),
+        v * math.sqrt(1 - ro**2) * math.sqrt(dt),
+        float(inputs["drift"]) * dt,
+        -0.5 * dt,
+        math.sqrt(dt),
+        int(inputs["t_steps"]),
+        float(inputs["strike"]),
+        float(inputs["warrantsNo"] * inputs["notionalPerWarr"] * 1.000799081),
+        antithetic,
+        np.ascontiguousarray(normals, dtype=np.float64),
+        seed,
+        settlement,
+        fx_terminal,
+    )
+    return settlement, fx_terminal
@@ -0,0 +1,211 @@
+r"""
+runs the generator -> split -> azfinsim -> concat workflow in a single process. Trades are generated
+a shard (the equivalent of a split file) at a time, priced, and the results handed to a single
+writer, with the stages connected by bounded queues instead of files. The generate and write stages
+run in background threads, so that they overlap with pricing. The output of each stage can
+optionally be written to disk, using the same file names as the individual tools.
+"""
+import logging
+import os
+import os.path
+import queue
+import threading
+import time
+
+from . import azfinsim, costmodel, metrics
+from .dbase import TradesCacheFile
+from .trades import ResultBatch, TradeBatch
+from .utils import GenerateTradesSeeded
+
+log = logging.getLogger(__name__)
+
+# config for metrics
+_metrics_config = {
+    "execution_time": {
+        "description": "process execution time",
+        "unit": "s",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+    "compute_time": {
+        "description": "Time to calculate PV, Delta, and Vega or Synthetic computation",
+        "unit": "s",
+        "type": "float",
+        "aggregation": "sum",
+    },
+    "out_of_band": {
+        "description": "trades outside the validity band of the analytic pricer",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "sum",
+    },
+    "throughput": {
+        "description": "trades processed per second",
+        "unit": "1/s",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+}
+
+_DONE = None  # marks the end of the items on a queue
+
+
+def check_args(args):
+    if args.start_trade is None:
+        args.start_trade = 0
+        log.info("{:10}: --start-trade=0".format("AUTO_ARG"))
+    if args.trade_window is None or args.trade_window < 1:
+        raise ValueError("trade_window must be specified")
+    if args.shard_size < 1:
+        raise ValueError("shard_size must be positive")
+    if args.queue_size < 1:
+        raise ValueError("queue_size must be positive")
+    if args.materialize and args.output_path is None:
+        raise ValueError("output_path must be specified to materialize stages")
+    azfinsim.check_pricing_args(args)
+
+
+class _Stage(threading.Thread):
+    """runs a stage in a background thread; `join` re-raises the exception the stage raised, if any"""
+
+    def __init__(self, name: str, target, *args):
+        super().__init__(name=name, target=target, args=args, daemon=True)
+        self._error = None
+
+    def run(self):
+        try:
+            super().run()
+        except BaseException as e:
+            self._error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self._error is not None:
+            raise self._error
+
+
+def _output(args, name: str) -> TradesCacheFile:
+    return TradesCacheFile(os.path.join(args.output_path, name), mode="w", compression=args.cache_compression)
+
+
+def _generate(args, shards: list, trades_queue: queue.Queue):
+    """generates the trades of each shard, and puts `(index, trades)` on the queue"""
+    try:
+        trades_file = _output(args, "trades.csv") if "trades" in args.materialize else None
+        for index, (begin, end) in enumerate(shards):
+            log.info("{:10}: shard {} trades {}-{}".format("GENERATE", index, begin, end - 1))
+            trades = GenerateTradesSeeded(args.seed or 0, begin, end - begin)
+            if trades_file is not None:
+                trades_file.set_trades(trades)
+            if "shards" in args.materialize:
+                _output(args, "trades.{}.csv".format(index)).set_trades(trades)
+            trades_queue.put((index, trades))
+    finally:
+        trades_queue.put(_DONE)
+
+
+def _write(args, results_queue: queue.Queue):
+    """writes (or discards) the results of each shard"""
+    error = None
+    merged = None
+    for index, results in iter(results_queue.get, _DONE):
+        if error is not None:
+            continue  # keep draining the queue, so that pricing isn't blocked
+        try:
+            if "results" in args.materialize:
+                _output(args, "trades.{}.results.csv".format(index)).set_trades(results)
+            if "merged" in args.materialize:
+                if merged is None:
+                    merged = _output(args, "results.csv")
+                merged.set_trades(results)
+        except Exception as e:
+            error = e
+    if error is not None:
+        raise error
+
+
+def execute(args):
+    # validate and sanitize args
+    check_args(args)
+
+    log.info("{:10}: pipeline starting".format("BEGIN"))
+
+    # setup metrics
+    metrics.define_measurements_and_views(_metrics_config)
+
+    if args.materialize:
+        os.makedirs(args.output_path, exist_ok=True)
+
+    start_trade = args.start_trade
+    stop_trade = start_trade + args.trade_window
+    shards = [
+        (begin, min(begin + args.shard_size, stop_trade))
+        for begin in range(start_trade, stop_trade, args.shard_size)
+    ]
+    log.info(
+        "{:10}: start_trade={}, stop_trade={}, shards={}, materialize={}".format(
+            "CONFIG", start_trade, stop_trade, len(shards), ",".join(args.materialize) or "none"
+        )
+    )
+
+    options = azfinsim.mc_options(args)
+    cost_model = costmodel.load(args.cost_model)
+    cost_profile = costmodel.profile(args)
+    pool = azfinsim.worker_pool(args, options) if args.workers > 1 else None
+
+    trades_queue = queue.Queue(maxsize=args.queue_size)
+    results_queue = queue.Queue(maxsize=args.queue_size)
+    generator = _Stage("generate", _generate, args, shards, trades_queue)
+    writer = _Stage("write", _write, args, results_queue)
+
+    start_ts = time.perf_counter()
+    generator.start()
+    writer.start()
+    count = 0
+    try:
+        for index, trades in iter(trades_queue.get, _DONE):
+            tradenums = trades["tradenum"].tolist()
+            batch = TradeBatch.from_frame(trades)
+            units = costmodel.trade_units(
+                batch, args.algorithm, args.scenarios, azfinsim.analytic_band(args), args.time_steps
+            )
+            units = dict(zip(tradenums, units))
+            pending = {tradenum: (trade, None) for tradenum, trade in zip(tradenums, batch)}
+            rows = {}
+            for tradenum, row_s, compute_ts in azfinsim.compute_all(
+                args, batch, pending, options, pool, cost_model, units
+            ):
+                metrics.put("compute_time", compute_ts)
+                cost_model.observe(cost_profile, units[tradenum], compute_ts)
+                rows[tradenum] = row_s
+
+            results = ResultBatch()
+            for tradenum in tradenums:
+                results.append(rows[tradenum])
+            results_queue.put((index, results.to_frame()))
+
+            count += len(tradenums)
+            log.info(
+                "{:10}: shard {} ({} trades, {:.1f} trades/s)".format(
+                    "PRICE", index, len(tradenums), count / (time.perf_counter() - start_ts)
+                )
+            )
+    finally:
+        results_queue.put(_DONE)
+    generator.join()
+    writer.join()
+    end_ts = time.perf_counter()
+
+    if pool is not None:
+        pool.shutdown()
+    if args.cost_model is not None:
+        cost_model.save(args.cost_model)
+
+    timedelta = end_ts - start_ts
+    log.info("{:10}: {} trades in {:.5}s ({:.1f} trades/s)".format("EXEC_TIME", count, timedelta, count / timedelta))
+    metrics.put("execution_time", timedelta)
+    metrics.put("throughput", count / timedelta)
+    log.info("{:10}: pipeline complete".format("END"))
+
+    # flush metrics
+    metrics.record()
@@ -0,0 +1,172 @@
+r"""
+quasi-Monte Carlo path generation: scrambled Sobol points, transformed to standard
+normals and assembled into paths using a Brownian bridge.
+
+Uses `scipy.stats.qmc` when available. Otherwise, an in-package Sobol generator is used
+for the leading (most important) Brownian bridge dimensions and the remaining ones are
+padded with pseudo-random numbers.
+"""
+import functools
+import logging
+import warnings
+
+import numpy as np
+
+try:
+    from scipy.stats import qmc as _scipy_qmc
+    from scipy.special import ndtri as _scipy_ndtri
+except ImportError:
+    _scipy_qmc = None
+
+log = logging.getLogger(__name__)
+
+# primitive polynomial degree (s), coefficients (a) and initial direction numbers (m)
+# for Sobol dimensions 2, 3, ... (Joe & Kuo, new-joe-kuo-6.21201)
+_DIRECTIONS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+]
+_BITS = 32
+MAX_BUILTIN_DIMS = len(_DIRECTIONS) + 1
+
+
+@functools.lru_cache(maxsize=None)
+def _direction_numbers(dims: int) -> np.ndarray:
+    """returns the (dims, _BITS) direction numbers, scaled to _BITS bits"""
+    v = np.zeros((dims, _BITS), dtype=np.uint64)
+    v[0] = [1 << (_BITS - 1 - i) for i in range(_BITS)]
+    for d in range(1, dims):
+        s, a, m = _DIRECTIONS[d - 1]
+        vd = [m[i] << (_BITS - 1 - i) for i in range(s)]
+        for i in range(s, _BITS):
+            value = vd[i - s] ^ (vd[i - s] >> s)
+            for k in range(1, s):
+                if (a >> (s - 1 - k)) & 1:
+                    value ^= vd[i - k]
+            vd.append(value)
+        v[d] = vd
+    return v
+
+
+def _builtin_sobol(n: int, dims: int) -> np.ndarray:
+    """returns the first `n` points of the `dims`-dimensional Sobol sequence, randomized
+    with a random digital shift"""
+    if n > 1 << _BITS:
+        raise ValueError(f"too many Sobol points: {n}")
+    v = _direction_numbers(dims)
+    index = np.arange(n, dtype=np.uint64)
+    points = np.zeros((n, dims), dtype=np.uint64)
+    for bit in range(max(int(n - 1).bit_length(), 1)):
+        mask = ((index >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        points[mask] ^= v[:, bit]
+    points ^= np.random.randint(0, 1 << _BITS, size=dims, dtype=np.uint64)
+    return (points.astype(np.float64) + 0.5) / float(1 << _BITS)
+
+
+def sobol(n: int, dims: int) -> np.ndarray:
+    """returns `n` scrambled Sobol points in `dims` dimensions; with the in-package
+    generator, only the first MAX_BUILTIN_DIMS dimensions are quasi-random"""
+    if _scipy_qmc is not None:
+        sampler = _scipy_qmc.Sobol(d=dims, scramble=True, seed=np.random.randint(1 << 32, dtype=np.uint64))
+        with warnings.catch_warnings():
+            # balance properties are best for powers of 2, but any count is valid
+            warnings.simplefilter("ignore", UserWarning)
+            return sampler.random(n)
+    qdims = min(dims, MAX_BUILTIN_DIMS)
+    return np.hstack((_builtin_sobol(n, qdims), np.random.random_sample((n, dims - qdims))))
+
+
+# coefficients for the inverse normal cdf (P. J. Acklam)
+_A = [-3.969683028665376e01, 2.209460984245205e02, -2.759285104469687e02,
+      1.383577518672690e02, -3.066479806614716e01, 2.506628277459239e00]
+_B = [-5.447609879822406e01, 1.615858368580409e02, -1.556989798598866e02,
+      6.680131188771972e01, -1.328068155288572e01]
+_C = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e00,
+      -2.549671010229528e00, 4.374664141464968e00, 2.938163982698783e00]
+_D = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e00,
+      3.754408661907416e00]
+_P_LOW = 0.02425
+
+
+def normal_ppf(u: np.ndarray) -> np.ndarray:
+    """inverse of the standard normal cdf"""
+    u = np.clip(u, 2.0**-53, 1.0 - 2.0**-53)
+    if _scipy_qmc is not None:
+        return _scipy_ndtri(u)
+
+    z = np.empty_like(u)
+    tail = np.minimum(u, 1.0 - u)
+    central = tail >= _P_LOW
+
+    q = u[central] - 0.5
+    r = q * q
+    z[central] = (
+        (((((_A[0] * r + _A[1]) * r + _A[2]) * r + _A[3]) * r + _A[4]) * r + _A[5]) * q
+        / (((((_B[0] * r + _B[1]) * r + _B[2]) * r + _B[3]) * r + _B[4]) * r + 1.0)
+    )
+
+    q = np.sqrt(-2.0 * np.log(tail[~central]))
+    z_tail = (
+        (((((_C[0] * q + _C[1]) * q + _C[2]) * q + _C[3]) * q + _C[4]) * q + _C[5])
+        / ((((_D[0] * q + _D[1]) * q + _D[2]) * q + _D[3]) * q + 1.0)
+    )
+    z[~central] = np.where(u[~central] < 0.5, z_tail, -z_tail)
+    return z
+
+
+@functools.lru_cache(maxsize=None)
+def _bridge_plan(t_steps: int) -> list:
+    """returns the Brownian bridge construction order over `t_steps` unit steps as a list
+    of (index, left, right, left weight, right weight, stddev), coarse to fine"""
+    plan = [(t_steps, 0, 0, 0.0, 0.0, np.sqrt(t_steps))]
+    intervals = [(0, t_steps)]
+    while intervals:
+        left, right = intervals.pop(0)
+        if right - left < 2:
+            continue
+        mid = (left + right) // 2
+        plan.append(
+            (
+                mid,
+                left,
+                right,
+                (right - mid) / (right - left),
+                (mid - left) / (right - left),
+                np.sqrt((mid - left) * (right - mid) / (right - left)),
+            )
+        )
+        intervals += [(left, mid), (mid, right)]
+    return plan
+
+
+def brownian_bridge(z: np.ndarray, t_steps: int) -> np.ndarray:
+    """builds Brownian paths from `z` (shape (t_steps, n)), where row `k` drives the
+    `k`-th point in the bridge construction order, and returns the per-step standard
+    normal increments (shape (t_steps, n))"""
+    w = np.zeros((t_steps + 1, z.shape[1]))
+    for k, (index, left, right, wl, wr, sd) in enumerate(_bridge_plan(t_steps)):
+        w[index] = wl * w[left] + wr * w[right] + sd * z[k]
+    return np.diff(w, axis=0)
+
+
+def sobol_normals(t_steps: int, n: int, drivers: int = 2) -> np.ndarray:
+    """returns standard normal increments of shape (drivers, t_steps, n) for `n` paths of
+    `drivers` Brownian motions. The Sobol dimensions are assigned in bridge order,
+    interleaving the drivers, so the leading dimensions determine the coarse path shape.
+    These depend only on `t_steps` and `n`, so they can be shared across trades."""
+    u = sobol(n, t_steps * drivers)
+    z = normal_ppf(u).T.reshape(t_steps, drivers, n)
+    return np.stack([brownian_bridge(z[:, d, :], t_steps) for d in range(drivers)])
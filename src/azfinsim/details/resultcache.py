@@ -0,0 +1,198 @@
+r"""
+memoization of pricing results. Results are keyed on a stable hash of the trade's pricing
+inputs (all trade columns but the trade number), the algorithm and its options, the model
+version and the random seed, so unchanged trades need not be repriced on later runs.
+"""
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+from redis.cluster import RedisCluster
+
+from . import metrics
+from .dbase import redis_client, trade_version
+from .montecarlo import MODEL_VERSION
+
+log = logging.getLogger(__name__)
+
+_metrics_config = {
+    "result_cache_hits": {
+        "description": "Results found in the result cache",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "sum",
+    },
+    "result_cache_misses": {
+        "description": "Results not found in the result cache",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "sum",
+    },
+}
+
+
+def result_key(trade: dict, algorithm: str, options: dict, seed=None, version: str = None) -> str:
+    """returns the cache key for the result of pricing `trade`; `version` is the trade's
+    `trade_version`, if already known"""
+    version = trade_version(trade) if version is None else version
+    payload = json.dumps([version, algorithm, options, MODEL_VERSION, seed], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self):
+        metrics.define_measurements_and_views(_metrics_config)
+
+    def get(self, key: str):
+        """returns the cached result or None"""
+        value = self._get(key)
+        metrics.put("result_cache_misses" if value is None else "result_cache_hits", 1)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key: str, result) -> None:
+        self._set(key, pickle.dumps(result))
+
+    def get_many(self, keys: list) -> list:
+        """returns the cached results for the keys, None for those not found"""
+        values = self._get_many(keys)
+        hits = sum(value is not None for value in values)
+        metrics.put("result_cache_hits", hits)
+        metrics.put("result_cache_misses", len(values) - hits)
+        return [None if value is None else pickle.loads(value) for value in values]
+
+    def set_many(self, results: dict) -> None:
+        """caches the results, a mapping of keys to results"""
+        self._set_many({key: pickle.dumps(result) for key, result in results.items()})
+
+    def flush(self) -> None:
+        """persists the results set (and, for caches that track it, the accesses) so far"""
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _get(self, key: str) -> bytes:
+        raise RuntimeError("Not implemented")
+
+    def _set(self, key: str, value: bytes) -> None:
+        raise RuntimeError("Not implemented")
+
+    def _get_many(self, keys: list) -> list:
+        return [self._get(key) for key in keys]
+
+    def _set_many(self, values: dict) -> None:
+        for key, value in values.items():
+            self._set(key, value)
+
+
+class ResultCacheRedis(ResultCache):
+    """stores results in redis, under a separate key namespace; entries expire after
+    `ttl` seconds (LRU eviction is left to the server's maxmemory-policy)"""
+
+    def __init__(self, redis_client, ttl: int, namespace: str = "resultcache:{}"):
+        super().__init__()
+        self._redis_client = redis_client
+        self._ttl = ttl
+        self._namespace = namespace
+
+    def _get(self, key: str) -> bytes:
+        return self._redis_client.get(self._namespace.format(key))
+
+    def _set(self, key: str, value: bytes) -> None:
+        self._redis_client.set(self._namespace.format(key), value, ex=self._ttl)
+
+    def _get_many(self, keys: list) -> list:
+        if not keys:
+            return []
+        names = [self._namespace.format(key) for key in keys]
+        if isinstance(self._redis_client, RedisCluster):
+            # the keys are spread over the slots of the cluster
+            return self._redis_client.mget_nonatomic(names)
+        return self._redis_client.mget(names)
+
+    def _set_many(self, values: dict) -> None:
+        if not values:
+            return
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(self._namespace.format(key), value, ex=self._ttl)
+        pipeline.execute()
+
+
+class ResultCacheFile(ResultCache):
+    """stores results in a local sqlite database; entries expire after `ttl` seconds and
+    the least recently used entries are evicted beyond `max_entries`. Changes are committed,
+    and entries evicted, by `flush`, e.g. once per batch of trades"""
+
+    def __init__(self, fname: str, ttl: int, max_entries: int):
+        super().__init__()
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._db.execute("DELETE FROM results WHERE created < ?", (time.time() - ttl,))
+        self._db.commit()
+
+    def _get(self, key: str) -> bytes:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ? AND created >= ?", (key, now - self._ttl)
+            ).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+        return None if row is None else row[0]
+
+    def _get_many(self, keys: list) -> list:
+        return [self._get(key) for key in keys]
+
+    def _set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, value, now, now)
+            )
+
+    def _set_many(self, values: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in values.items()],
+            )
+
+    def flush(self) -> None:
+        with self._lock:
+            excess = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self._max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)",
+                    (excess,),
+                )
+            self._db.commit()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+
+def connect(args) -> ResultCache:
+    """returns the result cache selected by the command line arguments, or None"""
+    if args.result_cache == "none":
+        return None
+    elif args.result_cache == "redis":
+        return ResultCacheRedis(redis_client(args), args.result_cache_ttl)
+    elif args.result_cache == "file":
+        return ResultCacheFile(args.result_cache_path, args.result_cache_ttl, args.result_cache_size)
+    else:
+        raise RuntimeError(f"Invalid result cache: {args.result_cache}")
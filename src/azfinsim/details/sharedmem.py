@@ -0,0 +1,67 @@
+r"""
+typed column arrays in shared memory, used to hand batches of trades to worker processes
+and to collect their results without pickling them through the pool's queues.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_ALIGN = 64  # column offsets are aligned to cache lines
+
+
+class SharedColumns:
+    """named column arrays laid out in a single shared memory block. The block is created
+    (and finally unlinked) by one process; other processes attach to it using `spec`."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, layout: list, owner: bool):
+        self._shm = shm
+        self._owner = owner
+        self.spec = shm.name, layout
+        self.columns = {
+            name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in layout
+        }
+
+    @classmethod
+    def create(cls, columns: dict) -> "SharedColumns":
+        """creates a block for `columns`, a dict of name to either an array (copied into
+        the block) or a `(shape, dtype)` tuple (left uninitialized)"""
+        layout = []
+        size = 0
+        for name, column in columns.items():
+            shape, dtype = (column.shape, column.dtype) if isinstance(column, np.ndarray) else column
+            dtype = np.dtype(dtype)
+            layout.append((name, dtype.str, tuple(shape), size))
+            size += -(-int(np.prod(shape)) * dtype.itemsize // _ALIGN) * _ALIGN
+        block = cls(shared_memory.SharedMemory(create=True, size=max(size, 1)), layout, owner=True)
+        for name, column in columns.items():
+            if isinstance(column, np.ndarray):
+                block.columns[name][...] = column
+        return block
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "SharedColumns":
+        name, layout = spec
+        return cls(shared_memory.SharedMemory(name=name), layout, owner=False)
+
+    def close(self) -> None:
+        # the arrays must be released before the buffer can be
+        self.columns = {}
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# the block a worker process is currently attached to
+_attached = None
+
+
+def attached(spec: tuple) -> SharedColumns:
+    """returns the block for `spec`, attaching to it (and detaching from the previous
+    block) if needed; meant to be called in worker processes"""
+    global _attached
+    if _attached is None or _attached.spec != spec:
+        if _attached is not None:
+            _attached.close()
+        _attached = SharedColumns.attach(spec)
+    return _attached
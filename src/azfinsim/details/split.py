@@ -1,8 +1,12 @@
 import logging
+import math
 import os, os.path
 import time
 
-from . import metrics
+import numpy as np
+
+from . import costmodel, metrics
+from .azfinsim import analytic_band
 from .dbase import connect
 
 log = logging.getLogger(__name__)
@@ -19,25 +23,39 @@ _metrics_config = {
 
 
 def check_args(args):
-    args.cache_type = "filesystem"
-    if args.cache_path is None:
-        raise ValueError("cache_path must be specified")
-    if args.output_path is None:
-        args.output_path = os.path.dirname(args.cache_path)
-        log.info("{:10}: --output-path={}".format("AUTO_ARG", args.output_path))
+    if args.cache_type is None:
+        # adjust default cache type
+        args.cache_type = "redis" if args.cache_path is None and args.cache_name is not None else "filesystem"
+        log.info("{:10}: --cache-type={}".format("AUTO_ARG", args.cache_type))
+    if args.cache_type == "redis":
+        if args.cache_name is None:
+            raise ValueError("cache_name must be specified for redis cache")
+    else:
+        if args.cache_path is None:
+            raise ValueError("cache_path must be specified")
+        if args.output_path is None:
+            args.output_path = os.path.dirname(args.cache_path)
+            log.info("{:10}: --output-path={}".format("AUTO_ARG", args.output_path))
+    if args.cache_hash_chunk is not None and args.cache_hash_chunk < 0:
+        raise ValueError("cache_hash_chunk must not be negative")
+    if args.cache_cluster and args.cache_type != "redis":
+        raise ValueError("cache_cluster requires redis cache")
     if args.trade_window is None or args.trade_window < 1:
         raise ValueError("trade_window must be specified")
+    if args.time_steps is not None and args.time_steps < 1:
+        raise ValueError("time_steps must be positive")
+    if args.split_by == "cost" and args.algorithm == "scenarios" and args.scenarios is None:
+        raise ValueError("scenarios must be specified for scenarios algorithm")
 
 
-def execute(args):
-    # validate and sanitize args
-    check_args(args)
+def _costs(args, model: costmodel.CostModel, trades) -> np.ndarray:
+    """returns the estimated compute cost of the trades, priced with the pricing arguments"""
+    units = costmodel.trade_units(trades, args.algorithm, args.scenarios, analytic_band(args), args.time_steps)
+    return model.estimate(costmodel.profile(args), units)
 
-    log.info("{:10}: split start".format("BEGIN"))
-
-    # setup metrics
-    metrics.define_measurements_and_views(_metrics_config)
 
+def _split_file(args):
+    """splits the trade file into files of `trade_window` trades (or of about equal cost)"""
     # -- open connection to dbase
     log.info("{:10}: connecting to {}".format("IN_CACHE", args.cache_path))
     dbase = connect(args, mode="r")
@@ -53,21 +71,83 @@ def execute(args):
     os.makedirs(args.output_path, exist_ok=True)
 
     trades = dbase.get_trades()
-    start_ts = time.perf_counter()
 
     # -- split trades into batches
-    for index, offset in enumerate(range(0, len(trades), args.trade_window)):
+    if args.split_by == "cost":
+        # same number of files, but cut so that each takes about the same time to process
+        model = costmodel.load(args.cost_model)
+        costs = _costs(args, model, trades)
+        shards = costmodel.partition(costs, math.ceil(len(trades) / args.trade_window))
+    else:
+        costs = None
+        shards = [
+            (offset, min(offset + args.trade_window, len(trades)))
+            for offset in range(0, len(trades), args.trade_window)
+        ]
+    for index, (begin, end) in enumerate(shards):
         args.cache_path = os.path.join(args.output_path, "{}.{}{}".format(name, index, ext))
         log.info("{:10}: creating {}".format("OUT_CACHE", args.cache_path))
         output = connect(args, mode="w")
 
-        df = trades.iloc[offset:offset + args.trade_window]
+        df = trades.iloc[begin:end]
         log.info(
             "{:10}: trades {}-{} (count={})".format(
                 "SAVE", df.iloc[0]["tradenum"], df.iloc[-1]["tradenum"], len(df)
             )
         )
+        if costs is not None:
+            log.info("{:10}: estimated cost {:.3f}s".format("COST", costs[begin:end].sum()))
         output.set_trades(df)
+
+
+def _plan_windows(args):
+    """plans the task windows for the trades in the redis cache, from its manifest, and prints
+    them to stdout as `<start trade> <trade window>` lines. Windows don't span gaps in the
+    trade numbers"""
+    log.info("{:10}: connecting to {}".format("IN_CACHE", args.cache_name))
+    dbase = connect(args, mode="r")
+
+    ranges = dbase.get_trade_ranges()
+    log.info(
+        "{:10}: {} trades in {} range(s)".format("TRADES", sum(stop - start for start, stop in ranges), len(ranges))
+    )
+    model = costmodel.load(args.cost_model) if args.split_by == "cost" else None
+    for start, stop in ranges:
+        if model is not None:
+            # same number of windows, but cut so that each takes about the same time to process
+            # read a window's worth of trades at a time
+            costs = np.concatenate([
+                _costs(args, model, dbase.get_batch(range(offset, min(offset + args.trade_window, stop))))
+                for offset in range(start, stop, args.trade_window)
+            ])
+            windows = costmodel.partition(costs, math.ceil((stop - start) / args.trade_window))
+        else:
+            costs = None
+            windows = [
+                (offset, min(offset + args.trade_window, stop - start))
+                for offset in range(0, stop - start, args.trade_window)
+            ]
+        for begin, end in windows:
+            log.info("{:10}: trades {}-{} (count={})".format("WINDOW", start + begin, start + end - 1, end - begin))
+            if costs is not None:
+                log.info("{:10}: estimated cost {:.3f}s".format("COST", costs[begin:end].sum()))
+            print(start + begin, end - begin, flush=True)
+
+
+def execute(args):
+    # validate and sanitize args
+    check_args(args)
+
+    log.info("{:10}: split start".format("BEGIN"))
+
+    # setup metrics
+    metrics.define_measurements_and_views(_metrics_config)
+
+    start_ts = time.perf_counter()
+    if args.cache_type == "redis":
+        _plan_windows(args)
+    else:
+        _split_file(args)
     end_ts = time.perf_counter()
     delta_ts = end_ts - start_ts
     metrics.put("execution_time", delta_ts)
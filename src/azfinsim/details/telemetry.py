@@ -0,0 +1,272 @@
+r"""
+resource telemetry: a background thread samples the CPU, memory, context switches and disk I/O of
+this process (and its children, e.g. worker pools), and the network I/O of the node, and records
+them through `metrics`, so that they are exported along with the task's metrics and tags. A summary
+is logged when sampling stops, at exit.
+
+All values are for the task, i.e. since sampling started; counters are cumulative. The peak
+resident set sizes are those reported by the OS, since the processes started.
+"""
+import atexit
+import logging
+import os
+import sys
+import threading
+import time
+
+import psutil
+
+try:
+    import resource
+except ImportError:
+    # e.g. on Windows
+    resource = None
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# config for metrics
+_metrics_config = {
+    "cpu_percent": {
+        "description": "CPU utilization of the task (and its children) since the last sample, 100 per core",
+        "unit": "%",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+    "cpu_time": {
+        "description": "CPU time (user + system) used by the task and its children",
+        "unit": "s",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+    "node_cpu_percent": {
+        "description": "CPU utilization of the node since the last sample, 100 for all cores",
+        "unit": "%",
+        "type": "float",
+        "aggregation": "last_value",
+    },
+    "peak_rss": {
+        "description": "peak resident set size of the task's process",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "peak_rss_children": {
+        "description": "peak resident set size of the largest of the task's children that have exited",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "sampled_max_rss": {
+        "description": "largest resident set size of the task and its children together, over the samples",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "ctx_switches_voluntary": {
+        "description": "voluntary context switches (e.g. waiting on I/O) of the task and its children",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "ctx_switches_involuntary": {
+        "description": "involuntary context switches (i.e. preempted) of the task and its children",
+        "unit": "count",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "disk_read_bytes": {
+        "description": "bytes read from disk by the task and its children",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "disk_write_bytes": {
+        "description": "bytes written to disk by the task and its children",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "net_bytes_sent": {
+        "description": "bytes sent over the network by the node",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+    "net_bytes_recv": {
+        "description": "bytes received over the network by the node",
+        "unit": "By",
+        "type": "int",
+        "aggregation": "last_value",
+    },
+}
+
+
+def _peak_rss(process: psutil.Process) -> tuple:
+    """returns the peak resident set size, in bytes, of this process and of the largest of its
+    children that have exited (and been waited for), as reported by the OS; None if not reported"""
+    if resource is not None:
+        scale = 1 if sys.platform == "darwin" else 1024  # kilobytes, except on macOS
+        return (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+        )
+    # the peak working set, on Windows
+    return getattr(process.memory_info(), "peak_wset", None), None
+
+
+class Sampler:
+    """samples resource usage every `interval` seconds, from a background thread"""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._process = psutil.Process()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_ts = time.perf_counter()
+        self._start = self._counters()
+        self._high = self._start
+        self._last = self._start_ts, self._start["cpu_time"]
+        self._max_rss = 0
+        psutil.cpu_percent()  # the first call only sets the baseline for the node utilization
+        self.values = {}
+
+    def _processes(self) -> list:
+        try:
+            return [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return [self._process]
+
+    def _counters(self) -> dict:
+        """returns the cumulative counters of the process and its children, and the node"""
+        counters = dict.fromkeys(
+            ["cpu_time", "rss", "ctx_switches_voluntary", "ctx_switches_involuntary", "disk_read_bytes", "disk_write_bytes"], 0
+        )
+        for process in self._processes():
+            try:
+                with process.oneshot():
+                    cpu = process.cpu_times()
+                    counters["cpu_time"] += cpu.user + cpu.system
+                    if process is self._process:
+                        # children that have exited, and been waited for
+                        counters["cpu_time"] += cpu.children_user + cpu.children_system
+                    counters["rss"] += process.memory_info().rss
+                    switches = process.num_ctx_switches()
+                    counters["ctx_switches_voluntary"] += switches.voluntary
+                    counters["ctx_switches_involuntary"] += switches.involuntary
+                    if hasattr(process, "io_counters"):  # not available on macOS
+                        io = process.io_counters()
+                        counters["disk_read_bytes"] += io.read_bytes
+                        counters["disk_write_bytes"] += io.write_bytes
+            except psutil.Error:
+                continue  # e.g. a worker that has just exited
+        net = psutil.net_io_counters()
+        counters["net_bytes_sent"] = net.bytes_sent if net is not None else 0
+        counters["net_bytes_recv"] = net.bytes_recv if net is not None else 0
+        return counters
+
+    def sample(self) -> dict:
+        """records the usage since sampling started; returns the recorded values"""
+        now = time.perf_counter()
+        counters = self._counters()
+        # the counters of children that exit between samples are lost (until they have
+        # been waited for, for the CPU time), so keep the totals from going backwards
+        for name in counters:
+            if name != "rss":
+                counters[name] = max(counters[name], self._high.get(name, 0))
+        self._high = counters.copy()
+        last_ts, last_cpu_time = self._last
+        self._last = now, counters["cpu_time"]
+        # the sum over the processes only peaks when sampled: a lower bound of the true peak
+        self._max_rss = max(self._max_rss, counters.pop("rss"))
+
+        values = {name: value - self._start[name] for name, value in counters.items()}
+        values["cpu_percent"] = 100.0 * (counters["cpu_time"] - last_cpu_time) / max(now - last_ts, 1e-9)
+        values["node_cpu_percent"] = psutil.cpu_percent()
+        peak_rss, peak_rss_children = _peak_rss(self._process)
+        values["peak_rss"] = peak_rss if peak_rss is not None else self._max_rss
+        values["peak_rss_children"] = peak_rss_children or 0
+        values["sampled_max_rss"] = self._max_rss
+        for name, value in values.items():
+            metrics.put(name, value)
+        self.values = values
+        log.debug("{:10}: {}".format("TELEMETRY", values))
+        return values
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.sample()
+            except Exception:
+                log.exception("failed to sample resource usage")
+
+    def start(self) -> "Sampler":
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> dict:
+        """stops sampling; takes (and returns) a final sample"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        values = self.sample()
+        elapsed = time.perf_counter() - self._start_ts
+        # the average utilization over the task, rather than over the last interval
+        values["cpu_percent"] = 100.0 * values["cpu_time"] / max(elapsed, 1e-9)
+        metrics.put("cpu_percent", values["cpu_percent"])
+        return values
+
+
+_sampler = None
+
+
+def start(interval: float) -> Sampler:
+    """starts sampling resource usage every `interval` seconds, until exit"""
+    global _sampler
+    stop()
+    metrics.define_measurements_and_views(_metrics_config)
+    _sampler = Sampler(interval).start()
+    # registered after `metrics.configure`, so that it runs before the final flush of the metrics
+    atexit.register(stop)
+    return _sampler
+
+
+def stop():
+    """stops sampling, and logs a summary of the resource usage"""
+    global _sampler
+    if _sampler is None:
+        return
+    sampler, _sampler = _sampler, None
+    atexit.unregister(stop)
+    values = sampler.stop()
+    log.info(
+        "{:10}: cpu={:.1f}% ({:.2f}s), peak_rss={:.1f}/{:.1f}MB (task/children), sampled_max_rss={:.1f}MB, "
+        "ctx_switches={}/{} (voluntary/involuntary), "
+        "disk={:.1f}/{:.1f}MB (read/write), net={:.1f}/{:.1f}MB (sent/received)".format(
+            "RESOURCES",
+            values["cpu_percent"],
+            values["cpu_time"],
+            values["peak_rss"] / 2**20,
+            values["peak_rss_children"] / 2**20,
+            values["sampled_max_rss"] / 2**20,
+            values["ctx_switches_voluntary"],
+            values["ctx_switches_involuntary"],
+            values["disk_read_bytes"] / 2**20,
+            values["disk_write_bytes"] / 2**20,
+            values["net_bytes_sent"] / 2**20,
+            values["net_bytes_recv"] / 2**20,
+        )
+    )
+
+
+def _after_fork_in_child():
+    # the sampler thread belongs to the parent, which accounts for its children
+    global _sampler
+    _sampler = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,169 @@
+r"""
+compact containers for trades and results, passed between the cache, the pricing engine
+and the result writer instead of per-trade pandas objects.
+"""
+from collections.abc import MutableMapping
+
+import numpy as np
+import pandas as pd
+
+# the columns of a trade, see `utils.GenerateTrade`
+FIELDS = (
+    "tradenum",
+    "fx1",
+    "start_date",
+    "end_date",
+    "drift",
+    "maturity",
+    "t_steps",
+    "trials",
+    "ro",
+    "v",
+    "sigma1",
+    "warrantsNo",
+    "notionalPerWarr",
+    "strike",
+)
+_FIELDS = frozenset(FIELDS)
+
+
+class Trade(MutableMapping):
+    """a single trade, as a mapping of column name to value. The standard columns are held
+    in slots; any other columns (e.g. per-trade options) in a dict"""
+
+    __slots__ = FIELDS + ("_extra",)
+
+    def __init__(self, columns=(), **kwargs):
+        self._extra = None
+        self.update(columns, **kwargs)
+
+    def __getitem__(self, key):
+        if key in _FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Trade({})".format(dict(self))
+
+    def copy(self) -> "Trade":
+        return Trade(self)
+
+
+class TradeBatch:
+    """a batch of trades stored as column arrays; supports the parts of the DataFrame
+    interface used for whole-batch computations (`columns`, `batch[column]`, `len`)"""
+
+    def __init__(self, columns: dict):
+        self._columns = {name: np.asarray(values) for name, values in columns.items()}
+        lengths = {len(values) for values in self._columns.values()}
+        assert len(lengths) <= 1, "columns must have the same length"
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "TradeBatch":
+        return cls({name: df[name].to_numpy() for name in df.columns})
+
+    @classmethod
+    def from_records(cls, records: list) -> "TradeBatch":
+        """creates a batch from mappings (e.g. dicts or Series), one per trade"""
+        names = list(dict.fromkeys(name for record in records for name in record.keys()))
+        return cls({name: [record.get(name) for record in records] for name in names})
+
+    @classmethod
+    def concat(cls, batches: list) -> "TradeBatch":
+        """returns the trades of the batches (with the same columns), one after the other"""
+        if len(batches) == 1:
+            return batches[0]
+        return cls({name: np.concatenate([batch[name] for batch in batches]) for name in batches[0].columns})
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    @property
+    def tradenums(self) -> list:
+        return self._columns["tradenum"].tolist()
+
+    def __getitem__(self, name) -> np.ndarray:
+        return self._columns[name]
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        """yields the trades as `Trade` records (with python scalar values)"""
+        names = list(self._columns)
+        for values in zip(*(self._columns[name].tolist() for name in names)):
+            yield Trade(zip(names, values))
+
+    def take(self, indices) -> "TradeBatch":
+        """returns the batch of trades at the given positions"""
+        return TradeBatch({name: values[indices] for name, values in self._columns.items()})
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self._columns)
+
+
+class ResultBatch:
+    """accumulates result rows (dicts of column lists, as returned by `azfinsim.compute`)
+    into column lists, written out as a single DataFrame"""
+
+    def __init__(self):
+        self._columns = {}
+        self._length = 0
+
+    def append(self, row: dict) -> None:
+        count = max((len(values) for values in row.values() if isinstance(values, list)), default=1)
+        for name, values in row.items():
+            if name not in self._columns:
+                self._columns[name] = [None] * self._length
+            column = self._columns[name]
+            if isinstance(values, list):
+                column.extend(values)
+            else:
+                # scalar, e.g. the trade number, repeated on every row
+                column.extend([values] * count)
+        self._length += count
+        for column in self._columns.values():
+            if len(column) < self._length:
+                column.extend([None] * (self._length - len(column)))
+
+    def __len__(self):
+        return self._length
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self._columns)
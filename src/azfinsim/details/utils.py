@@ -17,30 +17,143 @@ def InjectRandomFail(failure):
 def DoFakeCompute(delay_time, task_duration, mem_usage):
     import time
 
-    # allocate the memory
-    array_size = (mem_usage, 131072)
-    data = np.ones(array_size, dtype=np.float64)
     # do startup delay
     time.sleep(delay_time)
 
     # now do fake computation
-    task_duration_s = task_duration / 1000.0  # - convert from ms to s
-    end_time = time.time() + task_duration_s
-    while time.time() < end_time:
-        data *= 12345.67890
-        data[:] = 1.0
+    SyntheticWorkload("memory", mem_usage).run(task_duration / 1000.0)  # - convert from ms to s
+
+
+class SyntheticWorkload:
+    """fake pricing workload, for benchmarking schedulers and pool configurations.
+
+    Profiles:
+      * memory: streams over a `mem_usage` MB buffer (memory bandwidth bound)
+      * cpu: floating point loops over a small, cache resident, array
+      * io: sleeps, as if waiting on I/O
+      * threads: cpu loops on `threads` threads at once (numpy releases the GIL)
+
+    Buffers (and threads) are allocated once, when the workload is created, and work is done
+    in small chunks so that each run ends close to the requested duration."""
+
+    _CHUNK = 1 << 15  # elements processed between checks of the clock (256 KB)
+
+    def __init__(self, profile: str = "memory", mem_usage: int = 16, threads: int = 1):
+        if profile not in ["memory", "cpu", "io", "threads"]:
+            raise ValueError(f"Unknown synthetic profile: {profile}")
+        self._profile = profile
+        self._data = None
+        self._executor = None
+        if profile == "memory":
+            self._data = np.ones(max(mem_usage, 1) * 131072, dtype=np.float64)
+        elif profile in ["cpu", "threads"]:
+            count = threads if profile == "threads" else 1
+            self._arrays = [np.ones(self._CHUNK, dtype=np.float64) for _ in range(count)]
+            if count > 1:
+                import concurrent.futures
+
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=count)
+
+    def run(self, duration: float) -> None:
+        """runs the workload for `duration` seconds"""
+        import time
+
+        end_time = time.perf_counter() + duration
+        if self._profile == "io":
+            time.sleep(max(duration, 0.0))
+        elif self._profile == "memory":
+            self._stream(end_time)
+        elif self._executor is None:
+            self._spin(self._arrays[0], end_time)
+        else:
+            for future in [self._executor.submit(self._spin, array, end_time) for array in self._arrays]:
+                future.result()
+
+    def _stream(self, end_time: float) -> None:
+        import time
+
+        data = self._data
+        while time.perf_counter() < end_time:
+            for offset in range(0, len(data), self._CHUNK):
+                chunk = data[offset:offset + self._CHUNK]
+                np.multiply(chunk, 12345.67890, out=chunk)
+                chunk[:] = 1.0
+                if time.perf_counter() >= end_time:
+                    return
+
+    @staticmethod
+    def _spin(array: np.ndarray, end_time: float) -> None:
+        import time
+
+        while time.perf_counter() < end_time:
+            # multiply-add converging to a fixed point, so the values stay finite
+            np.multiply(array, 0.999999, out=array)
+            np.add(array, 1e-6, out=array)
+
+
+def SampleDuration(
+    mean: float, distribution: str = "fixed", sigma: float = 0.5, fraction: float = 0.1, ratio: float = 10.0
+) -> float:
+    """returns a task duration with the given `mean`, drawn from the distribution:
+    fixed, lognormal (with log standard deviation `sigma`) or bimodal (a `fraction` of
+    tasks `ratio` times longer than the rest)"""
+    if distribution == "fixed":
+        return mean
+    elif distribution == "lognormal":
+        return float(np.random.lognormal(np.log(mean) - sigma**2 / 2, sigma)) if mean > 0 else 0.0
+    elif distribution == "bimodal":
+        short = mean / (1 - fraction + fraction * ratio)
+        return short * ratio if np.random.random_sample() < fraction else short
+    else:
+        raise ValueError(f"Unknown duration distribution: {distribution}")
 
 
 def GenerateTrade(tradenum: int, N: int) -> pd.DataFrame:
     # just use the time now
+    tradenums = range(tradenum, tradenum + N)
+    draws = {}
+    draws["fx1"] = np.random.rand(N)
+    draws["drift"] = np.random.rand(N)
+    draws["sigma1"] = np.random.rand(N)
+    draws["warrantsNo"] = np.random.randint(30000, 60000, N)
+    draws["notionalPerWarr"] = np.random.rand(N)
+    draws["strike"] = np.random.rand(N)
+    return _trades_from_draws(tradenums, draws)
+
+
+# number of uniform draws reserved for each trade by `GenerateTradesSeeded`; a multiple of
+# 4, since each step of the Philox counter produces 4 draws
+_DRAWS_PER_TRADE = 8
+
+
+def GenerateTradesSeeded(seed: int, tradenum: int, N: int) -> pd.DataFrame:
+    """generates trades `tradenum` to `tradenum + N - 1`, with the same distributions as
+    `GenerateTrade`. Each trade is a function of `seed` and its trade number only, so any
+    range of trades can be (re)generated independently."""
+    bitgen = np.random.Philox(key=seed)
+    bitgen.advance(tradenum * _DRAWS_PER_TRADE // 4)
+    uniforms = np.random.Generator(bitgen).random((N, _DRAWS_PER_TRADE))
+    draws = {}
+    draws["fx1"] = uniforms[:, 0]
+    draws["drift"] = uniforms[:, 1]
+    draws["sigma1"] = uniforms[:, 2]
+    draws["warrantsNo"] = 30000 + (uniforms[:, 3] * 30000).astype(np.int64)
+    draws["notionalPerWarr"] = uniforms[:, 4]
+    draws["strike"] = uniforms[:, 5]
+    return _trades_from_draws(range(tradenum, tradenum + N), draws)
+
+
+def _trades_from_draws(tradenums: range, draws: dict) -> pd.DataFrame:
+    """builds the trades from uniform draws in [0, 1) (and the number of warrants)"""
+    N = len(tradenums)
     newFile = {}
-    newFile["tradenum"] = range(tradenum, tradenum + N)
-    newFile["fx1"] = np.random.rand(N) * 0.12 + 0.8285
+    newFile["tradenum"] = tradenums
+    newFile["fx1"] = draws["fx1"] * 0.12 + 0.8285
 
     newFile["start_date"] = [dt.date(2017, 12, 29)] * N
     newFile["end_date"] = [dt.date(2018, 8, 28)] * N
 
-    newFile["drift"] = np.random.rand(N) * 0.2 - 0.1
+    newFile["drift"] = draws["drift"] * 0.2 - 0.1
     newFile["maturity"] = [0.20] * N
 
     t_steps = np.busday_count(
@@ -57,10 +170,10 @@ def GenerateTrade(tradenum: int, N: int) -> pd.DataFrame:
         0.000038413221829
     ] * N  # calibration value: 0.000038413221829   Vega01 value: 0.0000387714624899
     newFile["v"] = [0.00154807378604] * N
-    newFile["sigma1"] = np.random.rand(N) * 0.03 - 0.015 + 0.0808844481978
+    newFile["sigma1"] = draws["sigma1"] * 0.03 - 0.015 + 0.0808844481978
 
-    newFile["warrantsNo"] = np.random.randint(30000, 60000, N)
-    newFile["notionalPerWarr"] = np.random.rand(N) * 100 + 950
+    newFile["warrantsNo"] = draws["warrantsNo"]
+    newFile["notionalPerWarr"] = draws["notionalPerWarr"] * 100 + 950
     # newFile['strike'] = np.random.rand(N)*0.2 + 0.9
-    newFile["strike"] = np.random.rand(N) * 0.12 + 0.7
+    newFile["strike"] = draws["strike"] * 0.12 + 0.7
     return pd.DataFrame.from_dict(newFile)
@@ -0,0 +1,4 @@
+from .details import getargs, pipeline
+
+args = getargs.getargs("pipeline")
+pipeline.execute(args)
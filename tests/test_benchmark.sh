@@ -0,0 +1,33 @@
+#!/usr/bin/env bash
+set -e
+# set -x
+
+echo "validate float32 simulation against float64"
+python3 -m azfinsim.benchmark \
+    --benchmark precision \
+    -n 10 \
+    --trials 10000
+
+echo "validate simulation kernels against the reference kernel"
+python3 -m azfinsim.benchmark \
+    --benchmark kernels \
+    -n 5 \
+    --trials 2000
+
+echo "validate coarse time-stepping with the Brownian bridge against the daily grid"
+python3 -m azfinsim.benchmark \
+    --benchmark bridge \
+    -n 5 \
+    --trials 10000
+
+echo "compare reading trades one at a time and in batches from a cache with latency"
+python3 -m azfinsim.benchmark \
+    --benchmark cache \
+    -n 200 \
+    --cache-latency 1 \
+    --cache-bandwidth 100
+
+echo "compare compression codecs on the trades"
+python3 -m azfinsim.benchmark \
+    --benchmark compression \
+    -n 1000
@@ -7,6 +7,8 @@ num_trades=20
 num_files=4
 
 mkdir -p $RESULTS_DIR
+rm -f $RESULTS_DIR/metrics.jsonl $RESULTS_DIR/results.db $RESULTS_DIR/cost.json $RESULTS_DIR/autotune.json
+rm -rf $RESULTS_DIR/balanced $RESULTS_DIR/synthetic $RESULTS_DIR/generated $RESULTS_DIR/pipeline $RESULTS_DIR/compressed $RESULTS_DIR/autotuned
 
 echo "populate with $num_trades trades"
 python3 -m azfinsim.generator \
@@ -32,7 +34,11 @@ for i in $(seq 0 $((num_files-1))); do
     echo "process $RESULTS_DIR/trades.$i.csv"
     python3 -m azfinsim.azfinsim \
         --cache-path $RESULTS_DIR/trades.$i.csv \
-        --algorithm pvonly
+        --algorithm pvonly \
+        --metrics-sink jsonl \
+        --metrics-path $RESULTS_DIR/metrics.jsonl \
+        --cost-model $RESULTS_DIR/cost.json \
+        --telemetry
 
     echo "verify results were added"
     keys=$(cat $RESULTS_DIR/trades.$i.results.csv | wc -l)
@@ -43,6 +49,173 @@ for i in $(seq 0 $((num_files-1))); do
     fi
 done
 
+echo "verify metrics were exported"
+runs=$(grep -c '"compute_time"' $RESULTS_DIR/metrics.jsonl)
+if [ $runs -lt $num_files ]; then
+    echo "Expected metrics from $num_files runs, found $runs"
+    exit 1
+fi
+runs=$(grep -c '"peak_rss"' $RESULTS_DIR/metrics.jsonl)
+if [ $runs -lt $num_files ]; then
+    echo "Expected resource telemetry from $num_files runs, found $runs"
+    exit 1
+fi
+
+echo "process trades using scenarios"
+echo '{"algorithm": "scenarios", "scenarios": {"fx1": [-0.01, 0, 0.01], "sigma1": [-0.1, 0.1]}}' \
+    > $RESULTS_DIR/scenarios.json
+python3 -m azfinsim.azfinsim \
+    --cache-path $RESULTS_DIR/trades.0.csv \
+    --output-path $RESULTS_DIR/scenarios \
+    --config $RESULTS_DIR/scenarios.json
+
+echo "verify scenario results were added"
+keys=$(cat $RESULTS_DIR/scenarios/trades.0.results.csv | wc -l)
+keys=$((keys-1)) # remove header
+if [ $keys -ne $((num_trades/num_files*6)) ]; then
+    echo "Expected $((num_trades/num_files*6)) scenario results, found $keys"
+    exit 1
+fi
+
+echo "process trades twice using a result cache"
+for run in 1 2; do
+    python3 -m azfinsim.azfinsim \
+        --cache-path $RESULTS_DIR/trades.1.csv \
+        --output-path $RESULTS_DIR/cached \
+        --algorithm pvonly \
+        --result-cache file \
+        --result-cache-path $RESULTS_DIR/results.db \
+        --metrics-sink jsonl \
+        --metrics-path $RESULTS_DIR/cached/metrics.$run.jsonl
+done
+
+echo "verify results were reused"
+if ! grep -q "\"result_cache_hits\": $((num_trades/num_files))" $RESULTS_DIR/cached/metrics.2.jsonl; then
+    echo "Expected $((num_trades/num_files)) result cache hits"
+    exit 1
+fi
+
+echo "split trades balanced by cost and process them using a worker pool"
+python3 -m azfinsim.split \
+    --cache-path $RESULTS_DIR/trades.csv \
+    --output-path $RESULTS_DIR/balanced \
+    -w $((num_trades/$num_files)) \
+    --split-by cost \
+    --algorithm pvonly \
+    --cost-model $RESULTS_DIR/cost.json
+for i in $(seq 0 $((num_files-1))); do
+    # alternate between passing trades through the pool's queues and through shared memory
+    shared=""
+    if [ $((i % 2)) -eq 1 ]; then
+        shared="--shared-memory"
+    fi
+    python3 -m azfinsim.azfinsim \
+        --cache-path $RESULTS_DIR/balanced/trades.$i.csv \
+        --algorithm pvonly \
+        --workers 2 $shared
+done
+
+echo "verify all balanced results were added"
+keys=$(cat $RESULTS_DIR/balanced/trades.[0-9]*.results.csv | grep -vc tradenum)
+if [ $keys -ne $num_trades ]; then
+    echo "Expected $num_trades results keys, found $keys"
+    exit 1
+fi
+
+echo "process trades using a synthetic workload"
+python3 -m azfinsim.azfinsim \
+    --cache-path $RESULTS_DIR/trades.csv \
+    --output-path $RESULTS_DIR/synthetic \
+    --algorithm synthetic \
+    --synthetic-profile threads \
+    --synthetic-threads 2 \
+    --task-duration 10 \
+    --duration-distribution lognormal \
+    --log-sample 5
+
+echo "verify synthetic results were added"
+keys=$(cat $RESULTS_DIR/synthetic/trades.results.csv | wc -l)
+keys=$((keys-1)) # remove header
+if [ $keys -ne $num_trades ]; then
+    echo "Expected $num_trades results keys, found $keys"
+    exit 1
+fi
+
+echo "process trades generated on the fly"
+python3 -m azfinsim.azfinsim \
+    --cache-type generated \
+    -s $start_trade \
+    -w $num_trades \
+    --seed 42 \
+    --output-path $RESULTS_DIR/generated \
+    --algorithm pvonly
+
+echo "verify generated results were added"
+keys=$(cat $RESULTS_DIR/generated/generated.$start_trade.results.csv | wc -l)
+keys=$((keys-1)) # remove header
+if [ $keys -ne $num_trades ]; then
+    echo "Expected $num_trades results keys, found $keys"
+    exit 1
+fi
+
+echo "run the generate, split, process and merge steps as an in-memory pipeline"
+python3 -m azfinsim.pipeline \
+    -s $start_trade \
+    -w $num_trades \
+    --shard-size $((num_trades/$num_files)) \
+    --seed 42 \
+    --algorithm pvonly \
+    --materialize merged \
+    --output-path $RESULTS_DIR/pipeline
+
+echo "verify pipeline results match the generated results"
+if ! cmp -s <(cut -d, -f1-4 $RESULTS_DIR/pipeline/results.csv) \
+        <(cut -d, -f1-4 $RESULTS_DIR/generated/generated.$start_trade.results.csv); then
+    echo "Pipeline results differ from generated results"
+    exit 1
+fi
+
+echo "process generated trades with auto-tuned batching and workers, calibrating then reusing the settings"
+# calibrating takes a few batches of up to 2 trades per CPU
+for run in calibrate reuse; do
+    python3 -m azfinsim.azfinsim \
+        --cache-type generated \
+        -s $start_trade \
+        -w $((2*num_trades)) \
+        --seed 42 \
+        --output-path $RESULTS_DIR/autotuned/$run \
+        --algorithm pvonly \
+        --autotune \
+        --autotune-file $RESULTS_DIR/autotune.json
+done
+
+echo "verify auto-tuned results match the generated results"
+for run in calibrate reuse; do
+    if ! cmp -s <(head -n $((num_trades+1)) $RESULTS_DIR/autotuned/$run/generated.$start_trade.results.csv | cut -d, -f1-4) \
+            <(cut -d, -f1-4 $RESULTS_DIR/generated/generated.$start_trade.results.csv); then
+        echo "Auto-tuned results differ from generated results"
+        exit 1
+    fi
+done
+
+echo "price the trades analytically, with Monte Carlo outside the validity band"
+python3 -m azfinsim.pipeline \
+    -s $start_trade \
+    -w $num_trades \
+    --seed 42 \
+    --algorithm hybrid \
+    --analytic-min-barrier-distance 50 \
+    --materialize merged \
+    --output-path $RESULTS_DIR/hybrid
+
+echo "verify hybrid results were added"
+keys=$(cat $RESULTS_DIR/hybrid/results.csv | wc -l)
+keys=$((keys-1)) # remove header
+if [ $keys -ne $num_trades ]; then
+    echo "Expected $num_trades results keys, found $keys"
+    exit 1
+fi
+
 echo "merge results"
 python3 -m azfinsim.concat \
     --cache-path "$RESULTS_DIR/trades.[0-9]*.results.csv" \
@@ -55,3 +228,26 @@ if [ $keys -ne $num_trades ]; then
     echo "Expected $num_trades results keys, found $keys"
     exit 1
 fi
+
+echo "split trades into compressed files"
+python3 -m azfinsim.split \
+    --cache-path $RESULTS_DIR/trades.csv \
+    --output-path $RESULTS_DIR/compressed \
+    --cache-compression zlib \
+    -w $((num_trades/$num_files))
+
+echo "verify compressed files merge like uncompressed files"
+python3 -m azfinsim.concat \
+    --cache-path "$RESULTS_DIR/compressed/trades.[0-9]*.csv" \
+    --output-path $RESULTS_DIR/compressed/trades.csv
+python3 -m azfinsim.concat \
+    --cache-path "$RESULTS_DIR/trades.[0-9].csv" \
+    --output-path $RESULTS_DIR/compressed/uncompressed.csv
+if head -c 8 $RESULTS_DIR/compressed/trades.0.csv | grep -q tradenum; then
+    echo "Expected compressed files"
+    exit 1
+fi
+if ! cmp -s $RESULTS_DIR/compressed/uncompressed.csv $RESULTS_DIR/compressed/trades.csv; then
+    echo "Trades merged from compressed files differ"
+    exit 1
+fi
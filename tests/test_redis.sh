@@ -20,6 +20,15 @@ if [ $keys -ne $num_trades ]; then
     exit 1
 fi
 
+echo "plan task windows from the trade manifest"
+windows=$(python3 -m azfinsim.split \
+    --cache-name $REDIS_HOST --cache-port $REDIS_PORT --cache-ssl no \
+    -w 10000)
+if [ "$(echo "$windows" | head -1)" != "$start_trade 10000" ] || [ $(echo "$windows" | wc -l) -ne 3 ]; then
+    echo "Unexpected windows: $windows"
+    exit 1
+fi
+
 echo "process trades"
 python3 -m azfinsim.azfinsim \
     --cache-name $REDIS_HOST --cache-port $REDIS_PORT --cache-ssl no \
@@ -47,4 +56,26 @@ if [ $keys -ne 6 ]; then
     exit 1
 fi
 
+echo "process trades writing results to a stream"
+python3 -m azfinsim.azfinsim \
+    --cache-name $REDIS_HOST --cache-port $REDIS_PORT --cache-ssl no \
+    -s $start_trade \
+    -w 20 \
+    --algorithm pvonly \
+    --result-sink stream
+
+echo "collect results from the stream"
+python3 -m azfinsim.collect \
+    --cache-name $REDIS_HOST --cache-port $REDIS_PORT --cache-ssl no \
+    --algorithm pvonly \
+    --output-path /tmp/collected.csv
+
+echo "verify results were collected"
+keys=$(cat /tmp/collected.csv | wc -l)
+keys=$((keys-1)) # remove header
+if [ $keys -ne 20 ]; then
+    echo "Expected 20 results, found $keys"
+    exit 1
+fi
+
 echo "done"
@@ -0,0 +1,84 @@
+#!/usr/bin/env bash
+
+set -e
+# set -x
+
+# starts a local 3 node Redis Cluster on ports $CLUSTER_PORT..$CLUSTER_PORT+2 (requires redis-server)
+CLUSTER_PORT=${CLUSTER_PORT:-7000}
+ports="$CLUSTER_PORT $((CLUSTER_PORT+1)) $((CLUSTER_PORT+2))"
+cluster_dir=$(mktemp -d)
+
+function cleanup {
+    for port in $ports; do
+        redis-cli -p $port shutdown nosave > /dev/null 2>&1 || true
+    done
+    rm -rf $cluster_dir
+}
+trap cleanup EXIT
+
+echo "start cluster"
+for port in $ports; do
+    mkdir -p $cluster_dir/$port
+    redis-server --port $port --cluster-enabled yes --cluster-config-file nodes.conf \
+        --dir $cluster_dir/$port --save "" --appendonly no --daemonize yes
+done
+sleep 1
+redis-cli --cluster create $(for port in $ports; do echo 127.0.0.1:$port; done) \
+    --cluster-replicas 0 --cluster-yes > /dev/null
+until redis-cli -p $CLUSTER_PORT cluster info | grep -q "cluster_state:ok"; do
+    sleep 1
+done
+
+# counts the keys matching the pattern on all nodes
+function count_keys {
+    local count=0
+    for port in $ports; do
+        count=$((count + $(redis-cli -p $port --scan --pattern "$1" | wc -l)))
+    done
+    echo $count
+}
+
+CACHE="--cache-name 127.0.0.1 --cache-port $CLUSTER_PORT --cache-ssl no --cache-cluster"
+
+echo "populate with 23,000 trades"
+start_trade=9899
+num_trades=23000
+python3 -m azfinsim.generator $CACHE \
+    -s $start_trade \
+    -w $num_trades
+
+echo "verify trades have been added, across nodes"
+keys=$(count_keys "trade:{*")
+if [ $keys -ne $num_trades ]; then
+    echo "Expected $num_trades keys, found $keys"
+    exit 1
+fi
+for port in $ports; do
+    if [ $(redis-cli -p $port --scan --pattern "trade:{*" | wc -l) -eq 0 ]; then
+        echo "No trades on node $port"
+        exit 1
+    fi
+done
+
+echo "plan task windows from the trade manifest"
+windows=$(python3 -m azfinsim.split $CACHE -w 10000)
+if [ "$(echo "$windows" | head -1)" != "$start_trade 10000" ] || [ $(echo "$windows" | wc -l) -ne 3 ]; then
+    echo "Unexpected windows: $windows"
+    exit 1
+fi
+
+echo "process trades spanning several chunks"
+python3 -m azfinsim.azfinsim $CACHE \
+    -s $((start_trade+950)) \
+    -w 120 \
+    --algorithm synthetic \
+    --task-duration 0
+
+echo "verify results were added"
+keys=$(count_keys "synthetic:{*")
+if [ $keys -ne 120 ]; then
+    echo "Expected 120 results keys, found $keys"
+    exit 1
+fi
+
+echo "done"